@@ -0,0 +1,107 @@
+"""
+Benchmark the websocket heartbeat hub with many idle connections on one worker.
+
+Websockets are replaced by stubs that answer every ping right away, so the numbers
+cover the hub itself (registry memory, CPU spent per tick), not the network stack.
+For comparison, the memory of one sleeping task per connection (the previous design)
+is measured as well.
+
+Usage:
+    python -m scripts.bench_heartbeat_hub --connections 10000
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from src.components import config
+from src.components.heartbeat import HeartbeatHub
+
+
+class _WebsocketStub:
+    __slots__ = ('loop',)
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    async def ping(self):
+        waiter = self.loop.create_future()
+        self.loop.call_soon(waiter.set_result, None)  # pong arrives on the next loop iteration
+        return waiter
+
+    def fail_connection(self, *_a, **_kw):
+        return True
+
+
+async def _noop(_username):
+    return None
+
+
+def _traced_bytes(fn) -> int:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    keep = fn()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    _ = keep
+    return after - before
+
+
+async def bench(n_connections: int, n_users: int, n_slots: int):
+    loop = asyncio.get_running_loop()
+    stubs = [_WebsocketStub(loop) for _ in range(n_connections)]
+    hub = HeartbeatHub(config.CONFIG_HEARTBEAT_INTERVAL_S, n_slots, _noop)
+
+    # memory held by the registry, per connection
+    registry_bytes = _traced_bytes(
+        lambda: [hub.register(ws, f"user{i % n_users}") for i, ws in enumerate(stubs)]
+    )
+
+    # spread connections evenly, as they would be when clients connect over time
+    for conn in [c for slot in hub._slots for c in slot]:
+        hub.unregister(conn)
+    for i, ws in enumerate(stubs):
+        hub._cursor = i % n_slots
+        hub.register(ws, f"user{i % n_users}")
+    hub._cursor = 0
+
+    # two revolutions: the first sends pings, the second also checks pongs
+    samples = []
+    for _ in range(2 * n_slots):
+        start = time.process_time()
+        reaped = await hub.tick()
+        samples.append(time.process_time() - start)
+        assert reaped == 0
+        await asyncio.sleep(0)  # let pongs arrive
+    samples = samples[n_slots:]
+
+    # memory of the previous design: one sleeping task per connection
+    async def _sender():
+        await asyncio.sleep(3600)
+
+    tasks = []
+    task_bytes = _traced_bytes(lambda: tasks.extend(loop.create_task(_sender()) for _ in range(n_connections)))
+    await asyncio.sleep(0)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    print(f"connections:              {n_connections} ({n_users} users, {n_slots} slots)")
+    print(f"registry memory:          {registry_bytes / n_connections:.0f} B/connection")
+    print(f"task-per-connection:      {task_bytes / n_connections:.0f} B/connection")
+    print(f"cpu per tick (avg / max): {1e3 * sum(samples) / len(samples):.3f} ms / {1e3 * max(samples):.3f} ms "
+          f"(~{n_connections // n_slots} pings per tick, one tick every {hub.tick_s:.1f}s)")
+    print(f"cpu per revolution:       {1e3 * sum(samples):.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--slots", type=int, default=config.CONFIG_HEARTBEAT_WHEEL_SLOTS)
+    args = parser.parse_args()
+    asyncio.run(bench(args.connections, args.users, args.slots))
+
+
+if __name__ == "__main__":
+    main()
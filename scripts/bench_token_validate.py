@@ -0,0 +1,98 @@
+"""
+Benchmark the auth-url token validation handler at a fixed request rate.
+
+Requests are generated open-loop (arrival times do not depend on completions) against the
+handler in-process, with a fixed set of workspace users reusing their tokens the way browsers
+do. The numbers cover the handler (token extraction, verification, response), not the network
+or the ingress.
+
+Usage:
+    python -m scripts.bench_token_validate --rps 5000 --duration 10
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+import jwt
+from loguru import logger
+
+from src.components import config
+from src.components.validator import DeviceTokenValidator, handle_token_validate
+
+_SECRET = "bench-secret-bench-secret-bench-secret"
+_ALGORITHM = "HS256"
+
+
+class _RequestStub:
+    __slots__ = ('cookies', 'headers')
+
+    def __init__(self, token: str):
+        self.cookies = {}
+        self.headers = {'Authorization': f"Bearer {token}"}
+
+
+def _make_tokens(n_users: int):
+    now = int(time.time())
+    return [
+        (f"user{i}", jwt.encode({
+            'username': f"user{i}",
+            'exp': now + config.CONFIG_DEVICE_TOKEN_EXPIRE_S,
+            'iat': now,
+            'email': None,
+            'role': "device",
+            'uid': 1000 + i,
+        }, _SECRET, algorithm=_ALGORITHM))
+        for i in range(n_users)
+    ]
+
+
+async def bench(rps: int, duration_s: float, n_users: int, maxsize: int):
+    validator = DeviceTokenValidator(_SECRET, _ALGORITHM, maxsize=maxsize)
+    tokens = _make_tokens(n_users)
+    latencies = []
+
+    async def _one(username, token, scheduled_at):
+        await handle_token_validate(_RequestStub(token), username, validator)
+        latencies.append(time.perf_counter() - scheduled_at)
+
+    loop = asyncio.get_running_loop()
+    n_requests = int(rps * duration_s)
+    start = time.perf_counter()
+    pending = []
+    for i in range(n_requests):
+        scheduled_at = start + i / rps
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        username, token = tokens[i % n_users]
+        pending.append(loop.create_task(_one(username, token, scheduled_at)))
+    await asyncio.gather(*pending)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f"requests:   {n_requests} at {rps} rps target ({n_requests / elapsed:.0f} rps achieved)")
+    print(f"users:      {n_users}, cache size {maxsize}")
+    print(f"latency:    p50 {1e3 * statistics.median(latencies):.3f} ms, "
+          f"p99 {1e3 * latencies[int(0.99 * len(latencies)) - 1]:.3f} ms, "
+          f"max {1e3 * latencies[-1]:.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rps", type=int, default=5000)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--cache-size", type=int, default=config.CONFIG_TOKEN_CACHE_SIZE,
+                        help="0 disables caching, for comparison")
+    args = parser.parse_args()
+
+    # per-request debug logs would dominate the measurement
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    asyncio.run(bench(args.rps, args.duration, args.users, args.cache_size))
+
+
+if __name__ == "__main__":
+    main()
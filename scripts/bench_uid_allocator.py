@@ -0,0 +1,101 @@
+"""
+Benchmark user-creation throughput with block-leased uids against a MongoDB.
+
+Each worker process allocates a uid and inserts a user document, with a number of concurrent creators per
+worker, the way an OIDC login storm or a batch import would. Password hashing is left out, it scales with
+the cores and is not what contends on the global document. --block-size 1 is the previous behaviour, one
+$inc on the global document per user.
+
+The benchmark writes to a scratch database which is dropped afterwards.
+
+Usage:
+    python -m scripts.bench_uid_allocator --workers 8 --users 4000 --block-size 1
+    python -m scripts.bench_uid_allocator --workers 8 --users 4000 --block-size 32
+"""
+import argparse
+import asyncio
+import multiprocessing
+import sys
+import time
+
+from loguru import logger
+from pymongo import MongoClient
+
+import src.components.datamodels as datamodels
+from src.apiserver.repo import DBRepo, UidAllocator
+
+
+def _options(args) -> dict:
+    return {'DB_HOST': args.db_host, 'DB_PORT': args.db_port, 'DB_USERNAME': args.db_username,
+            'DB_PASSWORD': args.db_password}
+
+
+async def _worker_main(args, n_users: int) -> list:
+    allocator = UidAllocator(DBRepo(_options(args)), block_size=args.block_size)
+    users = allocator.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
+    queue = list(range(n_users))
+    uids = []
+
+    async def _creator():
+        while queue:
+            i = queue.pop()
+            uid = await allocator.next()
+            await users.insert_one({'uid': uid, 'username': f"bench-{uid}-{i}"})
+            uids.append(uid)
+
+    await asyncio.gather(*[_creator() for _ in range(args.concurrency)])
+    return uids
+
+
+def _worker(args, n_users: int, ready, start, results):
+    ready.wait()
+    start.wait()
+    results.put(asyncio.new_event_loop().run_until_complete(_worker_main(args, n_users)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--users", type=int, default=4000, help="users created in total")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent creators per worker")
+    parser.add_argument("--block-size", type=int, default=32)
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-port", type=int, default=27017)
+    parser.add_argument("--db-username", default="")
+    parser.add_argument("--db-password", default="")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+
+    # the worker processes resolve the collections of the scratch database
+    datamodels.database_name = "clpl_bench_uid"
+    account = f"{args.db_username}:{args.db_password}@" if args.db_username else ""
+    conn = MongoClient(f"mongodb://{account}{args.db_host}:{args.db_port}")
+    conn.drop_database(datamodels.database_name)
+    conn[datamodels.database_name][datamodels.global_collection_name].insert_one({"_id": "global", "uid_counter": 1})
+
+    ctx = multiprocessing.get_context("fork")
+    ready, start, results = ctx.Barrier(args.workers + 1), ctx.Barrier(args.workers + 1), ctx.Queue()
+    per_worker = args.users // args.workers
+    procs = [ctx.Process(target=_worker, args=(args, per_worker, ready, start, results))
+             for _ in range(args.workers)]
+    for p in procs:
+        p.start()
+    ready.wait()
+
+    started_at = time.perf_counter()
+    start.wait()
+    uids = [uid for _ in procs for uid in results.get()]
+    elapsed = time.perf_counter() - started_at
+    for p in procs:
+        p.join()
+
+    conn.drop_database(datamodels.database_name)
+    logger.info(f"workers={args.workers} concurrency={args.concurrency} block_size={args.block_size}")
+    logger.info(f"created {len(uids)} users in {elapsed:.2f}s, {len(uids) / elapsed:.0f} users/s")
+    logger.info(f"unique uids: {len(set(uids)) == len(uids)}, range: {min(uids)}..{max(uids)}")
+
+
+if __name__ == "__main__":
+    main()
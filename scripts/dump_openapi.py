@@ -54,11 +54,15 @@ import src.components.tasks as _tasks  # noqa: E402
 import src.components.utils as _utils  # noqa: E402
 
 _tasks.check_and_create_admin_user = lambda _opt: None
+_tasks.check_and_create_indexes = lambda _opt: None
+_tasks.migrate_password_less_users = lambda _opt: None
 _tasks.check_kubernetes_connection = lambda _opt: None
 _tasks.set_crash_flag = _async_none
 _tasks.get_crash_flag = _async_get_crash_flag
 _tasks.recover_from_crash = _async_recover
 _tasks.scan_pods = _async_scan
+_tasks.audit_usage = _async_scan
+_tasks.flush_heartbeats = _async_scan
 
 _utils.get_k8s_client = lambda *_a, **_kw: _K8sStub()
 
@@ -66,8 +70,12 @@ _ctrl.set_crash_flag = _async_none
 _ctrl.get_crash_flag = _async_get_crash_flag
 _ctrl.recover_from_crash = _async_recover
 _ctrl.scan_pods = _async_scan
+_ctrl.audit_usage = _async_scan
+_ctrl.flush_heartbeats = _async_scan
 
 _srv.check_and_create_admin_user = lambda _opt: None
+_srv.check_and_create_indexes = lambda _opt: None
+_srv.migrate_password_less_users = lambda _opt: None
 _srv.check_kubernetes_connection = lambda _opt: None
 _srv.get_k8s_client = lambda *_a, **_kw: _K8sStub()
 
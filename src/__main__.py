@@ -10,7 +10,6 @@ import click
 from loguru import logger
 from sanic import Sanic
 
-from src.apiserver.server import apiserver_prepare_run, apiserver_check_option
 from src.components.config import APIServerConfig, CONFIG_DEFAULT_CONFIG_PATH
 from src.components.logging import create_logger
 from src.components.utils import DelayedKeyboardInterrupt
@@ -82,6 +81,7 @@ if __name__ == '__main__':
             logger.info(f"running option: {opt.to_dict()}")
 
             # prepare and run the server
+            from src.apiserver.server import apiserver_prepare_run, apiserver_check_option
             app = apiserver_prepare_run(apiserver_check_option(opt))
             app.config.update_config(opt.to_sanic_config())
 
@@ -98,4 +98,55 @@ if __name__ == '__main__':
             sys.exit(1)
 
 
+    @cli.command(context_settings=dict(ignore_unknown_options=True, allow_extra_args=True))
+    @click.pass_context
+    def authd(ctx):
+        """
+        Run the standalone token validation server for the workspace ingress
+        """
+        global opt
+        with DelayedKeyboardInterrupt():
+            v, err = APIServerConfig.load_config(argv=sys.argv[2:])
+            opt = APIServerConfig().from_vyper(v)
+
+            # attention: imported here, the apiserver and its dependencies are not loaded by authd
+            from src.authd import authd_prepare_run, authd_check_option
+            app = authd_prepare_run(authd_check_option(opt))
+
+        try:
+            app.run(host=opt.authd_host,
+                    port=opt.authd_port,
+                    access_log=opt.api_access_log,
+                    workers=opt.authd_num_workers,
+                    auto_reload=False,
+                    debug=opt.debug)
+        except KeyboardInterrupt as _:
+            logger.info("KeyboardInterrupt, terminating workers")
+            sys.exit(1)
+
+
+    @cli.command(context_settings=dict(ignore_unknown_options=True, allow_extra_args=True))
+    @click.argument("kind", type=click.Choice(["users", "pods"]))
+    @click.option("--output", "-o", default="-", help="output file, - for stdout")
+    @click.option("--filter", "extra_query_filter", default="", help="mongodb query filter in json format")
+    @click.pass_context
+    def export(ctx, kind, output, extra_query_filter):
+        """
+        Export users or pods as newline-delimited JSON, the way GET /v1/admin/<kind>?stream=1 streams them
+        """
+        global opt
+        import asyncio
+        v, err = APIServerConfig.load_config(argv=ctx.args)
+        opt = APIServerConfig().from_vyper(v)
+
+        import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before the tasks
+        from src.components.tasks import export_ndjson
+        with click.open_file(output, "wb") as out:
+            n, err = asyncio.run(export_ndjson(opt, kind, extra_query_filter, out))
+        if err is not None:
+            logger.error(f"export failed after {n} {kind}: {err}")
+            sys.exit(1)
+        logger.info(f"exported {n} {kind}")
+
+
     cli()
@@ -0,0 +1,118 @@
+"""
+This module implements the admin debug controller.
+"""
+
+import http
+
+from loguru import logger
+from sanic import Blueprint
+from sanic_ext import openapi
+from sanic_jwt import protected
+
+import src.components.authz as authn
+import src.components.errors as errors
+from src.components import config, profiler, stalls
+from .response import model_response
+from .types import *
+
+bp = Blueprint("admin_debug", url_prefix="/admin/debug", version=1)
+
+
+@bp.get("/stalls", name="admin_debug_stalls")
+@openapi.definition(
+    response=[
+        openapi.definitions.Response(
+            {'application/json': StallsResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
+            status=200)
+    ],
+    secured={"token": []}
+)
+@protected()
+@authn.validate_role(role=("admin", "super_admin"))
+async def list_stalls(request):
+    """
+    List the stalls of the event loops of all workers, by the location of the code that blocked the loop.
+    Stalls are only watched for if api.stallThresholdMS is set.
+    """
+    logger.debug(f"{request.method} {request.path} invoked")
+
+    return model_response(
+        StallsResponse(
+            status=http.HTTPStatus.OK,
+            message="success",
+            threshold_ms=request.app.ctx.opt.api_stall_threshold_ms,
+            stalls=stalls.read_stalls()
+        ),
+        status=http.HTTPStatus.OK
+    )
+
+
+@bp.post("/profile", name="admin_debug_profile")
+@openapi.definition(
+    response=[
+        openapi.definitions.Response(
+            {'application/json': ProfileResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
+            status=200)
+    ],
+    parameter=[
+        openapi.definitions.Parameter("seconds", int, location="query", required=False),
+        openapi.definitions.Parameter("mode", str, location="query", required=False),
+        openapi.definitions.Parameter("top", int, location="query", required=False),
+        openapi.definitions.Parameter("all", int, location="query", required=False)
+    ],
+    secured={"token": []}
+)
+@protected()
+@authn.validate_role(role=("admin", "super_admin"))
+async def profile(request):
+    """
+    Profile the worker serving the request, or all workers with all=1, for seconds, and return the result.
+
+    mode=cpu samples the stack of the event loop and returns the collapsed stacks, for flame graph tools.
+    mode=alloc compares tracemalloc snapshots and returns the top lines that allocated memory.
+    """
+    logger.debug(f"{request.method} {request.path} invoked")
+
+    # parse query args
+    try:
+        req = ProfileRequest(**{k: v for (k, v) in request.query_args})
+    except Exception as e:
+        return model_response(
+            ProfileResponse(
+                status=http.HTTPStatus.BAD_REQUEST,
+                message=str(e)
+            ),
+            status=http.HTTPStatus.BAD_REQUEST
+        )
+
+    # the other workers poll for the request and profile the same window, unless this worker is busy
+    profile_id = None
+    if req.all and not profiler.is_running():
+        profile_id = profiler.request_profile(req.mode, req.seconds, req.top)
+    result, err = await profiler.run_profile(req.mode, req.seconds, req.top)
+    results = [] if result is None else [result]
+    if profile_id is not None:
+        results += await profiler.collect_results(profile_id, request.app.ctx.opt.api_num_workers - 1,
+                                                  config.CONFIG_PROFILE_BROADCAST_GRACE_S)
+
+    # return response
+    if err is not None:
+        status_code = errors.http_status_for(err)
+        return model_response(
+            ProfileResponse(
+                status=status_code,
+                message=str(err)
+            ),
+            status=status_code
+        )
+    else:
+        return model_response(
+            ProfileResponse(
+                status=http.HTTPStatus.OK,
+                message="success",
+                mode=req.mode,
+                seconds=req.seconds,
+                **profiler.merge_results(results, req.top)
+            ),
+            status=http.HTTPStatus.OK
+        )
@@ -6,14 +6,17 @@ import http
 
 from loguru import logger
 from sanic import Blueprint
-from sanic.response import json as json_response
 from sanic_ext import openapi
 from sanic_jwt import protected
 
 import src.components.authz as authn
+import src.components.datamodels as datamodels
 import src.components.errors as errors
+from src.components.events import PodStatusEvent
 from src.apiserver.service import get_root_service
+from .response import list_etag, model_response, not_modified, resource_etag, stream_ndjson, wants_ndjson
 from .types import *
+from .watch import stream_pod_status
 
 bp = Blueprint("admin_pod", url_prefix="/admin/pods", version=1)
 
@@ -22,13 +25,21 @@ bp = Blueprint("admin_pod", url_prefix="/admin/pods", version=1)
 @openapi.definition(
     response=[
         openapi.definitions.Response(
-            {'application/json': PodListResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            {
+                'application/json': PodListResponse.model_json_schema(ref_template="#/components/schemas/{model}"),
+                'application/x-ndjson': datamodels.PodModel.model_json_schema(
+                    ref_template="#/components/schemas/{model}"
+                )
+            },
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     parameter=[
         openapi.definitions.Parameter("index_start", int, location="query", required=False),
         openapi.definitions.Parameter("index_end", int, location="query", required=False),
-        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False)
+        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False),
+        openapi.definitions.Parameter("stream", int, location="query", required=False),
+        openapi.definitions.Parameter("If-None-Match", str, location="header", required=False)
     ],
     secured={"token": []}
 )
@@ -36,7 +47,7 @@ bp = Blueprint("admin_pod", url_prefix="/admin/pods", version=1)
 @authn.validate_role(role=("admin", "super_admin"))
 async def list(request):
     """
-    List all pods.
+    List all pods. With the Accept header application/x-ndjson or ?stream=1, pods are streamed one per line.
     """
     logger.debug(f"{request.method} {request.path} invoked")
 
@@ -46,26 +57,118 @@ async def list(request):
     else:
         req = PodListRequest(**{k: v for (k, v) in request.query_args})
 
+    # stream newline-delimited JSON straight from the cursor, if asked to
+    if wants_ndjson(request):
+        pods, err = get_root_service().pod_service.iterate(request.app, req)
+        if err is None:
+            err = await stream_ndjson(request, pods)
+        if err is not None:
+            status_code = errors.http_status_for(err)
+            return model_response(
+                PodListResponse(
+                    status=status_code,
+                    message=str(err)
+                ),
+                status=status_code
+            )
+        return None
+
+    # answer conditional requests from the resource versions, before reading the pods
+    version, digest, count, total, err = await get_root_service().pod_service.list_version(request.app, req)
+    etag = list_etag(version, digest, count, total, req) if err is None else None
+    res = not_modified(request, etag)
+    if res is not None:
+        return res
+
     # list pods
     count, pods, err = await get_root_service().pod_service.list(request.app, req)
 
     # return response
     if err is not None:
-        return json_response(
+        status_code = errors.http_status_for(err)
+        return model_response(
             PodListResponse(
-                status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                status=status_code,
                 message=str(err)
-            ).model_dump(),
-            status=http.HTTPStatus.INTERNAL_SERVER_ERROR
+            ),
+            status=status_code
         )
     else:
-        return json_response(
+        return model_response(
             PodListResponse(
                 status=http.HTTPStatus.OK,
                 message="success",
                 total_pods=count,
                 pods=pods
-            ).model_dump(),
+            ),
+            status=http.HTTPStatus.OK,
+            etag=etag
+        )
+
+
+@bp.get("/watch", name="admin_pod_watch")
+@openapi.definition(
+    response=[
+        openapi.definitions.Response(
+            {'text/event-stream': PodStatusEvent.model_json_schema(ref_template="#/components/schemas/{model}")},
+            status=200)
+    ],
+    parameter=[
+        openapi.definitions.Parameter("since", int, location="query", required=False),
+        openapi.definitions.Parameter("Last-Event-ID", int, location="header", required=False)
+    ],
+    secured={"token": []}
+)
+@protected()
+@authn.validate_role(role=("admin", "super_admin"))
+async def watch(request):
+    """
+    Watch the status of all pods, as server-sent events.
+
+    Each event carries the pod's resource_version as its id. With since, or the Last-Event-ID header of a
+    reconnecting client, the transitions after that version are sent first, since=0 sends the status of every pod.
+    """
+    logger.debug(f"{request.method} {request.path} invoked")
+
+    return await stream_pod_status(request, None)
+
+
+@bp.get("/timings", name="admin_pod_timings")
+@openapi.definition(
+    response=[
+        openapi.definitions.Response(
+            {'application/json': PodTimingsResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
+            status=200)
+    ],
+    secured={"token": []}
+)
+@protected()
+@authn.validate_role(role=("admin", "super_admin"))
+async def timings(request):
+    """
+    Get the p50 and p95 of the phases of pod starts, by template, from the last start of each pod that did not fail.
+    """
+    logger.debug(f"{request.method} {request.path} invoked")
+
+    templates, err = await get_root_service().pod_service.summarize_timings(request.app)
+
+    # return response
+    if err is not None:
+        status_code = errors.http_status_for(err)
+        return model_response(
+            PodTimingsResponse(
+                status=status_code,
+                message=str(err)
+            ),
+            status=status_code
+        )
+    else:
+        return model_response(
+            PodTimingsResponse(
+                status=http.HTTPStatus.OK,
+                message="success",
+                templates=templates
+            ),
             status=http.HTTPStatus.OK
         )
 
@@ -90,11 +193,11 @@ async def create(request):
 
     # parse request body
     if request.json is None:
-        return json_response(
+        return model_response(
             PodCreateResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -103,11 +206,11 @@ async def create(request):
             req = PodCreateRequest(**request.json)
             req.username = request.ctx.user['username'] if req.username is None else req.username
         except Exception as e:
-            return json_response(
+            return model_response(
                 PodCreateResponse(
                     status=http.HTTPStatus.BAD_REQUEST,
                     message=str(e)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.BAD_REQUEST
             )
 
@@ -116,21 +219,21 @@ async def create(request):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 PodCreateResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
 
         else:
-            return json_response(
+            return model_response(
                 PodCreateResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=pod
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
 
@@ -140,7 +243,8 @@ async def create(request):
     response=[
         openapi.definitions.Response(
             {'application/json': PodGetResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     secured={"token": []}
 )
@@ -154,35 +258,43 @@ async def get(request, pod_id: str):
 
     # check pod_id param in url
     if pod_id is None or pod_id == "":
-        return json_response(
+        return model_response(
             PodGetResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
-        # get pod
+        # answer conditional requests from the resource version, before reading the pod
         req = PodGetRequest(pod_id=pod_id)
+        version, err = await get_root_service().pod_service.get_version(request.app, req)
+        if err is None:
+            res = not_modified(request, resource_etag(version.get('resource_version', 0)))
+            if res is not None:
+                return res
+
+        # get pod
         pod, err = await get_root_service().pod_service.get(request.app, req)
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=pod
-                ).model_dump(),
-                status=http.HTTPStatus.OK
+                ),
+                status=http.HTTPStatus.OK,
+                etag=resource_etag(pod.resource_version)
             )
 
 
@@ -206,11 +318,11 @@ async def update(request, pod_id: str):
 
     # check pod_id param in url
     if pod_id is None or pod_id == "":
-        return json_response(
+        return model_response(
             PodUpdateResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -225,20 +337,20 @@ async def update(request, pod_id: str):
         # return response
         if err is not None:
             status_code = errors.http_status_for(err)
-            return json_response(
+            return model_response(
                 PodUpdateResponse(
                     status=status_code,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=status_code
             )
         else:
-            return json_response(
+            return model_response(
                 PodUpdateResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=pod
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
 
@@ -262,11 +374,11 @@ async def delete(request, pod_id: str):
 
     # check pod_id param in url
     if pod_id is None or pod_id == "":
-        return json_response(
+        return model_response(
             PodDeleteResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -276,19 +388,19 @@ async def delete(request, pod_id: str):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 PodDeleteResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 PodDeleteResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=deleted_pod
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
@@ -6,13 +6,13 @@ import http
 
 from loguru import logger
 from sanic import Blueprint
-from sanic.response import json as json_response
 from sanic_ext import openapi
 from sanic_jwt import protected
 
 import src.components.authz as authn
 from src.apiserver.service import get_root_service
 from src.components import errors
+from .response import list_etag, model_response, not_modified, resource_etag, stream_ndjson, wants_ndjson
 from .types import *
 
 bp = Blueprint('admin_user', url_prefix="/admin/users", version=1)
@@ -22,13 +22,21 @@ bp = Blueprint('admin_user', url_prefix="/admin/users", version=1)
 @openapi.definition(
     response=[
         openapi.definitions.Response(
-            {'application/json': UserListResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            {
+                'application/json': UserListResponse.model_json_schema(ref_template="#/components/schemas/{model}"),
+                'application/x-ndjson': datamodels.UserModel.model_json_schema(
+                    ref_template="#/components/schemas/{model}"
+                )
+            },
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     parameter=[
         openapi.definitions.Parameter("index_start", int, location="query", required=False),
         openapi.definitions.Parameter("index_end", int, location="query", required=False),
-        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False)
+        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False),
+        openapi.definitions.Parameter("stream", int, location="query", required=False),
+        openapi.definitions.Parameter("If-None-Match", str, location="header", required=False)
     ],
     secured={"token": []}
 )
@@ -36,7 +44,7 @@ bp = Blueprint('admin_user', url_prefix="/admin/users", version=1)
 @authn.validate_role(role=("admin", "super_admin"))
 async def list(request):
     """
-    List all users.
+    List all users. With the Accept header application/x-ndjson or ?stream=1, users are streamed one per line.
     """
     logger.debug(f"{request.method} {request.path} invoked")
 
@@ -46,27 +54,52 @@ async def list(request):
     else:
         req = UserListRequest(**{k: v for (k, v) in request.query_args})
 
+    # stream newline-delimited JSON straight from the cursor, if asked to
+    if wants_ndjson(request):
+        users, err = get_root_service().user_service.iterate(request.app, req)
+        if err is None:
+            err = await stream_ndjson(request, users)
+        if err is not None:
+            status_code = errors.http_status_for(err)
+            return model_response(
+                UserListResponse(
+                    status=status_code,
+                    message=str(err)
+                ),
+                status=status_code
+            )
+        return None
+
+    # answer conditional requests from the resource versions, before reading the users
+    version, digest, count, total, err = await get_root_service().user_service.list_version(request.app, req)
+    etag = list_etag(version, digest, count, total, req) if err is None else None
+    res = not_modified(request, etag)
+    if res is not None:
+        return res
+
     # list users
     count, users, err = await get_root_service().user_service.list(request.app, req)
 
     # return response
     if err is not None:
-        return json_response(
+        status_code = errors.http_status_for(err)
+        return model_response(
             UserListResponse(
-                status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                status=status_code,
                 message=str(err)
-            ).model_dump(),
-            status=http.HTTPStatus.INTERNAL_SERVER_ERROR
+            ),
+            status=status_code
         )
     else:
-        return json_response(
+        return model_response(
             UserListResponse(
                 status=http.HTTPStatus.OK,
                 message="success",
                 total_users=count,
                 users=users
-            ).model_dump(),
-            status=http.HTTPStatus.OK
+            ),
+            status=http.HTTPStatus.OK,
+            etag=etag
         )
 
 
@@ -90,11 +123,11 @@ async def create(request):
 
     # parse request body
     if request.json is None:
-        return json_response(
+        return model_response(
             UserCreateResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -102,11 +135,11 @@ async def create(request):
         try:
             req = UserCreateRequest(**request.json)
         except Exception as e:
-            return json_response(
+            return model_response(
                 UserCreateResponse(
                     status=http.HTTPStatus.BAD_REQUEST,
                     message=str(e)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.BAD_REQUEST
             )
 
@@ -115,25 +148,79 @@ async def create(request):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 UserCreateResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
 
         else:
-            return json_response(
+            return model_response(
                 UserCreateResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     user=user
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
 
 
+@bp.post("/batch", name="admin_user_batch_create")
+@openapi.definition(
+    body={'application/json': UserBatchCreateRequest.model_json_schema(ref_template="#/components/schemas/{model}")},
+    response=[
+        openapi.definitions.Response(
+            {'application/json': UserBatchCreateResponse.model_json_schema(
+                ref_template="#/components/schemas/{model}")},
+            status=200)
+    ],
+    secured={"token": []}
+)
+@protected()
+@authn.validate_role(role=("admin", "super_admin"))
+async def batch_create(request):
+    """
+    Create many users, e.g. a class of students.
+    """
+    logger.debug(f"{request.method} {request.path} invoked")
+
+    # parse request body
+    if request.json is None:
+        return model_response(
+            UserBatchCreateResponse(
+                status=http.HTTPStatus.BAD_REQUEST,
+                message=str(errors.invalid_request_body)
+            ),
+            status=http.HTTPStatus.BAD_REQUEST
+        )
+
+    # validate request body
+    try:
+        req = UserBatchCreateRequest(**request.json)
+    except Exception as e:
+        return model_response(
+            UserBatchCreateResponse(
+                status=http.HTTPStatus.BAD_REQUEST,
+                message=str(e)
+            ),
+            status=http.HTTPStatus.BAD_REQUEST
+        )
+
+    # create users, the ones that failed are reported by username
+    users, failed = await get_root_service().user_service.create_many(request.app, req)
+    return model_response(
+        UserBatchCreateResponse(
+            status=http.HTTPStatus.OK,
+            message="success" if len(failed) == 0 else "partial failure",
+            users=users,
+            failed={username: str(err) for username, err in failed.items()}
+        ),
+        status=http.HTTPStatus.OK
+    )
+
+
 @bp.get("/<username:str>", name="admin_user_get")
 @openapi.response(
     200,
@@ -143,7 +230,8 @@ async def create(request):
     response=[
         openapi.definitions.Response(
             {'application/json': UserGetResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     secured={"token": []}
 )
@@ -157,35 +245,43 @@ async def get(request, username: str):
 
     # check username param in url
     if username is None or username == "":
-        return json_response(
+        return model_response(
             UserGetResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
-        # get user
+        # answer conditional requests from the resource version, before reading the user
         req = UserGetRequest(username=username)
+        version, err = await get_root_service().user_service.get_version(request.app, req)
+        if err is None:
+            res = not_modified(request, resource_etag(version.get('resource_version', 0)))
+            if res is not None:
+                return res
+
+        # get user
         user, err = await get_root_service().user_service.get(request.app, req)
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 UserGetResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 UserGetResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     user=user
-                ).model_dump(),
-                status=http.HTTPStatus.OK
+                ),
+                status=http.HTTPStatus.OK,
+                etag=resource_etag(user.resource_version)
             )
 
 
@@ -209,11 +305,11 @@ async def update(request, username: str):
 
     # check username param in url
     if username is None or username == "":
-        return json_response(
+        return model_response(
             UserUpdateResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -227,20 +323,20 @@ async def update(request, username: str):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 UserUpdateResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 UserUpdateResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     user=user
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
 
@@ -264,21 +360,21 @@ async def delete(request, username: str):
 
     # check username param in url
     if username is None or username == "":
-        return json_response(
+        return model_response(
             UserDeleteResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
         # check if username is the same as the current user, if so, return error
         if username == request.ctx.user['username']:
-            return json_response(
+            return model_response(
                 UserDeleteResponse(
                     status=http.HTTPStatus.BAD_REQUEST,
                     message=str(errors.user_not_allowed)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.BAD_REQUEST
             )
 
@@ -288,19 +384,19 @@ async def delete(request, username: str):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 UserDeleteResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 UserDeleteResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     user=deleted_user
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
@@ -1,22 +1,35 @@
-import datetime
 import http
-from urllib.parse import urlparse, parse_qs
 
-import jwt
-from loguru import logger
 from sanic import Blueprint
 from sanic.response import json as json_response
 from sanic_ext import openapi
 
+from src.apiserver.controller.response import model_response
 from src.apiserver.controller.types import ResponseBaseModel
 from src.apiserver.service import get_root_service
 from src.apiserver.service.auth import LoginCredential, TokenResponse
 from src.components import config
-from src.components.datamodels import UserRoleEnum
-from src.components.utils import parse_bearer
+from src.components.utils import parse_bearer, parse_pod_id
+from src.components.validator import (
+    get_unauthorized_token_response,
+    handle_token_validate
+)
 
 bp = Blueprint("auth", url_prefix="/auth", version=1)
 
+
+def record_pod_activity(request, username, _payload):
+    """
+    The validated request reaches a workspace, record the pod's activity. Only a pod of username is touched: the
+    url of the workspace is a header the client can set.
+    """
+    pod_id, err = parse_pod_id(
+        request.headers.get(config.CONFIG_PROXY_ORIGIN_URL_HEADER),
+        request.app.ctx.opt.config_workspace_hostname
+    )
+    if err is None:
+        get_root_service().heartbeat_service.touch_pod(username, pod_id)
+
 _unauthorized_basic_response = json_response(
     body=ResponseBaseModel(
         description='',
@@ -42,47 +55,6 @@ _authorized_basic_response = json_response(
 )
 
 
-def get_authorized_token_response(token: str):
-    """
-    This function returns an authorized response for token/validation endpoint
-    It also sets a cookie config.CONFIG_AUTH_COOKIES_NAME=token
-    """
-    r = json_response(
-        body=ResponseBaseModel(
-            description='',
-            message='AUTHORIZED',
-            status=http.HTTPStatus.OK
-        ).model_dump(),
-        headers={
-            'WWW-Authenticate': "Bearer"
-        },
-        status=http.HTTPStatus.OK
-    )
-    r.add_cookie(
-        config.CONFIG_AUTH_COOKIES_NAME,
-        token,
-        max_age=config.CONFIG_DEVICE_TOKEN_EXPIRE_S
-    )
-    return r
-
-
-def get_unauthorized_token_response():
-    """
-    This function returns an unauthorized response for token/validation endpoint
-    It also deletes a the cookie config.CONFIG_AUTH_COOKIES_NAME
-    """
-    r = json_response(
-        body=ResponseBaseModel(
-            description='',
-            message='UNAUTHORIZED',
-            status=http.HTTPStatus.UNAUTHORIZED
-        ).model_dump(),
-        status=http.HTTPStatus.UNAUTHORIZED
-    )
-    r.delete_cookie(config.CONFIG_AUTH_COOKIES_NAME)
-    return r
-
-
 _bad_request_response = json_response(
     body=ResponseBaseModel(
         description='',
@@ -179,13 +151,13 @@ async def token_login(request):
     if err is not None:
         return _unauthorized_basic_response
     else:
-        return json_response(
-            body=TokenResponse(
+        return model_response(
+            TokenResponse(
                 description='',
                 message='OK',
                 status=http.HTTPStatus.OK,
                 token=access_token
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.OK
         )
 
@@ -222,13 +194,13 @@ async def token_refresh(request):
     if err is not None:
         return _unauthorized_basic_response
     else:
-        return json_response(
-            body=TokenResponse(
+        return model_response(
+            TokenResponse(
                 description='',
                 message='OK',
                 status=http.HTTPStatus.OK,
                 token=access_token
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.OK
         )
 
@@ -248,73 +220,14 @@ async def token_refresh(request):
 async def token_validate(request, username: str):
     """
     This function validates the token in:
+    - cookie.clpl_auth_token
     - header.Authorization
     - urlParam.clpl_auth_token
 
     If the validation succeed, return 200 OK and set cookie clpl_auth_token=${JWT}
     """
-    # try to get from cookies
-    cookies_token = request.cookies.get(config.CONFIG_AUTH_COOKIES_NAME, None)
-    if cookies_token is None:
-        # cookie does not exists, fallback to header
-        token, err = parse_bearer(request.headers.get('Authorization'))
-        if err is not None:
-            # header does not exists, fallback to query
-            logger.debug(f"validation_err: {str(err)}, fallback to query")
-
-            # attention: the proxy must pass the x-original-url header that contains original url
-            origin_url = request.headers.get(config.CONFIG_PROXY_ORIGIN_URL_HEADER)
-            if origin_url is None:
-                logger.debug(f"validation_err: misconfigured proxy, no {config.CONFIG_PROXY_ORIGIN_URL_HEADER}")
-                return get_unauthorized_token_response()
-            else:
-                result = parse_qs(urlparse(origin_url).query)
-                token = result.get(config.CONFIG_AUTH_COOKIES_NAME, [None])[0]
-                if token is None:
-                    logger.debug(f"validation_err: {config.CONFIG_AUTH_COOKIES_NAME} not found in query")
-                    return get_unauthorized_token_response()
-    else:
-        # succeed
-        token = cookies_token
-
-    # decode the jwt and check the signature
-    try:
-        payload = jwt.decode(
-            token,
-            request.app.config.get('JWT_SECRET'),
-            algorithms=request.app.config.get('JWT_ALGORITHM')
-        )
-    except Exception as e:
-        logger.debug(f"validation_err: {str(e)}")
-        return get_unauthorized_token_response()
-
-    # if user not match, return 401
-    if payload['username'] != username:
-        logger.debug(f"validation_err: expected user to be {username} but got {payload['username']}")
-        return get_unauthorized_token_response()
-    else:
-        # replace the token with device token
-        now = datetime.datetime.utcnow().timestamp()
-
-        # rotate token if:
-        # case 1: the token will expire in less than 6 days
-        # case 2: the token is not device token
-        if (
-                (payload['exp'] < (now + config.CONFIG_DEVICE_TOKEN_RENEW_THRESHOLD_S)) or
-                (payload['role'] != UserRoleEnum.device.value)
-        ):
-            logger.debug(f"validation_warning: token will expire in less "
-                         f"than {config.CONFIG_DEVICE_TOKEN_RENEW_THRESHOLD_S} seconds, rotate token")
-            payload['role'] = UserRoleEnum.device.value
-            token, err = await get_root_service().auth_service.jwt_token_rotate(
-                payload,
-                request.app.config.get('JWT_SECRET'),
-                datetime.timedelta(seconds=config.CONFIG_DEVICE_TOKEN_EXPIRE_S)
-            )
-            if err is not None:
-                logger.debug(f"validation_err: {str(err)}")
-                return get_unauthorized_token_response()
-
-        # return authorized response
-        logger.debug(f"validation_success")
-        return get_authorized_token_response(token=token)
+    return await handle_token_validate(request,
+                                       username,
+                                       request.app.ctx.token_validator,
+                                       record_pod_activity,
+                                       request.app.config.get('CONFIG_AUTH_CACHE_DURATION_S', 0))
@@ -1,6 +1,7 @@
 import http
-import json
-from typing import Tuple, Optional, List
+import importlib.util
+import time
+from typing import Dict, Tuple, Optional, List
 
 import httpx
 import jwt
@@ -14,13 +15,22 @@ from sanic.response import redirect as redirect_response
 from sanic_ext import openapi
 
 from src.apiserver.service import get_root_service, UserService
-from src.components import errors
+from src.components import config, errors, metrics
 from src.components.config import APIServerConfig
-from src.components.datamodels import UserRoleEnum, UserStatusEnum, QuotaModel
+from src.components.cache import SingleFlight
+from src.components.datamodels import UserModel, UserRoleEnum, UserStatusEnum, QuotaModel
+from src.components.jwks import JWKSCache
 from src.components.utils import UserFilter, random_password
 
 bp = Blueprint("auth_oidc", url_prefix="/auth/oidc", version=1)
 
+# HTTP/2 needs the optional h2 package (httpx[http2])
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# first logins in flight, by username
+_provisioning = SingleFlight()
+
+from .response import model_response
 from .types import OIDCStatusResponse, ResponseBaseModel
 
 
@@ -125,6 +135,8 @@ class OAuth2Config(BaseModel):
         if self.frontend_login_url is None or self.frontend_login_url == "":
             self.frontend_login_url = f"{self.base_url}/login"
 
+        return self
+
     @property
     def authorization_redirect_url(self):
         """
@@ -178,19 +190,75 @@ class OAuth2Config(BaseModel):
         return self._email_expr
 
 
+class EndpointLatency:
+    """
+    Count, total and max latency (until response headers) of the calls to each IdP endpoint
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, List[float]] = {}
+
+    def observe(self, endpoint: str, seconds: float):
+        stats = self._stats.setdefault(endpoint, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def snapshot(self) -> Dict[str, dict]:
+        return {
+            endpoint: {'count': count, 'avg_s': total / count, 'max_s': max_s}
+            for endpoint, (count, total, max_s) in self._stats.items()
+        }
+
+
 class AsyncOauthClient:
     """
-    AsyncOauthClient is a client for OAuth2 that uses httpx to accomplish operations
+    AsyncOauthClient is a client for OAuth2 that uses httpx to accomplish operations.
+
+    It holds a connection pool, create one per worker after the fork. It keeps no per-login state, tokens
+    are passed explicitly, so concurrent logins can share it.
     """
 
     def __init__(self, cfg: OAuth2Config):
         self._cfg = cfg
-        self._client = httpx.AsyncClient()
-        self._oauth_token = None  # cached oauth token
-        self._public_keys = None  # cached public keys
+        self._endpoints = {
+            cfg.token_url: "token",
+            cfg.user_info_url: "userinfo",
+            cfg.jwks_url: "jwks",
+        }
+        self.latency = EndpointLatency()
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=config.CONFIG_OIDC_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=config.CONFIG_OIDC_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                                keepalive_expiry=config.CONFIG_OIDC_HTTP_KEEPALIVE_EXPIRY_S),
+            timeout=httpx.Timeout(config.CONFIG_OIDC_HTTP_TIMEOUT_S,
+                                  connect=config.CONFIG_OIDC_HTTP_CONNECT_TIMEOUT_S),
+            http2=_HTTP2_AVAILABLE,
+            event_hooks={'request': [self._on_request], 'response': [self._on_response]},
+        )
+        self._jwks = JWKSCache(self._client, self._cfg.jwks_url)  # cached public keys
 
         self._user_info_expr = parse(self._cfg.user_info_path)
 
+    async def _on_request(self, request: httpx.Request):
+        request.extensions['clpl_started_at'] = time.perf_counter()
+
+    async def _on_response(self, response: httpx.Response):
+        started_at = response.request.extensions.get('clpl_started_at')
+        if started_at is None:
+            return
+        endpoint = self._endpoints.get(str(response.request.url), "other")
+        elapsed = time.perf_counter() - started_at
+        self.latency.observe(endpoint, elapsed)
+        metrics.OIDC_REQUEST_DURATION.observe(elapsed, endpoint)
+        logger.debug(f"oidc {endpoint} {response.status_code} in {elapsed * 1000:.1f}ms")
+
+    async def aclose(self):
+        """
+        Close the connection pool
+        """
+        await self._client.aclose()
+
     async def fetch_token(self, code: str) -> Tuple[Optional[OAuthToken], Optional[Exception]]:
         """
         Fetch token with authorization code from token endpoint
@@ -199,72 +267,70 @@ class AsyncOauthClient:
             "accept": "application/json"
         }
 
-        # call endpoint
-        res = await self._client.post(
-            self._cfg.token_url,
-            headers=_headers,
-            auth=(self._cfg.client_id, self._cfg.client_secret),
-            data={
-                "grant_type": self._cfg.grant_type,
-                "client_id": self._cfg.client_id,
-                "client_secret": self._cfg.client_secret,
-                "code": code,
-                "redirect_uri": self._cfg.redirect_url
-            }
-        )
+        # call endpoint, timeouts and connection errors are authorization errors as well
+        try:
+            res = await self._client.post(
+                self._cfg.token_url,
+                headers=_headers,
+                auth=(self._cfg.client_id, self._cfg.client_secret),
+                data={
+                    "grant_type": self._cfg.grant_type,
+                    "client_id": self._cfg.client_id,
+                    "client_secret": self._cfg.client_secret,
+                    "code": code,
+                    "redirect_uri": self._cfg.redirect_url
+                }
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"oidc token endpoint: {e}")
+            return None, Exception("Authorization Error")
 
         # parse token
         if res.status_code == http.HTTPStatus.OK:
-            oauth_token = OAuthToken(**res.json())
-            self._oauth_token = oauth_token
-            return oauth_token, None
+            return OAuthToken(**res.json()), None
         else:
             return None, Exception("Authorization Error")
 
-    async def refresh_token(self, oauth_token: OAuthToken = None) -> Tuple[Optional[OAuthToken], Optional[Exception]]:
+    async def refresh_token(self, oauth_token: OAuthToken) -> Tuple[Optional[OAuthToken], Optional[Exception]]:
         """
-        Refresh token with refresh token from token endpoint, use the cached oauth_token if not provided
+        Refresh token with refresh token from token endpoint
         """
-        if oauth_token is None:
-            oauth_token = self._oauth_token
-
         _headers = {
             "accept": "application/json"
         }
 
-        # call endpoint
-        res = await self._client.post(
-            self._cfg.token_url,
-            headers=_headers,
-            auth=(self._cfg.client_id, self._cfg.client_secret),
-            data={
-                "grant_type": "refresh_token",
-                "client_id": self._cfg.client_id,
-                "client_secret": self._cfg.client_secret,
-                "refresh_token": oauth_token.refresh_token,
-                "redirect_uri": self._cfg.redirect_url
-            }
-        )
+        # call endpoint, timeouts and connection errors are authorization errors as well
+        try:
+            res = await self._client.post(
+                self._cfg.token_url,
+                headers=_headers,
+                auth=(self._cfg.client_id, self._cfg.client_secret),
+                data={
+                    "grant_type": "refresh_token",
+                    "client_id": self._cfg.client_id,
+                    "client_secret": self._cfg.client_secret,
+                    "refresh_token": oauth_token.refresh_token,
+                    "redirect_uri": self._cfg.redirect_url
+                }
+            )
+        except httpx.HTTPError as e:
+            logger.error(f"oidc token endpoint: {e}")
+            return None, Exception("Authorization Error")
 
         # parse token
         if res.status_code == http.HTTPStatus.OK:
-            oauth_token = OAuthToken(**res.json())
-            self._oauth_token = oauth_token
-            return oauth_token, None
+            return OAuthToken(**res.json()), None
         else:
             return None, Exception("Authorization Error")
 
-    async def fetch_user(self, oauth_token: OAuthToken = None) -> Tuple[Optional[dict], Optional[Exception]]:
+    async def fetch_user(self, oauth_token: OAuthToken) -> Tuple[Optional[dict], Optional[Exception]]:
         """
-        Fetch user info with access token from user info endpoint, use the cached oauth_token if not provided
+        Fetch user info with access token from user info endpoint
         """
-        if oauth_token is None:
-            oauth_token = self._oauth_token
-
         # Get user info from Authentik using the access token
         _headers = {"Authorization": f"Bearer {oauth_token.access_token}"}
-        res = await self._client.get(self._cfg.user_info_url, headers=_headers)
         try:
+            res = await self._client.get(self._cfg.user_info_url, headers=_headers)
             res.raise_for_status()
         except Exception as e:
             return None, e
@@ -278,30 +344,22 @@ class AsyncOauthClient:
         """
         Fetch public keys from jwks endpoint
         """
-        # call endpoint
-        res = await self._client.get(self._cfg.jwks_url)
+        err = await self._jwks.refresh()
+        if err is not None:
+            return None, err
+        return self._jwks.keys, None
+
+    async def validate_token(self, token: str) -> Tuple[Optional[dict], Optional[Exception]]:
         try:
-            res.raise_for_status()
+            kid = jwt.get_unverified_header(token)['kid']
         except Exception as e:
             return None, e
 
-        # decode jwks response
-        public_keys = {}
-        jwks = res.json()
-        for jwk in jwks['keys']:
-            kid = jwk['kid']
-            public_keys[kid] = jwt.get_algorithm_by_name('RSAAlgorithm').from_jwk(json.dumps(jwk))
-
-        self._public_keys = public_keys
-        return public_keys, None
-
-    async def validate_token(self, token: str) -> Tuple[Optional[dict], Optional[Exception]]:
-        if self._public_keys is None:
-            await self.fetch_public_keys()
+        key, err = await self._jwks.get_key(kid)
+        if err is not None:
+            return None, err
 
         try:
-            kid = jwt.get_unverified_header(token)['kid']
-            key = self._public_keys[kid]
             payload = jwt.decode(token, key=key, algorithms=['RS256'])
         except Exception as e:
             return None, e
@@ -325,7 +383,7 @@ async def oidc_status(request):
             name=request.app.ctx.oauth_cfg.name,
             path=request.app.url_for("root.auth_oidc.login")  # "/v1/auth/oidc/login"
         )
-        return json_response(response.model_dump())
+        return model_response(response)
 
 
 @bp.get("/login", name="login", version=1)
@@ -345,6 +403,36 @@ async def oidc_login(request):
     return redirect_response(c.authorization_redirect_url)
 
 
+async def _provision(username: str,
+                     email: Optional[str],
+                     user_info: dict,
+                     user_allowed: bool) -> Tuple[Optional[UserModel], Optional[Exception]]:
+    """
+    Get the user, create it on its first login
+    """
+    # get a service
+    srv: UserService = get_root_service().user_service
+
+    user, created, err = await srv.repo.get_or_create(username=username,
+                                                      password="",  # empty password prevent user from login
+                                                      email=email,
+                                                      role=UserRoleEnum.user,
+                                                      quota=QuotaModel.default_quota().model_dump(
+                                                          exclude={"version", "committed"}),
+                                                      extra_info=user_info)
+    if err is not None:
+        return None, err
+
+    # if user does not match filter rules, set as inactive
+    if created and not user_allowed:
+        await srv.repo.update(username=username, password=None,
+                              status=UserStatusEnum.inactive, email=None,
+                              role=None, quota=None)
+        return None, errors.user_not_allowed
+
+    return user, None
+
+
 async def create_or_login(cfg: OAuth2Config, user_info: dict) -> Tuple[Optional[str], Optional[Exception]]:
     """
     This function checks if the user exists, if not, create user
@@ -367,35 +455,17 @@ async def create_or_login(cfg: OAuth2Config, user_info: dict) -> Tuple[Optional[
         logger.warning(f"failed to parse email: {e}")
         email = None
 
-    # get a service
-    srv: UserService = get_root_service().user_service
-
-    # find user
-    user, err = await srv.repo.get(username)
+    # concurrent first logins of the same user provision it once, the others wait for the result
+    user, err = await _provisioning.do(username, lambda: _provision(username, email, user_info, user_allowed))
     if err is not None:
-        # create the user if not exists
-        user, err = await srv.repo.create(username=username,
-                                          password="",  # empty password prevent user from login
-                                          email=email,
-                                          role=UserRoleEnum.user,
-                                          quota=QuotaModel.default_quota().model_dump(
-                                              exclude={"version", "committed"}),
-                                          extra_info=user_info)
-        if err is not None:
-            return None, err
-        # if user does not match filter rules, set as inactive
-        if not user_allowed:
-            await srv.repo.update(username=username, password=None,
-                                  status=UserStatusEnum.inactive, email=None,
-                                  role=None, quota=None)
-            return None, errors.user_not_allowed
-    else:
-        # super_admin is not allowed to log in
-        if user.role in ['super_admin']:
-            return None, errors.user_not_allowed
-        # existing user not matching filter is not allowed to log in
-        if not user_allowed:
-            return None, errors.user_not_allowed
+        return None, err
+
+    # super_admin is not allowed to log in
+    if user.role in ['super_admin']:
+        return None, errors.user_not_allowed
+    # user not matching filter is not allowed to log in
+    if not user_allowed:
+        return None, errors.user_not_allowed
 
     # generate jwt token
     access_token, err = await get_root_service().auth_service.generate_jwt_token(user)
@@ -432,11 +502,11 @@ async def oidc_authorize(request):
     # oauth_token, err = await c.refresh_token(oauth_token)
     if err is not None:
         if opt.debug:
-            return json_response(
+            return model_response(
                 ResponseBaseModel(
                     status=http.HTTPStatus.BAD_REQUEST,
                     message=str(err),
-                ).model_dump(), status=http.HTTPStatus.BAD_REQUEST
+                ), status=http.HTTPStatus.BAD_REQUEST
             )
         else:
             return redirect_response(
@@ -451,11 +521,11 @@ async def oidc_authorize(request):
     # fetch user info with access token
     user_info, err = await c.fetch_user(oauth_token)
     if err is not None:
-        return json_response(
+        return model_response(
             ResponseBaseModel(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(err),
-            ).model_dump(), status=http.HTTPStatus.BAD_REQUEST
+            ), status=http.HTTPStatus.BAD_REQUEST
         )
 
     # try to decode id_token
@@ -466,12 +536,12 @@ async def oidc_authorize(request):
 
     if err is not None:
         if opt.debug:
-            return json_response(
+            return model_response(
                 ResponseBaseModel(
                     status=http.HTTPStatus.BAD_REQUEST,
                     message=str(err),
                     description="Authorization Error"
-                ).model_dump(), status=http.HTTPStatus.BAD_REQUEST
+                ), status=http.HTTPStatus.BAD_REQUEST
             )
         else:
             return redirect_response(
@@ -1,16 +1,32 @@
 """
 This module defines the controller of the apiserver.
 """
+import asyncio
+import collections
 import http
 import sys
+import time
 
 from loguru import logger
 from sanic import Sanic
-from sanic.response import json as json_response
+from sanic.response import json as json_response, raw
 
-from src.components import config
+from src.apiserver.service import get_root_service
+from src.components import config, metrics, profiler, stalls
 from src.components.config import APIServerConfig
-from src.components.tasks import set_crash_flag, get_crash_flag, recover_from_crash, scan_pods
+from src.components.query_guard import attributed, check_repeated_commands, command_counts, query_route
+from src.components.tasks import (
+    set_crash_flag,
+    get_crash_flag,
+    recover_from_crash,
+    scan_pods,
+    audit_usage,
+    flush_heartbeats,
+    poll_revocations,
+    poll_pod_status,
+    poll_profile_requests,
+    collect_metrics
+)
 from .types import OIDCStatusResponse
 
 app = Sanic("root")
@@ -51,6 +67,41 @@ async def health(request):
     return _health(request.app.ctx.opt)
 
 
+@app.get("/metrics", name="metrics")
+async def prometheus_metrics(request):
+    """
+    Metrics of all workers, in the Prometheus text format.
+    """
+    metrics.write_snapshot()  # the metrics of this worker are current, the others are at most a flush behind
+    return raw(metrics.render(metrics.read_snapshots()).encode(), content_type=metrics.PROMETHEUS_CONTENT_TYPE)
+
+
+@app.on_request
+async def set_query_route(request):
+    """
+    Tag the queries run for the request with its route, for the slow and rejected query logs, and count them.
+    """
+    request.ctx.started_at = time.perf_counter()
+    request.ctx.command_counts = collections.Counter()
+    query_route.set(request.name or request.path)
+    command_counts.set(request.ctx.command_counts)
+
+
+@app.on_response
+async def observe_request(request, response):
+    """
+    Observe the duration of the request, until its response (or the headers of a streamed one) is sent, and check
+    the database commands it ran for repeated ones.
+    """
+    if getattr(request.ctx, 'command_counts', None) is not None:
+        check_repeated_commands(request.ctx.command_counts)
+    started_at = getattr(request.ctx, 'started_at', None)
+    if started_at is not None and response is not None:
+        # attention: unmatched paths are not labelled with the path, scanners would create a series per path
+        metrics.HTTP_REQUEST_DURATION.observe(time.perf_counter() - started_at,
+                                              request.name or "unmatched", request.method, str(response.status))
+
+
 @app.main_process_start
 async def main_process_start(application: Sanic):
     """
@@ -58,6 +109,11 @@ async def main_process_start(application: Sanic):
     """
     logger.info(f"sanic application: {application} starting")
 
+    # the metrics, stalls and profiles files of the workers of the last run
+    metrics.reset_directory()
+    metrics.reset_directory(stalls.STALLS_DIR)
+    metrics.reset_directory(profiler.PROFILES_DIR)
+
 
 @app.main_process_stop
 async def main_process_stop(application: Sanic):
@@ -94,7 +150,8 @@ async def after_server_start(application: Sanic):
 
         # recover from crash
         if crashed:
-            ret, err = await recover_from_crash(application)
+            with attributed("task:recover_from_crash"):
+                ret, err = await recover_from_crash(application)
             if not ret:
                 logger.error(err)
                 sys.exit(1)
@@ -104,14 +161,53 @@ async def after_server_start(application: Sanic):
         # set crash flag to True, assume will crash
         _ = await set_crash_flag(application.ctx.opt, True)
 
-    # only start scan_pods task in rank 0 process
+    # only start scan_pods and audit_usage tasks in rank 0 process
+    # attention: add_task returns the task itself, awaiting it would block until the loop exits
     if application.m.name == "Sanic-Server-0-0":
-        await application.add_task(scan_pods(application), name="scan_pods")
+        application.add_task(scan_pods(application), name="scan_pods")
+        application.add_task(audit_usage(application), name="audit_usage")
+
+    # every process buffers the heartbeats of its own connections, and keeps its own revocation table
+    application.add_task(flush_heartbeats(application), name="flush_heartbeats")
+    application.add_task(poll_revocations(application), name="poll_revocations")
+
+    # every process feeds the pod watches of its own connections
+    application.add_task(poll_pod_status(application), name="poll_pod_status")
+
+    # every process writes its own metrics
+    metrics.ASYNCIO_TASKS.function = lambda: len(asyncio.all_tasks())
+    metrics.WATCH_SUBSCRIBERS.function = lambda: len(get_root_service().pod_service.watch)
+    metrics.HEARTBEAT_CONNECTIONS.function = lambda: len(application.ctx.heartbeat_hub)
+    application.add_task(collect_metrics(application), name="collect_metrics")
+
+    # every process runs the profiles requested from all processes
+    application.add_task(poll_profile_requests(application), name="poll_profile_requests")
+
+    # every process watches its own event loop, if asked to
+    application.ctx.stall_watchdog = None
+    if application.ctx.opt.api_stall_threshold_ms > 0:
+        application.ctx.stall_watchdog = stalls.StallWatchdog(application.ctx.opt.api_stall_threshold_ms / 1000)
+        application.ctx.stall_watchdog.start(asyncio.get_running_loop())
+
+    # every process has its own connection pool to the IdP
+    if application.ctx.opt.config_use_oidc:
+        application.ctx.oauth_client = application.ctx.oauth_cfg.get_async_client()
 
 
 @app.before_server_stop
 async def before_server_stop(application: Sanic):
-    # only cancel scan_pods task in rank 0 process
+    # flush_heartbeats writes buffered heartbeats when cancelled
+    await application.cancel_task("flush_heartbeats")
+
+    if getattr(application.ctx, 'stall_watchdog', None) is not None:
+        application.ctx.stall_watchdog.stop()
+
+    if getattr(application.ctx, 'oauth_client', None) is not None:
+        logger.info(f"oidc latency: {application.ctx.oauth_client.latency.snapshot()}")
+        await application.ctx.oauth_client.aclose()
+
+    # only cancel scan_pods and audit_usage tasks in rank 0 process
     if application.m.name == "Sanic-Server-0-0":
         await application.cancel_task("scan_pods")
+        await application.cancel_task("audit_usage")
         await application.purge_tasks()
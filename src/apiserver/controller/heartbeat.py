@@ -2,11 +2,9 @@
 This module implements the heartbeat controller.
 """
 
-import asyncio
-
 import jwt
 from loguru import logger
-from sanic import Blueprint
+from sanic import Blueprint, Sanic
 from sanic.server.websockets.impl import WebsocketImplProtocol
 from sanic_ext import openapi
 
@@ -14,23 +12,30 @@ from src.apiserver.service import get_root_service
 from src.apiserver.service.handler import handle_user_heartbeat_event
 from src.components import config
 from src.components.events import UserHeartbeatEvent
+from src.components.heartbeat import HeartbeatHub
 
 bp = Blueprint("heartbeat", url_prefix="/heartbeat", version=1)
 
 
-async def sender(ws: WebsocketImplProtocol, username: str):
-    # get root service
-    srv = get_root_service()
-    ev = UserHeartbeatEvent(username=username)
-    while True:
-        try:
-            # send ping message
-            await ws.send('ping')
-            await handle_user_heartbeat_event(srv, ev)  # update user's heartbeat timestamp
-            await asyncio.sleep(config.CONFIG_HEARTBEAT_INTERVAL_S)  # wait for 120 seconds
-        except Exception as e:
-            logger.error(f"connection closed: {e}")
-            break
+async def record_heartbeat(username: str):
+    # update user's heartbeat timestamp
+    return await handle_user_heartbeat_event(get_root_service(), UserHeartbeatEvent(username=username))
+
+
+@bp.after_server_start
+async def start_heartbeat_hub(application: Sanic):
+    # one hub per process drives the pings of all its connections
+    application.ctx.heartbeat_hub = HeartbeatHub(
+        interval_s=config.CONFIG_HEARTBEAT_INTERVAL_S,
+        n_slots=config.CONFIG_HEARTBEAT_WHEEL_SLOTS,
+        on_alive=record_heartbeat,
+    )
+    application.add_task(application.ctx.heartbeat_hub.run(), name="heartbeat_hub")
+
+
+@bp.before_server_stop
+async def stop_heartbeat_hub(application: Sanic):
+    await application.cancel_task("heartbeat_hub")
 
 
 @bp.websocket("/user", name="heartbeat_user")
@@ -41,14 +46,12 @@ async def sender(ws: WebsocketImplProtocol, username: str):
 )
 async def user_heartbeat_ws(request, ws: WebsocketImplProtocol):
     """
-    User heartbeat websocket. The serve will send a 'ping' message to the client every 60 seconds.
+    User heartbeat websocket. The server will send a ping frame to the client every 120 seconds.
 
-    If the client does not recv within 60 seconds, the server will close the connection.
+    If the client does not answer with a pong before the next ping, the server will close the connection.
 
-    If the client responds with ACK, the server will update the user's heartbeat timestamp.
+    While the client answers, the server will update the user's heartbeat timestamp.
     """
-    task_name = f"receiver:{request.id}"
-
     # parse query args, token should be encoded jwt
     token = request.args.get("token")
     if token is None or token == "":
@@ -76,11 +79,11 @@ async def user_heartbeat_ws(request, ws: WebsocketImplProtocol):
             await ws.close(code=4401, reason="Unauthorized")
             return
 
-    # start sender task with username
-    request.app.add_task(sender(ws, username), name=task_name)
+    # register to the hub, which pings the connection from now on
+    _ = await record_heartbeat(username)
+    conn = request.app.ctx.heartbeat_hub.register(ws, username)
     try:
         while True:
             await ws.recv()
     finally:
-        # await request.app.cancel_task(task_name)
-        request.app.purge_tasks()
+        request.app.ctx.heartbeat_hub.unregister(conn)
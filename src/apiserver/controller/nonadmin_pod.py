@@ -6,14 +6,16 @@ import http
 
 from loguru import logger
 from sanic import Blueprint
-from sanic.response import json as json_response
 from sanic_ext import openapi
 from sanic_jwt import protected
 
 import src.components.authz as authn
 import src.components.errors as errors
+from src.components.events import PodStatusEvent
 from src.apiserver.service import get_root_service
+from .response import list_etag, model_response, not_modified, resource_etag
 from .types import *
+from .watch import stream_pod_status
 
 bp = Blueprint("nonadmin_pod", url_prefix="/pods", version=1)
 
@@ -23,12 +25,14 @@ bp = Blueprint("nonadmin_pod", url_prefix="/pods", version=1)
     response=[
         openapi.definitions.Response(
             {'application/json': PodListResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     parameter=[
         openapi.definitions.Parameter("index_start", int, location="query", required=False),
         openapi.definitions.Parameter("index_end", int, location="query", required=False),
-        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False)
+        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False),
+        openapi.definitions.Parameter("If-None-Match", str, location="header", required=False)
     ],
     secured={"token": []}
 )
@@ -45,34 +49,76 @@ async def list(request):
         req = PodListRequest()
     else:
         req = PodListRequest(**{k: v for (k, v) in request.query_args})
-    # legal client will add 'username=<username>' to extra_query_filter
+
+    # only pods owned by the user, whatever the client filters on
+    # attention: request.ctx.user['username'] is set in authn.validate_role()
+    owner_filter = {'username': request.ctx.user['username']}
+
+    # answer conditional requests from the resource versions, before reading the pods
+    version, digest, count, _, err = await get_root_service().pod_service.list_version(
+        request.app, req, extra_query_filter=owner_filter, count_all=False
+    )
+    etag = list_etag(version, digest, count, 0, req) if err is None else None
+    res = not_modified(request, etag)
+    if res is not None:
+        return res
 
     # list pods
-    count, pods, err = await get_root_service().pod_service.list(request.app, req)
-    pods = [p for p in pods if p.username == request.ctx.user['username']]  # filter out pods not owned by the user
-    count = len(pods)  # update count
+    _, pods, err = await get_root_service().pod_service.list(
+        request.app, req, extra_query_filter=owner_filter, count_all=False
+    )
+    count = len(pods)
 
     # return response
     if err is not None:
-        return json_response(
+        status_code = errors.http_status_for(err)
+        return model_response(
             PodListResponse(
-                status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                status=status_code,
                 message=str(err)
-            ).model_dump(),
-            status=http.HTTPStatus.INTERNAL_SERVER_ERROR
+            ),
+            status=status_code
         )
     else:
-        return json_response(
+        return model_response(
             PodListResponse(
                 status=http.HTTPStatus.OK,
                 message="success",
                 total_pods=count,
                 pods=pods
-            ).model_dump(),
-            status=http.HTTPStatus.OK
+            ),
+            status=http.HTTPStatus.OK,
+            etag=etag
         )
 
 
+@bp.get("/watch", name="nonadmin_pod_watch")
+@openapi.definition(
+    response=[
+        openapi.definitions.Response(
+            {'text/event-stream': PodStatusEvent.model_json_schema(ref_template="#/components/schemas/{model}")},
+            status=200)
+    ],
+    parameter=[
+        openapi.definitions.Parameter("since", int, location="query", required=False),
+        openapi.definitions.Parameter("Last-Event-ID", int, location="header", required=False)
+    ],
+    secured={"token": []}
+)
+@protected()
+@authn.validate_role()
+async def watch(request):
+    """
+    Watch the status of the pods owned by the user, as server-sent events.
+
+    Each event carries the pod's resource_version as its id. With since, or the Last-Event-ID header of a
+    reconnecting client, the transitions after that version are sent first, since=0 sends the status of every pod.
+    """
+    logger.debug(f"{request.method} {request.path} invoked")
+
+    return await stream_pod_status(request, request.ctx.user['username'])
+
+
 @bp.post("/", name="nonadmin_pod_create")
 @openapi.definition(
     body={'application/json': PodCreateRequest.model_json_schema(ref_template="#/components/schemas/{model}")},
@@ -93,11 +139,11 @@ async def create(request):
 
     # parse request body
     if request.json is None:
-        return json_response(
+        return model_response(
             PodCreateResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -106,11 +152,11 @@ async def create(request):
             req = PodCreateRequest(**request.json)
             req.username = request.ctx.user['username'] if req.username is None else req.username
         except Exception as e:
-            return json_response(
+            return model_response(
                 PodCreateResponse(
                     status=http.HTTPStatus.BAD_REQUEST,
                     message=str(e)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.BAD_REQUEST
             )
 
@@ -119,21 +165,21 @@ async def create(request):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 PodCreateResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
 
         else:
-            return json_response(
+            return model_response(
                 PodCreateResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=pod
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
 
@@ -143,7 +189,8 @@ async def create(request):
     response=[
         openapi.definitions.Response(
             {'application/json': PodGetResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     secured={"token": []}
 )
@@ -157,54 +204,62 @@ async def get(request, pod_id: str):
 
     # check pod_id param in url
     if pod_id is None or pod_id == "":
-        return json_response(
+        return model_response(
             PodGetResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
-        # get pod
+        # answer conditional requests from the resource version, before reading the pod
         req = PodGetRequest(pod_id=pod_id)
+        version, err = await get_root_service().pod_service.get_version(request.app, req)
+        if err is None and version.get('username') == request.ctx.user['username']:
+            res = not_modified(request, resource_etag(version.get('resource_version', 0)))
+            if res is not None:
+                return res
+
+        # get pod
         pod, err = await get_root_service().pod_service.get(request.app, req)
         if err is not None:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.NOT_FOUND,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.NOT_FOUND
             )
 
         # reject if pod does not belong to current user
         # attention: request.ctx.user['username'] is set in authn.validate_role()
         if pod.username != request.ctx.user['username']:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.UNAUTHORIZED,
                     message="cannot get pods that does not belong to current user"
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.UNAUTHORIZED
             )
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=pod
-                ).model_dump(),
-                status=http.HTTPStatus.OK
+                ),
+                status=http.HTTPStatus.OK,
+                etag=resource_etag(pod.resource_version)
             )
 
 
@@ -228,11 +283,11 @@ async def update(request, pod_id: str):
 
     # check pod_id param in url
     if pod_id is None or pod_id == "":
-        return json_response(
+        return model_response(
             PodUpdateResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -242,22 +297,22 @@ async def update(request, pod_id: str):
         # check if pod exists
         pod, err = await get_root_service().pod_service.get(request.app, req)
         if err is not None:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.NOT_FOUND,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.NOT_FOUND
             )
         else:
             # reject if pod does not belong to current user
             # attention: request.ctx.user['username'] is set in authn.validate_role()
             if pod.username != request.ctx.user['username']:
-                return json_response(
+                return model_response(
                     PodUpdateResponse(
                         status=http.HTTPStatus.UNAUTHORIZED,
                         message="cannot update pods that does not belong to current user"
-                    ).model_dump(),
+                    ),
                     status=http.HTTPStatus.UNAUTHORIZED
                 )
 
@@ -266,11 +321,11 @@ async def update(request, pod_id: str):
         try:
             req = PodUpdateRequest(**body)
         except Exception as e:
-            return json_response(
+            return model_response(
                 PodUpdateResponse(
                     status=http.HTTPStatus.BAD_REQUEST,
                     message=str(e)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.BAD_REQUEST
             )
         req.pod_id = pod_id  # set pod_id to the one in url
@@ -279,20 +334,20 @@ async def update(request, pod_id: str):
         # return response
         if err is not None:
             status_code = errors.http_status_for(err)
-            return json_response(
+            return model_response(
                 PodUpdateResponse(
                     status=status_code,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=status_code
             )
         else:
-            return json_response(
+            return model_response(
                 PodUpdateResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=pod
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
 
@@ -316,11 +371,11 @@ async def delete(request, pod_id: str):
 
     # check pod_id param in url
     if pod_id is None or pod_id == "":
-        return json_response(
+        return model_response(
             PodDeleteResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
@@ -328,22 +383,22 @@ async def delete(request, pod_id: str):
         req = PodGetRequest(pod_id=pod_id)
         pod, err = await get_root_service().pod_service.get(request.app, req)
         if err is not None:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.NOT_FOUND,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.NOT_FOUND
             )
         else:
             # reject if pod does not belong to current user
             # attention: request.ctx.user['username'] is set in authn.validate_role()
             if pod.username != request.ctx.user['username']:
-                return json_response(
+                return model_response(
                     PodGetResponse(
                         status=http.HTTPStatus.UNAUTHORIZED,
                         message="cannot update pods that does not belong to current user"
-                    ).model_dump(),
+                    ),
                     status=http.HTTPStatus.UNAUTHORIZED
                 )
 
@@ -353,19 +408,19 @@ async def delete(request, pod_id: str):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 PodDeleteResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 PodDeleteResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     pod=deleted_pod
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
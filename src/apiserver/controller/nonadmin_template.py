@@ -7,12 +7,12 @@ import json
 
 from loguru import logger
 from sanic import Blueprint
-from sanic.response import json as json_response
 from sanic_ext import openapi
 from sanic_jwt import protected
 
 import src.components.errors as errors
 from src.apiserver.service import get_root_service
+from .response import list_etag, model_response, not_modified, resource_etag
 from .types import *
 
 bp = Blueprint("nonadmin_template", url_prefix="/templates", version=1)
@@ -23,12 +23,14 @@ bp = Blueprint("nonadmin_template", url_prefix="/templates", version=1)
     response=[
         openapi.definitions.Response(
             {'application/json': TemplateListResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     parameter=[
         openapi.definitions.Parameter("index_start", int, location="query", required=False),
         openapi.definitions.Parameter("index_end", int, location="query", required=False),
-        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False)
+        openapi.definitions.Parameter("extra_query_filter", str, location="query", required=False),
+        openapi.definitions.Parameter("If-None-Match", str, location="header", required=False)
     ],
     secured={"token": []}
 )
@@ -53,27 +55,36 @@ async def list(request):
     base_filter["enabled"] = True
     req.extra_query_filter = json.dumps(base_filter)
 
+    # answer conditional requests from the resource versions, before reading the templates
+    version, digest, count, total, err = await get_root_service().template_service.list_version(request.app, req)
+    etag = list_etag(version, digest, count, total, req) if err is None else None
+    res = not_modified(request, etag)
+    if res is not None:
+        return res
+
     # list templates
     count, templates, err = await get_root_service().template_service.list(request.app, req)
 
     # return response
     if err is not None:
-        return json_response(
+        status_code = errors.http_status_for(err)
+        return model_response(
             TemplateListResponse(
-                status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
+                status=status_code,
                 message=str(err)
-            ).model_dump(),
-            status=http.HTTPStatus.INTERNAL_SERVER_ERROR
+            ),
+            status=status_code
         )
     else:
-        return json_response(
+        return model_response(
             TemplateListResponse(
                 status=http.HTTPStatus.OK,
                 message="success",
                 total_templates=count,
                 templates=templates
-            ).model_dump(),
-            status=http.HTTPStatus.OK
+            ),
+            status=http.HTTPStatus.OK,
+            etag=etag
         )
 
 
@@ -82,7 +93,8 @@ async def list(request):
     response=[
         openapi.definitions.Response(
             {'application/json': TemplateGetResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     secured={"token": []}
 )
@@ -95,16 +107,23 @@ async def get(request, template_id: str):
 
     # check template_id param in url
     if template_id is None or template_id == "":
-        return json_response(
+        return model_response(
             TemplateGetResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
-        # get template
+        # answer conditional requests from the resource version, before reading the template
         req = TemplateGetRequest(template_id=template_id)
+        version, err = await get_root_service().template_service.get_version(request.app, req)
+        if err is None and version.get('enabled', False):
+            res = not_modified(request, resource_etag(version.get('resource_version', 0)))
+            if res is not None:
+                return res
+
+        # get template
         template, err = await get_root_service().template_service.get(request.app, req)
 
         # treat disabled templates as not found for non-admin users
@@ -114,19 +133,20 @@ async def get(request, template_id: str):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 TemplateGetResponse(
                     status=http.HTTPStatus.NOT_FOUND,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.NOT_FOUND
             )
         else:
-            return json_response(
+            return model_response(
                 TemplateGetResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     template=template
-                ).model_dump(),
-                status=http.HTTPStatus.OK
+                ),
+                status=http.HTTPStatus.OK,
+                etag=resource_etag(template.resource_version)
             )
@@ -6,13 +6,13 @@ import http
 
 from loguru import logger
 from sanic import Blueprint
-from sanic.response import json as json_response
 from sanic_ext import openapi
 from sanic_jwt import protected
 
 import src.components.authz as authn
 from src.apiserver.service import get_root_service
 from src.components import errors
+from .response import model_response, not_modified, resource_etag
 from .types import *
 
 bp = Blueprint("nonadmin_user", url_prefix="/users", version=1)
@@ -23,7 +23,8 @@ bp = Blueprint("nonadmin_user", url_prefix="/users", version=1)
     response=[
         openapi.definitions.Response(
             {'application/json': UserGetResponse.model_json_schema(ref_template="#/components/schemas/{model}")},
-            status=200)
+            status=200),
+        openapi.definitions.Response(description="Not Modified", status=304)
     ],
     secured={"token": []}
 )
@@ -37,46 +38,54 @@ async def get(request, username: str):
 
     # check username param in url
     if username is None or username == "":
-        return json_response(
+        return model_response(
             UserGetResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
         # check if user is requesting their own info
         # attention: request.ctx.user['username'] is set in authn.validate_role()
         if username != request.ctx.user['username']:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.UNAUTHORIZED,
                     message="cannot get other users"
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.UNAUTHORIZED
             )
 
-        # get user
+        # answer conditional requests from the resource version, before reading the user
         req = UserGetRequest(username=username)
+        version, err = await get_root_service().user_service.get_version(request.app, req)
+        if err is None:
+            res = not_modified(request, resource_etag(version.get('resource_version', 0)))
+            if res is not None:
+                return res
+
+        # get user
         user, err = await get_root_service().user_service.get(request.app, req)
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 UserGetResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 UserGetResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     user=user
-                ).model_dump(),
-                status=http.HTTPStatus.OK
+                ),
+                status=http.HTTPStatus.OK,
+                etag=resource_etag(user.resource_version)
             )
 
 
@@ -100,21 +109,21 @@ async def update(request, username: str):
 
     # check username param in url
     if username is None or username == "":
-        return json_response(
+        return model_response(
             UserUpdateResponse(
                 status=http.HTTPStatus.BAD_REQUEST,
                 message=str(errors.invalid_request_body)
-            ).model_dump(),
+            ),
             status=http.HTTPStatus.BAD_REQUEST
         )
     else:
         # check if user is updating their own info
         if username != request.ctx.user['username']:
-            return json_response(
+            return model_response(
                 PodGetResponse(
                     status=http.HTTPStatus.UNAUTHORIZED,
                     message="cannot get other users"
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.UNAUTHORIZED
             )
         body = request.json
@@ -129,19 +138,19 @@ async def update(request, username: str):
 
         # return response
         if err is not None:
-            return json_response(
+            return model_response(
                 UserUpdateResponse(
                     status=http.HTTPStatus.INTERNAL_SERVER_ERROR,
                     message=str(err)
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.INTERNAL_SERVER_ERROR
             )
         else:
-            return json_response(
+            return model_response(
                 UserUpdateResponse(
                     status=http.HTTPStatus.OK,
                     message="success",
                     user=user
-                ).model_dump(),
+                ),
                 status=http.HTTPStatus.OK
             )
@@ -0,0 +1,138 @@
+"""
+This module serializes response models.
+
+With orjson installed, the model is dumped to python objects and encoded by orjson: enums, UUIDs and
+datetimes are handled in C, where pydantic's JSON mode calls back into python for every enum value.
+Without it, pydantic-core serializes the model to JSON bytes in one pass.
+
+Read endpoints tag responses with ETags derived from resource versions (see src/components/hlc.py). The
+versions are read before the documents, so a request whose If-None-Match still matches is answered with a
+304 without reading or serializing the documents.
+
+Large lists can be streamed as newline-delimited JSON instead, one document per line, read from the database
+cursor batch by batch: memory stays bounded and the first byte is sent after the first batch, whatever the size
+of the collection.
+"""
+
+import http
+from typing import AsyncIterator, Dict, Optional
+
+from pydantic import BaseModel
+from sanic import Request
+from sanic.response import HTTPResponse
+
+from src.components import config
+from src.components.query_guard import query_error
+from .types import ListRequestBaseModel
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dump_json(model: BaseModel) -> bytes:
+    """
+    Serialize model to JSON bytes
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(model.model_dump(), option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. a type orjson does not know, pydantic does
+            pass
+    return model.__pydantic_serializer__.to_json(model)
+
+
+def model_response(model: BaseModel,
+                   status: int = http.HTTPStatus.OK,
+                   headers: Optional[Dict[str, str]] = None,
+                   etag: Optional[str] = None) -> HTTPResponse:
+    """
+    Return model as a JSON response, tagged with etag if given
+    """
+    if etag is not None:
+        headers = {**(headers or {}), 'ETag': etag}
+    return HTTPResponse(dump_json(model), status=status, headers=headers, content_type="application/json")
+
+
+def resource_etag(version: int) -> str:
+    """
+    Return the ETag of a single resource
+    """
+    return f'"{version:x}"'
+
+
+def list_etag(version: int, digest: int, count: int, total: int, req: ListRequestBaseModel) -> str:
+    """
+    Return the ETag of a page of a list. digest catches updates that do not raise the max version, count catches
+    deletions; total is part of the response body, and the pages of an unchanged list differ by their bounds.
+    """
+    return f'"{version:x}-{digest:x}-{count:x}-{total:x}-{req.index_start}-{req.index_end}"'
+
+
+def not_modified(request: Request, etag: Optional[str]) -> Optional[HTTPResponse]:
+    """
+    Return a 304 response if the If-None-Match header of request matches etag, None otherwise
+    """
+    if etag is None:
+        return None
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is None:
+        return None
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        # weak comparison, as RFC 9110 prescribes for If-None-Match
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag or candidate == '*':
+            return HTTPResponse(status=http.HTTPStatus.NOT_MODIFIED, headers={'ETag': etag})
+    return None
+
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(request: Request) -> bool:
+    """
+    Return whether request asks for a newline-delimited JSON stream, with its Accept header or ?stream=1
+    """
+    return NDJSON_CONTENT_TYPE in request.headers.get('accept', '') or request.args.get('stream') in ('1', 'true')
+
+
+async def ndjson_chunks(models: AsyncIterator[BaseModel],
+                        chunk_size: int = config.CONFIG_STREAM_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Encode models as newline-delimited JSON, in chunks of about chunk_size bytes
+    """
+    lines, size = [], 0
+    async for model in models:
+        line = dump_json(model) + b"\n"
+        lines.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b"".join(lines)
+            lines, size = [], 0
+    if len(lines) > 0:
+        yield b"".join(lines)
+
+
+async def stream_ndjson(request: Request, models: AsyncIterator[BaseModel]) -> Optional[Exception]:
+    """
+    Stream models as newline-delimited JSON. Return an error, with nothing sent, if the first chunk cannot be read.
+    """
+    chunks = ndjson_chunks(models)
+    try:
+        first = await anext(chunks, b"")
+    except Exception as e:
+        return query_error(e)
+
+    # attention: an error after this point drops the connection without the last chunk, the client sees a
+    # truncated stream rather than a complete one
+    response = await request.respond(content_type=NDJSON_CONTENT_TYPE)
+    if len(first) > 0:
+        await response.send(first)
+    async for chunk in chunks:
+        await response.send(chunk)
+    await response.eof()
+    return None
@@ -7,6 +7,7 @@ from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, EmailStr, field_validator, model_validator
 
 import src.components.datamodels as datamodels
+from src.components import config
 
 
 class ListRequestBaseModel(BaseModel):
@@ -66,6 +67,27 @@ class UserCreateResponse(ResponseBaseModel):
     user: datamodels.UserModel = None
 
 
+class UserBatchCreateRequest(BaseModel):
+    """
+    Create request for many users at once
+    """
+    users: List[UserCreateRequest]
+
+    @field_validator('users')
+    def usernames_must_be_unique(cls, v):
+        if len({user.username for user in v}) != len(v):
+            raise ValueError("duplicate username in batch")
+        return v
+
+
+class UserBatchCreateResponse(ResponseBaseModel):
+    """
+    Create response for many users, failed maps usernames to the error
+    """
+    users: List[datamodels.UserModel] = []
+    failed: Dict[str, str] = {}
+
+
 class UserGetRequest(BaseModel):
     """
     Get request for users
@@ -411,6 +433,114 @@ class PodDeleteResponse(PodGetResponse):
     pass
 
 
+class PodWatchRequest(BaseModel):
+    """
+    Watch request for pods, resumes from version since if set
+    """
+    since: Optional[int] = None
+
+    @field_validator('since')
+    def since_must_not_be_negative(cls, v):
+        if v is not None and v < 0:
+            raise ValueError("since must not be negative")
+        return v
+
+
+class PodWatchResponse(ResponseBaseModel):
+    """
+    Watch response for pods, only sent when the watch cannot be started
+    """
+    pass
+
+
+class PodTimingsSummaryModel(BaseModel):
+    """
+    Percentiles of the phases of the pod starts of a template, in milliseconds by phase
+    """
+    template_ref: str
+    pods: int = 0  # pods whose last start is counted
+    p50_ms: Dict[str, int] = {}
+    p95_ms: Dict[str, int] = {}
+
+
+class PodTimingsResponse(ResponseBaseModel):
+    """
+    Timings response for pods, the start latency of each template
+    """
+    templates: List[PodTimingsSummaryModel] = []
+
+
+class StallModel(BaseModel):
+    """
+    Stalls of the event loop at a location of the code
+    """
+    location: str
+    count: int
+    total_ms: int
+    max_ms: int
+    stack: List[str] = []  # stack of the longest stall, innermost last
+    workers: List[int] = []  # pids of the workers that stalled there
+
+
+class StallsResponse(ResponseBaseModel):
+    """
+    Stalls response, the stalls of the event loops of all workers by location, the longest first
+    """
+    threshold_ms: int = 0  # 0 if the watchdog is off
+    stalls: List[StallModel] = []
+
+
+class ProfileRequest(BaseModel):
+    """
+    Profile request, profiles the worker serving it or all workers for seconds
+    """
+    seconds: int = 30
+    mode: str = "cpu"  # cpu or alloc
+    top: int = config.CONFIG_PROFILE_TOP_N  # rows of the allocation table
+    all: bool = False  # profile all workers
+
+    @field_validator('seconds')
+    def seconds_must_be_in_range(cls, v):
+        if not 0 < v <= config.CONFIG_PROFILE_MAX_S:
+            raise ValueError(f"seconds must be between 1 and {config.CONFIG_PROFILE_MAX_S}")
+        return v
+
+    @field_validator('mode')
+    def mode_must_be_valid(cls, v):
+        if v not in ("cpu", "alloc"):
+            raise ValueError("mode must be cpu or alloc")
+        return v
+
+    @field_validator('top')
+    def top_must_be_in_range(cls, v):
+        if not 0 < v <= config.CONFIG_PROFILE_MAX_TOP_N:
+            raise ValueError(f"top must be between 1 and {config.CONFIG_PROFILE_MAX_TOP_N}")
+        return v
+
+
+class AllocationModel(BaseModel):
+    """
+    Memory allocated by a line of code during a profile
+    """
+    location: str
+    size_diff_kb: float  # allocated and not freed during the profile
+    count_diff: int
+    size_kb: float  # held at the end of the profile
+    pid: int
+
+
+class ProfileResponse(ResponseBaseModel):
+    """
+    Profile response, the collapsed stacks of the cpu mode or the allocation table of the alloc mode
+    """
+    mode: str = "cpu"
+    seconds: int = 0
+    workers: List[int] = []  # pids of the workers profiled
+    samples: int = 0
+    collapsed: List[str] = []  # "outer;...;inner count", most samples first
+    allocations: List[AllocationModel] = []
+
+
 class OIDCStatusResponse(BaseModel):
     name: str
     path: str
@@ -420,3 +550,6 @@ from sanic_ext import openapi
 
 # attention: registrate components
 openapi.component(OIDCStatusResponse)
+openapi.component(PodTimingsSummaryModel)
+openapi.component(StallModel)
+openapi.component(AllocationModel)
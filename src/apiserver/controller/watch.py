@@ -0,0 +1,94 @@
+"""
+This module streams pod status events to watchers as server-sent events.
+
+A watch without `since` streams the transitions from now on. A watch resumed with `since` (or the Last-Event-ID
+header a reconnecting EventSource sends) first replays what changed after that version, `since=0` replays the
+status of every pod. Events are snapshots of the status of a pod, so replaying one twice is harmless.
+"""
+
+import asyncio
+import http
+from typing import Iterable, Optional
+
+from sanic import Request
+from sanic.response import HTTPResponse
+
+from src.apiserver.service import get_root_service
+from src.components import config
+from src.components.events import PodStatusEvent
+from .response import dump_json, model_response
+from .types import PodWatchRequest, PodWatchResponse
+
+
+def format_event(ev: PodStatusEvent) -> bytes:
+    """
+    Format ev as a server-sent event, its id is the version to resume from
+    """
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (ev.resource_version, ev.type.encode(), dump_json(ev))
+
+
+async def _send_all(response, events: Iterable[PodStatusEvent]) -> int:
+    last = 0
+    for ev in events:
+        await response.send(format_event(ev))
+        last = max(last, ev.resource_version)
+    return last
+
+
+async def stream_pod_status(request: Request, username: Optional[str] = None) -> Optional[HTTPResponse]:
+    """
+    Stream the status events of the pods of username, or of all pods if username is None
+    """
+    try:
+        since = request.headers.get('last-event-id', request.args.get('since'))
+        req = PodWatchRequest(since=since)
+    except Exception as e:
+        return model_response(
+            PodWatchResponse(status=http.HTTPStatus.BAD_REQUEST, message=str(e)),
+            status=http.HTTPStatus.BAD_REQUEST
+        )
+
+    pod_service = get_root_service().pod_service
+    hub = pod_service.watch
+    sub, replay = hub.subscribe(username, req.since)
+    try:
+        # the backlog does not reach back far enough, read what changed from the database
+        if replay is None:
+            replay, err = await pod_service.list_status(request.app, req.since - hub.lookback, username)
+            if err is not None:
+                return model_response(
+                    PodWatchResponse(status=http.HTTPStatus.INTERNAL_SERVER_ERROR, message=str(err)),
+                    status=http.HTTPStatus.INTERNAL_SERVER_ERROR
+                )
+
+        response = await request.respond(
+            content_type="text/event-stream",
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        await response.send(b"retry: %d\n\n" % config.CONFIG_WATCH_RETRY_MS)
+        last = max(req.since or 0, await _send_all(response, replay))
+
+        while True:
+            # the queue overflowed and events were dropped, catch up from the database
+            if sub.lagged:
+                while not sub.queue.empty():
+                    sub.queue.get_nowait()
+                sub.lagged = False
+                events, err = await pod_service.list_status(request.app, last - hub.lookback, username)
+                if err is not None:
+                    break
+                last = max(last, await _send_all(response, events))
+                continue
+
+            try:
+                ev = await asyncio.wait_for(sub.queue.get(), timeout=config.CONFIG_WATCH_KEEPALIVE_S)
+            except asyncio.TimeoutError:
+                # a comment, keeps proxies from closing the idle connection and detects dead clients
+                await response.send(b": keepalive\n\n")
+                continue
+            await response.send(format_event(ev))
+            last = max(last, ev.resource_version)
+
+        await response.eof()
+    finally:
+        hub.unsubscribe(sub)
@@ -1,4 +1,6 @@
 from .db import DBRepo
 from .pod import PodRepo
 from .template import TemplateRepo
+from .uid import UidAllocator
+from .usage import UsageRepo
 from .user import UserRepo
@@ -2,14 +2,107 @@
 Repo is a class that provides methods to access the database
 """
 
-from typing import Dict
+import asyncio
+import functools
+import inspect
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
 
+import pymongo
+import pymongo.monitoring
 from kubernetes import client
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
+from loguru import logger
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCursor, AsyncIOMotorDatabase, AsyncIOMotorCollection
 
+from src.components import config, errors, metrics
+from src.components.query_guard import command_counts, query_route, query_shape
 from src.components.utils import singleton
 
 
+def _timed(method: str, fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            res = await fn(*args, **kwargs)
+        except BaseException:
+            metrics.DB_OPERATION_ERRORS.inc(method)
+            raise
+        finally:
+            metrics.DB_OPERATION_DURATION.observe(time.perf_counter() - start, method)
+        err = res[-1] if isinstance(res, tuple) and len(res) > 0 else res
+        if isinstance(err, BaseException):
+            metrics.DB_OPERATION_ERRORS.inc(method)
+        return res
+
+    return wrapper
+
+
+def instrumented(cls):
+    """
+    Class decorator for repos: time their public async methods, and count the calls that return or raise an
+    error, by method.
+    """
+    for name, fn in list(vars(cls).items()):
+        if not name.startswith('_') and inspect.iscoroutinefunction(fn):
+            setattr(cls, name, _timed(f"{cls.__name__}.{name}", fn))
+    return cls
+
+
+def _documents(reply: Dict[str, Any]) -> int:
+    cursor = reply.get('cursor')
+    if isinstance(cursor, dict):
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if 'value' in reply:  # findAndModify
+        return 0 if reply['value'] is None else 1
+    return int(reply.get('n', 0))
+
+
+class CommandMonitor(pymongo.monitoring.CommandListener):
+    """
+    Count the commands pymongo sends by the route, task or event handler they run for, time them, and log the
+    slow ones. Motor runs pymongo in threads with a copy of the caller's context, so query_route is the route of
+    the caller.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started: Dict[Tuple[int, Any], Tuple[str, str]] = {}
+
+    def started(self, event: pymongo.monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get('collection' if event.command_name == 'getMore' else event.command_name)
+        route = query_route.get()
+        with self._lock:
+            self._started[(event.request_id, event.connection_id)] = (
+                collection if isinstance(collection, str) else '', route
+            )
+            counts = command_counts.get()
+            if counts is not None:
+                counts[(event.command_name, collection if isinstance(collection, str) else '')] += 1
+
+    def succeeded(self, event: pymongo.monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, _documents(event.reply) if isinstance(event.reply, dict) else 0)
+
+    def failed(self, event: pymongo.monitoring.CommandFailedEvent) -> None:
+        self._finish(event, 0)
+
+    def _finish(self, event, documents: int) -> None:
+        duration_s = event.duration_micros / 1e6
+        with self._lock:
+            collection, route = self._started.pop((event.request_id, event.connection_id), ('', '-'))
+            metrics.DB_COMMANDS.inc(route, event.command_name, collection)
+            metrics.DB_COMMAND_DURATION.observe(duration_s, event.command_name, collection)
+            if documents > 0:
+                metrics.DB_COMMAND_DOCUMENTS.inc(route, collection, amount=documents)
+        if duration_s * 1000 > config.CONFIG_QUERY_SLOW_MS:
+            logger.warning(f"slow {event.command_name} on {collection} for {route}: {duration_s * 1000:.0f}ms, "
+                           f"{documents} documents")
+
+
+command_monitor = CommandMonitor()
+
+
 @singleton
 class DBRepo:
     """
@@ -35,7 +128,7 @@ class DBRepo:
                 password=self.options['DB_PASSWORD']) if self.options['DB_USERNAME'] else '',
             host=self.options['DB_HOST'] if self.options['DB_HOST'] else '127.0.0.1',
             port=self.options['DB_PORT'] if self.options['DB_PORT'] else 27017)
-        return AsyncIOMotorClient(self.motor_uri)
+        return AsyncIOMotorClient(self.motor_uri, event_listeners=[command_monitor])
 
     def get_db(self, db: str) -> AsyncIOMotorDatabase:
         """
@@ -61,3 +154,98 @@ class DBRepo:
             self._db_collection[collection_key] = self.get_db(db_name)[collection]
 
         return self._db_collection[collection_key]
+
+    @property
+    def query_max_time_ms(self) -> Optional[int]:
+        """
+        The time limit of list queries, None for none
+        """
+        return self.options.get('DB_QUERY_MAX_TIME_MS') or None
+
+    @property
+    def query_explain(self) -> bool:
+        """
+        Whether list queries that scan the collection are rejected
+        """
+        return bool(self.options.get('DB_QUERY_EXPLAIN', False))
+
+
+# the verdicts of check_query_plan, by collection, sort key and query shape
+_plan_cache: Dict[Tuple[str, Optional[str], Any], bool] = {}
+
+
+def _has_collscan(plan: Any) -> bool:
+    if isinstance(plan, dict):
+        return plan.get('stage') == 'COLLSCAN' or any(_has_collscan(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(v) for v in plan)
+    return False
+
+
+async def check_query_plan(collection: AsyncIOMotorCollection,
+                           query_filter: Dict[str, Any],
+                           sort_key: Optional[str] = None) -> None:
+    """
+    Explain the query and raise query_not_indexed if it scans a collection of CONFIG_QUERY_EXPLAIN_MIN_DOCS
+    documents or more. Verdicts are cached by query shape, so each shape is explained once.
+    """
+    key = (collection.name, sort_key, query_shape(query_filter))
+    collscan = _plan_cache.get(key)
+    if collscan is None:
+        if await collection.estimated_document_count() < config.CONFIG_QUERY_EXPLAIN_MIN_DOCS:
+            return  # not cached, the collection may grow
+
+        cursor = collection.find(query_filter)
+        if sort_key is not None:
+            cursor = cursor.sort(sort_key, pymongo.ASCENDING)
+        explained = await cursor.explain()
+        collscan = _has_collscan(explained.get('queryPlanner', {}).get('winningPlan'))
+        if len(_plan_cache) >= config.CONFIG_QUERY_PLAN_CACHE_SIZE:
+            _plan_cache.clear()
+        _plan_cache[key] = collscan
+
+    if collscan:
+        logger.warning(f"query on {collection.name} rejected for {query_route.get()}: collection scan, "
+                       f"filter: {query_filter}")
+        raise errors.query_not_indexed
+
+
+async def find_guarded(db: DBRepo,
+                       collection: AsyncIOMotorCollection,
+                       query_filter: Dict[str, Any],
+                       sort_key: str,
+                       batch_size: int = config.CONFIG_STREAM_BATCH_SIZE) -> AsyncIOMotorCursor:
+    """
+    Find the documents matching query_filter sorted by sort_key, within the time limit of list queries. If db is
+    configured to, reject query filters that scan the collection.
+    """
+    if db.query_explain:
+        await check_query_plan(collection, query_filter, sort_key)
+    return collection.find(
+        query_filter, batch_size=batch_size, max_time_ms=db.query_max_time_ms
+    ).sort(sort_key, pymongo.ASCENDING)
+
+
+async def get_list_version(collection: AsyncIOMotorCollection,
+                           query_filter: Dict[str, Any],
+                           count_all: bool = True,
+                           max_time_ms: Optional[int] = None) -> Tuple[int, int, int, int]:
+    """
+    Return the max resource_version, a digest of the resource_versions and the count of the documents matching
+    query_filter, and the count of the collection (0 unless count_all), without reading the documents.
+
+    Versions are not globally ordered (clock skew between replicas), so an update may leave the max version as it
+    is. The digest, a sum that does not depend on the order of the documents, changes with it.
+    """
+    # attention: a $match inside $facet cannot use indexes, keep it the first stage of its own pipeline
+    matched = collection.aggregate([
+        {'$match': query_filter},
+        {'$group': {'_id': None, 'version': {'$max': '$resource_version'}, 'count': {'$sum': 1},
+                    'digest': {'$sum': {'$mod': ['$resource_version', 2 ** 31]}}}}
+    ], **({} if max_time_ms is None else {'maxTimeMS': max_time_ms})).to_list(length=1)
+    if count_all:
+        matched, total = await asyncio.gather(matched, collection.estimated_document_count())
+    else:
+        matched, total = await matched, 0
+    matched = matched[0] if matched else {}
+    return matched.get('version') or 0, int(matched.get('digest') or 0), matched.get('count', 0), total
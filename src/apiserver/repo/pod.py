@@ -3,18 +3,22 @@ PodRepo is a class that provides methods to access the database for pod related
 """
 
 import datetime
-from typing import List, Tuple, Optional, Dict, Any
+from typing import AsyncIterator, List, Tuple, Optional, Dict, Any
 
 import pymongo
 from loguru import logger
 
 import src.components.datamodels as datamodels
-from src.components import errors
+from src.components import config, errors
+from src.components.events import PodStatusEvent
+from src.components.hlc import next_resource_version
+from src.components.query_guard import log_slow_query, query_error
 from src.components.utils import singleton
-from .db import DBRepo
+from .db import DBRepo, check_query_plan, find_guarded, get_list_version, instrumented
 
 
 @singleton
+@instrumented
 class PodRepo:
     def __init__(self, db: DBRepo):
         self.db = db
@@ -26,7 +30,8 @@ class PodRepo:
         collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
         ret = await collection.find_one_and_update(
             {"pod_id": pod_id},
-            {"$set": {"resource_status": datamodels.ResourceStatusEnum.committed.value}}
+            {"$set": {"resource_status": datamodels.ResourceStatusEnum.committed.value,
+                      "resource_version": next_resource_version()}}
         )
         if ret is None:
             raise errors.unknown_error
@@ -45,39 +50,126 @@ class PodRepo:
         else:
             return datamodels.PodModel(**res), None
 
+    async def get_version(self, pod_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+        """
+        Get the resource_version and owner of a pod by pod_id, without reading the document.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
+            res = await collection.find_one({'pod_id': pod_id}, {'_id': 0, 'resource_version': 1, 'username': 1})
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return None, errors.db_connection_error
+        if res is None:
+            return None, errors.pod_not_found
+        return res, None
+
+    async def list_version(
+            self,
+            extra_query_filter: Dict[str, Any] = None,
+            count_all: bool = True
+    ) -> Tuple[int, int, int, int, Optional[Exception]]:
+        """
+        Get the max resource_version, version digest and count of the pods matching the filter, and the count of
+        all pods (0 unless count_all).
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
+            query_filter = extra_query_filter or {}
+            if self.db.query_explain:
+                await check_query_plan(collection, query_filter)
+            with log_slow_query(datamodels.pod_collection_name, query_filter):
+                version, digest, count, total = await get_list_version(collection, query_filter, count_all,
+                                                                       self.db.query_max_time_ms)
+            return version, digest, count, total, None
+        except Exception as e:
+            return 0, 0, 0, 0, query_error(e)
+
+    async def list_status(
+            self,
+            since: int,
+            extra_query_filter: Dict[str, Any] = None
+    ) -> Tuple[List[PodStatusEvent], Optional[Exception]]:
+        """
+        List the status of the pods written after version since, in version order.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
+            query_filter = {'resource_version': {'$gt': since}} | (extra_query_filter or {})
+            cursor = collection.find(query_filter, {
+                '_id': 0, 'pod_id': 1, 'username': 1, 'name': 1, 'target_status': 1, 'current_status': 1,
+                'current_status_reason': 1, 'resource_status': 1, 'resource_version': 1
+            }).sort('resource_version', pymongo.ASCENDING)
+            return [PodStatusEvent(**document) async for document in cursor], None
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return [], errors.db_connection_error
+
+    async def list_timings(self) -> Tuple[List[Dict[str, Any]], Optional[Exception]]:
+        """
+        List the template_ref and timings of the pods with timings, leaving out the pods whose last start failed.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
+            cursor = collection.find(
+                {'timings': {'$ne': None}, 'current_status': {'$ne': datamodels.PodStatusEnum.failed.value}},
+                {'_id': 0, 'template_ref': 1, 'timings': 1}
+            )
+            return [document async for document in cursor], None
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return [], errors.db_connection_error
+
     async def list(
             self,
             index_start: int = -1,
             index_end: int = -1,
-            extra_query_filter: Dict[str, Any] = None
+            extra_query_filter: Dict[str, Any] = None,
+            count_all: bool = True
     ) -> Tuple[int, List[datamodels.PodModel], Optional[Exception]]:
         """
-        List pods.
+        List pods. Return the count of all pods (0 unless count_all) and the pods of the range.
         """
 
         try:
             # mongodb collection
             collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
-            num_document = await collection.count_documents({})
+            num_document = await collection.count_documents({}) if count_all else 0
+
+            # read from cursor
+            with log_slow_query(datamodels.pod_collection_name, extra_query_filter):
+                res = [pod async for pod in self.iterate(index_start, index_end, extra_query_filter)]
+            return num_document, res, None
 
-            # assemble query filter
-            _start = 0 if index_start < 0 else index_start
-            _end = num_document if index_end < 0 else index_end
-            query_filter = {} if extra_query_filter is None else extra_query_filter
+        except Exception as e:
+            return 0, [], query_error(e)
 
-            cursor = collection.find(query_filter).sort('name', pymongo.ASCENDING)
+    async def iterate(
+            self,
+            index_start: int = -1,
+            index_end: int = -1,
+            extra_query_filter: Dict[str, Any] = None,
+            batch_size: int = config.CONFIG_STREAM_BATCH_SIZE
+    ) -> AsyncIterator[datamodels.PodModel]:
+        """
+        Iterate over the pods of the range in list order, read from the cursor batch by batch. Raises on database
+        errors, and query_not_indexed if the filter is rejected.
+        """
+        collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
 
-            # read from cursor
-            res = []
-            async for document in cursor:
-                res.append(datamodels.PodModel(**document))
+        # assemble query filter
+        _start = 0 if index_start < 0 else index_start
+        query_filter = {} if extra_query_filter is None else extra_query_filter
 
-            # return sliced result
-            return num_document, res[_start:_end], None
+        # slice on the server, only the pods of the range are read
+        cursor = (await find_guarded(self.db, collection, query_filter, 'name', batch_size)).skip(_start)
+        if index_end >= 0:
+            if index_end <= _start:
+                return
+            cursor = cursor.limit(index_end - _start)
 
-        except Exception as e:
-            logger.error(f"get_collection error: {e}")
-            return 0, [], errors.db_connection_error
+        async for document in cursor:
+            yield datamodels.PodModel(**document)
 
     async def create(self,
                      name: str,
@@ -144,9 +236,12 @@ class PodRepo:
             template_str: Optional[str] = None,  # hidden argument
             current_status_reason: Optional[str] = None,  # hidden argument
             clear_status_reason: bool = False,  # hidden argument: force-clear the reason
+            timings: Optional[Dict[str, int]] = None,  # hidden argument
+            resource_version: Optional[int] = None,
     ) -> Tuple[Optional[datamodels.PodModel], Optional[Exception]]:
         """
-        Update a pod.
+        Update a pod. If resource_version is set, only update the pod if it is still at that version, and return
+        pod_changed otherwise.
         """
         try:
             # mongodb collection
@@ -158,6 +253,9 @@ class PodRepo:
 
             # get pod
             pod = await collection.find_one({'pod_id': pod_id})
+            read_version = pod.get('resource_version')
+            if resource_version is not None and (read_version or 0) != resource_version:
+                return None, errors.pod_changed
 
             # noinspection PyBroadException
             try:
@@ -182,6 +280,7 @@ class PodRepo:
                 pod['accessed_at'] = accessed_at if accessed_at is not None else datetime.datetime.utcnow()  # auto
                 pod['current_status'] = current_status if current_status is not None else pod['current_status']
                 pod['template_str'] = template_str if template_str is not None else pod['template_str']
+                pod['timings'] = timings if timings is not None else pod.get('timings')
 
                 # status reason: settable on failure, clearable on success
                 if clear_status_reason:
@@ -200,6 +299,7 @@ class PodRepo:
                     gpu is not None,
                 ]):
                     pod['resource_status'] = datamodels.ResourceStatusEnum.pending.value
+                pod['resource_version'] = next_resource_version()
 
                 # check if the profile is valid
                 pod_model = datamodels.PodModel(**pod)  # check if the pod model is valid
@@ -208,9 +308,14 @@ class PodRepo:
                 logger.error(f"update pod {pod} wrong profile: {e} ")
                 return None, errors.wrong_pod_profile
 
-            # update pod
-            ret = await collection.find_one_and_replace({'_id': pod['_id']}, pod)
-            if ret is None:
+            # update pod, unless it changed meanwhile
+            query_filter = {'_id': pod['_id']}
+            if resource_version is not None:
+                query_filter['resource_version'] = read_version
+            ret = await collection.find_one_and_replace(query_filter, pod)
+            if ret is None and resource_version is not None:
+                return None, errors.pod_changed
+            elif ret is None:
                 logger.error(f"update pod unknown error: {pod_id}")
                 return None, errors.unknown_error
             else:
@@ -220,6 +325,59 @@ class PodRepo:
             logger.error(f"get_collection error: {e}")
             return None, errors.db_connection_error
 
+    async def fail(self, pod_id: str) -> Tuple[Optional[datamodels.PodModel], Optional[Exception]]:
+        """
+        Set current_status of a pod to failed if it still holds compute, i.e. it was not stopped, failed or deleted
+        meanwhile. Return the pod as it was before, None if it did not hold compute.
+        """
+        try:
+            # mongodb collection
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
+
+            res = await collection.find_one_and_update(
+                {
+                    'pod_id': pod_id,
+                    'target_status': datamodels.PodStatusEnum.running.value,
+                    'current_status': {'$ne': datamodels.PodStatusEnum.failed.value},
+                    'resource_status': {'$ne': datamodels.ResourceStatusEnum.deleted.value},
+                },
+                {'$set': {'current_status': datamodels.PodStatusEnum.failed.value,
+                          'resource_version': next_resource_version()}},
+                return_document=pymongo.ReturnDocument.BEFORE
+            )
+            return (None if res is None else datamodels.PodModel(**res)), None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return None, errors.db_connection_error
+
+    async def touch(self,
+                    usernames: List[str],
+                    pods: List[Tuple[str, str]],
+                    accessed_at: datetime.datetime) -> Optional[Exception]:
+        """
+        Set accessed_at of all running pods owned by the given users, or with the given (username, pod_id) pairs.
+        A pod_id only matches a pod of its username.
+        """
+        try:
+            # mongodb collection
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
+
+            await collection.update_many(
+                {
+                    '$or': [{'username': {'$in': usernames}}] + [
+                        {'pod_id': pod_id, 'username': username} for username, pod_id in pods
+                    ],
+                    'current_status': datamodels.PodStatusEnum.running.value
+                },
+                {'$set': {'accessed_at': accessed_at, 'resource_version': next_resource_version()}}
+            )
+            return None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return errors.db_connection_error
+
     async def delete(self, pod_id: str) -> Tuple[Optional[datamodels.PodModel], Optional[Exception]]:
         """
         Delete a pod. (set resource_status to deleted)
@@ -239,7 +397,7 @@ class PodRepo:
                 # delete pod (set resource_status to deleted)
                 ret = await collection.find_one_and_update(
                     {'pod_id': pod_id},
-                    {'$set': {'resource_status': 'deleted'}})
+                    {'$set': {'resource_status': 'deleted', 'resource_version': next_resource_version()}})
                 if ret is None:
                     return None, errors.unknown_error
                 else:
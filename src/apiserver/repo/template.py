@@ -4,16 +4,18 @@ TemplateRepo is a class that provides methods to access the database for templat
 
 from typing import List, Tuple, Optional, Dict, Any
 
-import pymongo
 from loguru import logger
 
 import src.components.datamodels as datamodels
 from src.components import errors
+from src.components.hlc import next_resource_version
+from src.components.query_guard import log_slow_query, query_error
 from src.components.utils import singleton
-from .db import DBRepo
+from .db import DBRepo, check_query_plan, find_guarded, get_list_version, instrumented
 
 
 @singleton
+@instrumented
 class TemplateRepo:
     def __init__(self, db: DBRepo):
         self.db = db
@@ -23,9 +25,10 @@ class TemplateRepo:
         Commit a template, set its resource_status to committed.
         """
         collection = self.db.get_db_collection(datamodels.database_name, datamodels.template_collection_name)
-        ret = collection.find_one_and_update(
+        ret = await collection.find_one_and_update(
             {"template_id": template_id},
-            {"$set": {"resource_status": datamodels.ResourceStatusEnum.committed.value}}
+            {"$set": {"resource_status": datamodels.ResourceStatusEnum.committed.value,
+                      "resource_version": next_resource_version()}}
         )
         if ret is None:
             logger.error(f"commit error")
@@ -43,6 +46,41 @@ class TemplateRepo:
         else:
             return datamodels.TemplateModel(**res), None
 
+    async def get_version(self, template_id: str) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+        """
+        Get the resource_version and enabled flag of a template by template_id, without reading the document.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.template_collection_name)
+            res = await collection.find_one({'template_id': template_id},
+                                            {'_id': 0, 'resource_version': 1, 'enabled': 1})
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return None, errors.db_connection_error
+        if res is None:
+            return None, errors.template_not_found
+        return res, None
+
+    async def list_version(
+            self,
+            extra_query_filter: Dict[str, Any] = None
+    ) -> Tuple[int, int, int, int, Optional[Exception]]:
+        """
+        Get the max resource_version, version digest and count of the templates matching the filter, and the count of
+        all templates.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.template_collection_name)
+            query_filter = extra_query_filter or {}
+            if self.db.query_explain:
+                await check_query_plan(collection, query_filter)
+            with log_slow_query(datamodels.template_collection_name, query_filter):
+                version, digest, count, total = await get_list_version(collection, query_filter,
+                                                                       max_time_ms=self.db.query_max_time_ms)
+            return version, digest, count, total, None
+        except Exception as e:
+            return 0, 0, 0, 0, query_error(e)
+
     async def list(self,
                    index_start: int = -1,
                    index_end: int = -1,
@@ -62,18 +100,18 @@ class TemplateRepo:
             _end = num_document if index_end < 0 else index_end
             query_filter = {} if extra_query_filter is None else extra_query_filter
 
-            cursor = collection.find(query_filter).sort('template_id', pymongo.ASCENDING)
+            cursor = await find_guarded(self.db, collection, query_filter, 'template_id')
 
             # read from cursor
             res = []
-            async for document in cursor:
-                res.append(datamodels.TemplateModel(**document))
+            with log_slow_query(datamodels.template_collection_name, query_filter):
+                async for document in cursor:
+                    res.append(datamodels.TemplateModel(**document))
 
             # return sliced result
             return num_document, res[_start:_end], None
         except Exception as e:
-            logger.error(f"get_collection error: {e}")
-            return 0, [], errors.db_connection_error
+            return 0, [], query_error(e)
 
     async def create(
             self,
@@ -150,6 +188,7 @@ class TemplateRepo:
                 template['defaults'] = defaults if defaults is not None else template['defaults']
                 template['enabled'] = enabled if enabled is not None else template.get('enabled', True)
                 template['resource_status'] = datamodels.ResourceStatusEnum.pending.value
+                template['resource_version'] = next_resource_version()
 
                 # check if the template model is valid
                 template_model = datamodels.TemplateModel(**template)  # check if the template model is valid
@@ -191,7 +230,7 @@ class TemplateRepo:
                 # delete the template (set resource_status to deleted)
                 ret = await collection.find_one_and_update(
                     {'template_id': template_id},
-                    {'$set': {'resource_status': 'deleted'}})
+                    {'$set': {'resource_status': 'deleted', 'resource_version': next_resource_version()}})
                 if ret is None:
                     return None, errors.unknown_error
                 else:
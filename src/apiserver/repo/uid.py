@@ -0,0 +1,58 @@
+"""
+UidAllocator hands out user ids from blocks leased off the global document.
+
+Leasing a block is one $inc by block_size on the global document, the ids of the block are then handed out
+locally. Ids are unique across workers and increasing within a worker, ids left in a block when the worker
+exits are skipped.
+"""
+
+import asyncio
+import os
+from typing import Optional
+
+import pymongo
+
+import src.components.datamodels as datamodels
+from src.components import config
+from .db import DBRepo
+
+
+class UidAllocator:
+    def __init__(self, db: DBRepo, block_size: int = config.CONFIG_UID_BLOCK_SIZE):
+        self.db = db
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._pid: Optional[int] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def _lease(self) -> None:
+        global_collection = self.db.get_db_collection(datamodels.database_name, datamodels.global_collection_name)
+        global_doc = await global_collection.find_one_and_update(
+            {"_id": "global"},
+            {"$inc": {"uid_counter": self.block_size}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        self._end = global_doc["uid_counter"]
+        self._next = self._end - self.block_size
+        self._pid = os.getpid()
+
+    def _exhausted(self) -> bool:
+        # attention: a block leased before the fork would be shared by all workers
+        return self._next >= self._end or self._pid != os.getpid()
+
+    async def next(self) -> int:
+        """
+        Return the next uid, lease a new block if the current one is exhausted. Raises on database errors.
+        """
+        if self._exhausted():
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                # concurrent callers wait for one lease instead of each leasing a block
+                if self._exhausted():
+                    await self._lease()
+
+        uid = self._next
+        self._next += 1
+        return uid
@@ -0,0 +1,227 @@
+"""
+UsageRepo is a class that provides methods to access the database for per-user resource usage.
+"""
+
+from typing import Tuple, Optional, Dict
+
+import pymongo
+from loguru import logger
+
+import src.components.datamodels as datamodels
+from src.components import errors
+from src.components.utils import singleton
+from .db import DBRepo, instrumented
+
+# usage field -> pod field that is charged to it
+_COMPUTE_FIELDS = {
+    "cpu_m": "$cpu_lim_m_cpu",
+    "memory_mb": "$mem_lim_mb",
+    "gpu": "$gpu",
+}
+
+# aggregation expression mirroring datamodels.PodModel.holds_compute
+_HOLDS_COMPUTE_EXPR = {
+    "$and": [
+        {"$eq": ["$target_status", datamodels.PodStatusEnum.running.value]},
+        {"$ne": ["$current_status", datamodels.PodStatusEnum.failed.value]},
+    ]
+}
+
+
+def usage_of(pod: datamodels.PodModel, holds_compute: Optional[bool] = None) -> Dict[str, int]:
+    """
+    Build the usage charged by a single pod. Storage and the pod slot are charged for the
+    pod's whole life, cpu/mem/gpu only while it holds compute.
+    """
+    holds_compute = pod.holds_compute if holds_compute is None else holds_compute
+    return {
+        "pod_n": 1,
+        "storage_mb": pod.storage_lim_mb,
+        "cpu_m": pod.cpu_lim_m_cpu if holds_compute else 0,
+        "memory_mb": pod.mem_lim_mb if holds_compute else 0,
+        "gpu": pod.gpu if holds_compute else 0,
+    }
+
+
+@singleton
+@instrumented
+class UsageRepo:
+    def __init__(self, db: DBRepo):
+        self.db = db
+
+    async def get(self, username: str) -> Tuple[Optional[datamodels.UsageModel], Optional[Exception]]:
+        """
+        Get the usage of a user.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.usage_collection_name)
+            res = await collection.find_one({'username': username})
+            if res is None:
+                return None, errors.user_not_found
+            else:
+                return datamodels.UsageModel(**res), None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return None, errors.db_connection_error
+
+    async def reserve(self,
+                      username: str,
+                      delta: Dict[str, int],
+                      limits: Optional[Dict[str, int]] = None) -> Optional[Exception]:
+        """
+        Atomically check and reserve resources for a user. The increment is applied only if,
+        for every key in limits with a positive delta, the resulting usage stays within the limit.
+        """
+        delta = {k: v for k, v in delta.items() if v != 0}
+        if len(delta) == 0:
+            return None
+
+        # assemble the admission condition
+        query_filter = {'username': username}
+        if limits is not None:
+            for k, v in delta.items():
+                if v > 0 and k in limits:
+                    query_filter[k] = {"$lte": limits[k] - v}
+
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.usage_collection_name)
+            ret = await collection.update_one(query_filter, {"$inc": delta})
+            if ret.matched_count > 0:
+                return None
+
+            # the condition failed, or the user has no usage document yet (e.g. pods created
+            # before usage was materialized): build it from the pods collection and retry once
+            if await collection.count_documents({'username': username}, limit=1) > 0:
+                return errors.quota_exceeded
+            _, err = await self.recompute(username)
+            if err is not None:
+                return err
+
+            ret = await collection.update_one(query_filter, {"$inc": delta})
+            return None if ret.matched_count > 0 else errors.quota_exceeded
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return errors.db_connection_error
+
+    async def release(self, username: str, delta: Dict[str, int]) -> Optional[Exception]:
+        """
+        Release resources previously reserved for a user.
+        """
+        delta = {k: -v for k, v in delta.items() if v != 0}
+        if len(delta) == 0:
+            return None
+
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.usage_collection_name)
+            await collection.update_one({'username': username}, {"$inc": delta})
+            return None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return errors.db_connection_error
+
+    async def delete(self, username: str) -> Optional[Exception]:
+        """
+        Delete the usage document of a user.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.usage_collection_name)
+            await collection.delete_one({'username': username})
+            return None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return errors.db_connection_error
+
+    async def aggregate(self, username: Optional[str] = None) -> Tuple[Dict[str, Dict[str, int]], Optional[Exception]]:
+        """
+        Compute usage from the pods collection, return a dict of username -> usage.
+        """
+        query_filter = {"resource_status": {"$ne": datamodels.ResourceStatusEnum.deleted.value}}
+        if username is not None:
+            query_filter["username"] = username
+
+        group = {
+            "_id": "$username",
+            "pod_n": {"$sum": 1},
+            "storage_mb": {"$sum": "$storage_lim_mb"},
+        }
+        for k, field in _COMPUTE_FIELDS.items():
+            group[k] = {"$sum": {"$cond": [_HOLDS_COMPUTE_EXPR, {"$ifNull": [field, 0]}, 0]}}
+
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.pod_collection_name)
+            cursor = collection.aggregate([{"$match": query_filter}, {"$group": group}])
+
+            res = {}
+            async for document in cursor:
+                res[document.pop("_id")] = document
+            return res, None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return {}, errors.db_connection_error
+
+    async def recompute(self, username: str) -> Tuple[Optional[datamodels.UsageModel], Optional[Exception]]:
+        """
+        Rebuild the usage document of a single user from the pods collection.
+        """
+        computed, err = await self.aggregate(username)
+        if err is not None:
+            return None, err
+        usage = datamodels.UsageModel(username=username, **computed.get(username, {}))
+
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.usage_collection_name)
+            await collection.update_one({'username': username}, {"$set": usage.model_dump()}, upsert=True)
+            return usage, None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return None, errors.db_connection_error
+
+    async def audit(
+            self,
+            suspects: Dict[str, Dict[str, int]]
+    ) -> Tuple[Dict[str, Dict[str, int]], Optional[Exception]]:
+        """
+        Compare materialized usage against the pods collection. A drifted user is corrected only
+        if the same drift was already reported by the previous pass (passed in as suspects), so
+        reservations in flight during a single pass are never overwritten. Return the drifted users.
+        """
+        computed, err = await self.aggregate()
+        if err is not None:
+            return {}, err
+
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.usage_collection_name)
+            stored = {}
+            async for document in collection.find({}, {'_id': 0}):
+                stored[document['username']] = datamodels.UsageModel(**document)
+
+            # find users whose stored usage differs from the computed one
+            drifted = {}
+            for username in set(stored.keys()) | set(computed.keys()):
+                expected = datamodels.UsageModel(username=username, **computed.get(username, {}))
+                if username not in stored or stored[username] != expected:
+                    drifted[username] = expected.model_dump()
+
+            # correct the drift confirmed by two consecutive passes
+            operations = []
+            for username, expected in drifted.items():
+                if suspects.get(username) == expected:
+                    logger.warning(
+                        f"usage of user {username} drifted: "
+                        f"{stored[username].model_dump() if username in stored else None} -> {expected}"
+                    )
+                    operations.append(pymongo.UpdateOne({'username': username}, {"$set": expected}, upsert=True))
+            if len(operations) > 0:
+                await collection.bulk_write(operations, ordered=False)
+
+            return drifted, None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return {}, errors.db_connection_error
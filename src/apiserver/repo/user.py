@@ -3,31 +3,87 @@ UserRepo is a class that provides methods to access the database for user relate
 """
 
 from hashlib import sha256
-from typing import List, Tuple, Optional, Dict, Any
+from typing import AsyncIterator, List, Tuple, Optional, Dict, Any
 
-import bcrypt
 import pymongo
+import pymongo.errors
 from loguru import logger
 
 import src.components.datamodels as datamodels
-from src.components import errors
+from src.components import config, errors
+from src.components.hlc import next_resource_version
+from src.components.hashing import make_htpasswd_async
+from src.components.query_guard import log_slow_query, query_error
 from src.components.utils import singleton
-from .db import DBRepo
+from .db import DBRepo, check_query_plan, find_guarded, get_list_version, instrumented
+from .uid import UidAllocator
 
 
 @singleton
+@instrumented
 class UserRepo:
     def __init__(self, db: DBRepo):
         self.db = db
+        self.uids = UidAllocator(db)
+
+    async def _next_status_epoch(self) -> int:
+        """
+        Take the next global status epoch, for a user whose status or role changes. An epoch taken but not used
+        leaves a gap, that is harmless.
+        """
+        global_collection = self.db.get_db_collection(datamodels.database_name, datamodels.global_collection_name)
+        global_doc = await global_collection.find_one_and_update(
+            {"_id": "global"},
+            {"$inc": {"status_epoch": 1}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        return global_doc["status_epoch"]
+
+    async def _record_revocation(self, uid: int, epoch: int, active: bool) -> None:
+        """
+        Revoke the tokens of a user issued before epoch. Must only be recorded once the user carries the epoch,
+        otherwise its new tokens are revoked too. Revocations are kept by uid, they outlive a purged user.
+        """
+        revocation_collection = self.db.get_db_collection(datamodels.database_name,
+                                                          datamodels.revocation_collection_name)
+        try:
+            await revocation_collection.update_one(
+                {"uid": uid, "epoch": {"$lt": epoch}},
+                {"$set": {"uid": uid, "epoch": epoch, "active": active}},
+                upsert=True
+            )
+        except pymongo.errors.DuplicateKeyError:
+            pass  # a later change of the user is recorded already
+
+    async def list_revocations(self, since: int) -> Tuple[int, List[Tuple[int, int, bool]], Optional[Exception]]:
+        """
+        Return the epoch read up to and the (uid, epoch, active) revocations newer than since, less a lookback.
+        Epochs are taken before the user write and recorded after it, so concurrent changes may be recorded out of
+        order: the lookback reads the older ones recorded late again, applying a revocation twice is harmless.
+        """
+        try:
+            revocation_collection = self.db.get_db_collection(datamodels.database_name,
+                                                              datamodels.revocation_collection_name)
+            query_filter = {"epoch": {"$gt": since - config.CONFIG_REVOCATION_LOOKBACK_EPOCHS}}
+            changes = [
+                (doc["uid"], doc["epoch"], doc["active"])
+                async for doc in revocation_collection.find(query_filter, {"_id": 0})
+            ]
+            return max([since] + [change[1] for change in changes]), changes, None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return since, [], errors.db_connection_error
 
     async def commit(self, username: str) -> None:
         """
         Commit a user, set its resource_status to committed.
         """
         collection = self.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
-        ret = collection.find_one_and_update(
+        ret = await collection.find_one_and_update(
             {"username": username},
-            {"$set": {"resource_status": datamodels.ResourceStatusEnum.committed.value}}
+            {"$set": {"resource_status": datamodels.ResourceStatusEnum.committed.value,
+                      "resource_version": next_resource_version()}}
         )
         if ret is None:
             raise errors.unknown_error
@@ -45,6 +101,40 @@ class UserRepo:
         else:
             return datamodels.UserModel(**res), None
 
+    async def get_version(self, username: str) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+        """
+        Get the resource_version of a user by username, without reading the document.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
+            res = await collection.find_one({'username': username}, {'_id': 0, 'resource_version': 1})
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return None, errors.db_connection_error
+        if res is None:
+            return None, errors.user_not_found
+        return res, None
+
+    async def list_version(
+            self,
+            extra_query_filter: Dict[str, Any] = None
+    ) -> Tuple[int, int, int, int, Optional[Exception]]:
+        """
+        Get the max resource_version, version digest and count of the users matching the filter, and the count of
+        all users.
+        """
+        try:
+            collection = self.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
+            query_filter = extra_query_filter or {}
+            if self.db.query_explain:
+                await check_query_plan(collection, query_filter)
+            with log_slow_query(datamodels.user_collection_name, query_filter):
+                version, digest, count, total = await get_list_version(collection, query_filter,
+                                                                       max_time_ms=self.db.query_max_time_ms)
+            return version, digest, count, total, None
+        except Exception as e:
+            return 0, 0, 0, 0, query_error(e)
+
     async def list(
             self,
             index_start: int = -1,
@@ -60,23 +150,39 @@ class UserRepo:
             collection = self.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
             num_document = await collection.count_documents({})
 
-            # assemble query filter
-            _start = 0 if index_start < 0 else index_start
-            _end = num_document if index_end < 0 else index_end
-            query_filter = {} if extra_query_filter is None else extra_query_filter
+            # read from cursor
+            with log_slow_query(datamodels.user_collection_name, extra_query_filter):
+                res = [user async for user in self.iterate(index_start, index_end, extra_query_filter)]
+            return num_document, res, None
+        except Exception as e:
+            return 0, [], query_error(e)
 
-            cursor = collection.find(query_filter).sort('uid', pymongo.ASCENDING)
+    async def iterate(
+            self,
+            index_start: int = -1,
+            index_end: int = -1,
+            extra_query_filter: Dict[str, Any] = None,
+            batch_size: int = config.CONFIG_STREAM_BATCH_SIZE
+    ) -> AsyncIterator[datamodels.UserModel]:
+        """
+        Iterate over the users of the range in list order, read from the cursor batch by batch. Raises on database
+        errors, and query_not_indexed if the filter is rejected.
+        """
+        collection = self.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
 
-            # read from cursor
-            res = []
-            async for document in cursor:
-                res.append(datamodels.UserModel(**document))
+        # assemble query filter
+        _start = 0 if index_start < 0 else index_start
+        query_filter = {} if extra_query_filter is None else extra_query_filter
 
-            # return sliced result
-            return num_document, res[_start:_end], None
-        except Exception as e:
-            logger.error(f"get_collection error: {e}")
-            return 0, [], errors.db_connection_error
+        # slice on the server, only the users of the range are read
+        cursor = (await find_guarded(self.db, collection, query_filter, 'uid', batch_size)).skip(_start)
+        if index_end >= 0:
+            if index_end <= _start:
+                return
+            cursor = cursor.limit(index_end - _start)
+
+        async for document in cursor:
+            yield datamodels.UserModel(**document)
 
     async def create(
             self,
@@ -93,20 +199,15 @@ class UserRepo:
         try:
             # mongodb collection
             user_collection = self.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
-            global_collection = self.db.get_db_collection(datamodels.database_name, datamodels.global_collection_name)
 
             # check if username exists
             if await user_collection.count_documents({'username': username}) > 0:
                 return None, errors.duplicate_username
 
-            # calculate uid
-            global_doc = await global_collection.find_one_and_update(
-                {"_id": "global"},
-                {"$inc": {
-                    "uid_counter": 1}})
-            uid = global_doc["uid_counter"]
+            # calculate uid, from the block leased by this worker
+            uid = await self.uids.next()
 
-            # build user model
+            # build user model, hashing off the event loop
             user = datamodels.UserModel.new(
                 uid=uid,
                 username=username,
@@ -114,7 +215,8 @@ class UserRepo:
                 role=datamodels.UserRoleEnum(role),
                 email=email,
                 quota=datamodels.QuotaModel.new(**quota) if quota is not None else None,
-                extra_info=extra_info
+                extra_info=extra_info,
+                htpasswd=await make_htpasswd_async(username, password)
             )
 
             # insert into database
@@ -124,10 +226,65 @@ class UserRepo:
             else:
                 return user, None
 
+        except pymongo.errors.DuplicateKeyError:
+            # lost a race against another create, caught by the unique username index
+            return None, errors.duplicate_username
         except Exception as e:
             logger.error(f"get_collection error: {e}")
             return None, errors.db_connection_error
 
+    async def get_or_create(
+            self,
+            username: str,
+            password: str,
+            email: str,
+            role: str,
+            quota: Dict[str, Any],
+            extra_info: Optional[Dict[str, Any]] = None
+    ) -> Tuple[Optional[datamodels.UserModel], bool, Optional[Exception]]:
+        """
+        Get a user, create it if it does not exist. Returns the user and whether it was created.
+        The insert is an upsert on the unique username, concurrent calls from other workers get the same user.
+        """
+        try:
+            user_collection = self.db.get_db_collection(datamodels.database_name, datamodels.user_collection_name)
+
+            res = await user_collection.find_one({'username': username})
+            if res is not None:
+                return datamodels.UserModel(**res), False, None
+
+            user = datamodels.UserModel.new(
+                uid=await self.uids.next(),
+                username=username,
+                password=password,
+                role=datamodels.UserRoleEnum(role),
+                email=email,
+                quota=datamodels.QuotaModel.new(**quota) if quota is not None else None,
+                extra_info=extra_info,
+                htpasswd=await make_htpasswd_async(username, password)
+            )
+            try:
+                ret = await user_collection.update_one(
+                    {'username': username},
+                    {'$setOnInsert': user.model_dump()},
+                    upsert=True
+                )
+                created = ret.upserted_id is not None
+            except pymongo.errors.DuplicateKeyError:
+                # two upserts raced, the loser reads the winner's user
+                created = False
+
+            if created:
+                return user, True, None
+            res = await user_collection.find_one({'username': username})
+            if res is None:
+                return None, False, errors.user_not_found
+            return datamodels.UserModel(**res), False, None
+
+        except Exception as e:
+            logger.error(f"get_collection error: {e}")
+            return None, False, errors.db_connection_error
+
     async def update(self,
                      username: str,
                      password: Optional[str],
@@ -149,12 +306,13 @@ class UserRepo:
             # get user
             user = await collection.find_one({'username': username})
             old_user_model = datamodels.UserModel(**user)
+            old_resource_version = user.get('resource_version')
 
             # noinspection PyBroadException
             try:
                 user['password'] = sha256(password.encode()).hexdigest() if password is not None else user['password']
-                user['htpasswd'] = f"{username}:" + bcrypt.hashpw(password.encode(), bcrypt.gensalt(
-                    rounds=12)).decode() if password is not None else user['htpasswd']
+                user['htpasswd'] = await make_htpasswd_async(username, password) \
+                    if password is not None else user['htpasswd']
                 user['status'] = status if status is not None else user['status']
                 user['email'] = email if email is not None else user['email']
                 user['role'] = datamodels.UserRoleEnum(role) if role is not None else user['role']
@@ -172,6 +330,7 @@ class UserRepo:
                     password is not None,
                 ]):
                     user['resource_status'] = datamodels.ResourceStatusEnum.pending.value
+                user['resource_version'] = next_resource_version()
 
                 # check if the user model is valid
                 user_model = datamodels.UserModel(**user)  # check if the user model is valid
@@ -180,13 +339,31 @@ class UserRepo:
                 logger.error(f"update user {username} wrong profile: {e}")
                 return None, errors.wrong_user_profile
 
-            # update user
-            ret = await collection.find_one_and_replace({'_id': user['_id']}, user)
+            # if status or role is changed, then the tokens issued before are revoked
+            revoked = user_model.status != old_user_model.status or user_model.role != old_user_model.role
+            if revoked:
+                user['status_epoch'] = user_model.status_epoch = await self._next_status_epoch()
+
+            # update user, unless it changed meanwhile
+            ret = await collection.find_one_and_replace(
+                {'_id': user['_id'], 'resource_version': old_resource_version}, user
+            )
             if ret is None:
                 logger.error(f"update user unknown error: {username}")
                 return None, errors.unknown_error
-            else:
-                return user_model, None
+
+            # revoke once the user carries the new epoch, or put the user back
+            if revoked:
+                try:
+                    await self._record_revocation(user_model.uid, user_model.status_epoch,
+                                                  user_model.status == datamodels.UserStatusEnum.active)
+                except Exception as e:
+                    logger.error(f"update user {username} revocation error: {e}")
+                    await collection.find_one_and_replace(
+                        {'_id': user['_id'], 'resource_version': user['resource_version']}, ret
+                    )
+                    return None, errors.db_connection_error
+            return user_model, None
 
         except Exception as e:
             logger.error(f"get_collection error: {e}")
@@ -210,14 +387,25 @@ class UserRepo:
                 if user.role == datamodels.UserRoleEnum.super_admin:
                     return None, errors.user_not_allowed
 
-                # delete user (set resource_status to deleted)
+                # delete user (set resource_status to deleted), unless it changed meanwhile
+                epoch, resource_version = await self._next_status_epoch(), next_resource_version()
                 ret = await collection.find_one_and_update(
-                    {'username': username},
-                    {'$set': {'resource_status': 'deleted'}})
+                    {'username': username, 'resource_version': res.get('resource_version')},
+                    {'$set': {'resource_status': 'deleted', 'status_epoch': epoch,
+                              'resource_version': resource_version}})
                 if ret is None:
                     return None, errors.unknown_error
-                else:
-                    return user, None
+
+                # revoke its tokens once it carries the new epoch, or put the user back
+                try:
+                    await self._record_revocation(user.uid, epoch, active=False)
+                except Exception as e:
+                    logger.error(f"delete user {username} revocation error: {e}")
+                    await collection.find_one_and_replace(
+                        {'_id': ret['_id'], 'resource_version': resource_version}, ret
+                    )
+                    return None, errors.db_connection_error
+                return user, None
 
         except Exception as e:
             logger.error(f"get_collection error: {e}")
@@ -11,6 +11,7 @@ from sanic import Sanic
 from sanic_jwt import initialize
 
 from src.apiserver.controller import controller_app
+from src.apiserver.controller.admin_debug import bp as admin_debug_bp
 from src.apiserver.controller.admin_pod import bp as admin_pod_bp
 from src.apiserver.controller.admin_template import bp as admin_template_bp
 from src.apiserver.controller.admin_user import bp as admin_user_bp
@@ -20,7 +21,7 @@ from src.apiserver.controller.heartbeat import bp as heartbeat_bp
 from src.apiserver.controller.nonadmin_pod import bp as nonadmin_pod_bp
 from src.apiserver.controller.nonadmin_template import bp as nonadmin_template_bp
 from src.apiserver.controller.nonadmin_user import bp as nonadmin_user_bp
-from src.apiserver.repo import DBRepo, UserRepo, TemplateRepo, PodRepo
+from src.apiserver.repo import DBRepo, UserRepo, TemplateRepo, PodRepo, UsageRepo
 from src.apiserver.service import RootService
 from src.apiserver.service.service import new_root_service
 from src.components.authn import (
@@ -32,8 +33,15 @@ from src.components.authn import (
     retrieve_refresh_token
 )
 from src.components.config import APIServerConfig
-from src.components.tasks import check_and_create_admin_user, check_kubernetes_connection  # check_rabbitmq_connection
+from src.components.tasks import (
+    check_and_create_admin_user,
+    check_and_create_indexes,
+    migrate_password_less_users,
+    check_kubernetes_connection,
+)  # check_rabbitmq_connection
+from src.components.revocation import RevocationTable
 from src.components.utils import get_k8s_client
+from src.components.validator import DeviceTokenValidator
 
 _service: RootService
 
@@ -75,6 +83,18 @@ def apiserver_prepare_run(opt: APIServerConfig) -> Sanic:
         logger.error(f"task check_and_create_admin_user failed: {err}")
         exit(1)
 
+    # create indexes the repos rely on
+    err = check_and_create_indexes(opt)
+    if err is not None:
+        logger.error(f"task check_and_create_indexes failed: {err}")
+        exit(1)
+
+    # lock the password-less accounts hashed from the empty password
+    err = migrate_password_less_users(opt)
+    if err is not None:
+        logger.error(f"task migrate_password_less_users failed: {err}")
+        exit(1)
+
     # check Kubernetes connection
     err = check_kubernetes_connection(opt)
     if err is not None:
@@ -100,6 +120,7 @@ def apiserver_prepare_run(opt: APIServerConfig) -> Sanic:
     )
 
     # attach Blueprint to context
+    controller_app.blueprint(admin_debug_bp)
     controller_app.blueprint(admin_pod_bp)
     controller_app.blueprint(admin_template_bp)
     controller_app.blueprint(admin_user_bp)
@@ -107,7 +128,8 @@ def apiserver_prepare_run(opt: APIServerConfig) -> Sanic:
     if opt.config_use_oidc:
         controller_app.blueprint(auth_oidc_bp)
         controller_app.ctx.oauth_cfg = OAuth2Config.from_apiserver_config(opt)
-        controller_app.ctx.oauth_client = controller_app.ctx.oauth_cfg.get_async_client()
+        # attention: the http client holds a connection pool, each worker creates its own after the fork
+        controller_app.ctx.oauth_client = None
     controller_app.blueprint(nonadmin_user_bp)
     controller_app.blueprint(nonadmin_template_bp)
     controller_app.blueprint(nonadmin_pod_bp)
@@ -117,6 +139,17 @@ def apiserver_prepare_run(opt: APIServerConfig) -> Sanic:
     controller_app.config.update({'JWT_SECRET': controller_app.ctx.auth.config.secret._value})
     controller_app.config.update({'JWT_ALGORITHM': controller_app.ctx.auth.config.algorithm._value})
 
+    # revoked tokens, refreshed by each worker, and the verified-token cache of the auth-url validator
+    controller_app.ctx.revocations = RevocationTable()
+    controller_app.ctx.token_validator = DeviceTokenValidator(
+        controller_app.config.get('JWT_SECRET'),
+        controller_app.config.get('JWT_ALGORITHM'),
+        revocations=controller_app.ctx.revocations
+    )
+
+    # websocket pings are sent by the heartbeat hub, disable sanic's per-connection keepalive task
+    controller_app.config.update({'WEBSOCKET_PING_INTERVAL': None})
+
     # create services
     repo = DBRepo(opt.to_sanic_config())
     _ = new_root_service(
@@ -124,6 +157,7 @@ def apiserver_prepare_run(opt: APIServerConfig) -> Sanic:
         UserRepo(repo),
         TemplateRepo(repo),
         PodRepo(repo),
+        UsageRepo(repo),
         get_k8s_client(opt.k8s_host, opt.k8s_port, opt.k8s_ca_cert, opt.k8s_token, opt.k8s_verify_ssl, opt.debug)
     )
 
@@ -42,7 +42,8 @@ class AuthService(ServiceInterface):
             'iat': now,
             'email': user.email,
             'role': user.role,
-            'uid': user.uid
+            'uid': user.uid,
+            'epoch': user.status_epoch
         }
 
     async def basic(self, auth_header: str, username: str = None) -> bool:
@@ -66,6 +67,10 @@ class AuthService(ServiceInterface):
         ]):
             return False
 
+        # password-less accounts (e.g. OIDC users) cannot log in with a password, not even an empty one
+        if user.htpasswd is None:
+            return False
+
         # check password
         if user.verify_password(input_password):
             return True
@@ -82,6 +87,10 @@ class AuthService(ServiceInterface):
         if err is not None:
             return None, err
 
+        # password-less accounts (e.g. OIDC users) have no htpasswd to sign with
+        if user.htpasswd is None:
+            return None, errors.wrong_password
+
         # check password
         if user.verify_password(cred.password):
             # generate jwt
@@ -121,7 +130,8 @@ class AuthService(ServiceInterface):
             if any([
                 err is not None,
                 user is not None and user.status != UserStatusEnum.active,
-                user is not None and user.uid != unverified_jwt.get('uid')
+                user is not None and user.uid != unverified_jwt.get('uid'),
+                user is not None and user.htpasswd is None
             ]):
                 return None, errors.user_not_found
         except Exception as e:
@@ -145,25 +155,6 @@ class AuthService(ServiceInterface):
 
         return access_token, None
 
-    async def jwt_token_rotate(self, payload, secret: str, duration: datetime.timedelta):
-        """
-        This method rotates jwt token, new token is signed with secret and will have duration = exp - iat
-        """
-        now = datetime.datetime.utcnow()
-        try:
-            new_payload = {
-                'username': payload['username'],
-                'exp': now + duration,
-                'iat': now,
-                'email': payload['email'],
-                'role': payload['role'],
-                'uid': payload['uid']
-            }
-        except Exception as e:
-            return None, e
-        access_token = jwt.encode(new_payload, secret, algorithm=self.algorithm)
-        return access_token, None
-
 
 from sanic_ext import openapi
 
@@ -2,10 +2,45 @@
 This module describes the interface of a service.
 """
 
+import json
 from abc import ABCMeta
-from typing import Optional, Any
+from typing import Optional, Any, Dict, Tuple
 
+from loguru import logger
+
+from src.components import errors
 from src.components.config import APIServerConfig
+from src.components.query_guard import check_query_filter
+
+
+def parse_query_filter(extra_query_filter: str,
+                       collection_name: str) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+    """
+    Build the query filter of a list request from its json string, and check it against the fields and operators
+    clients may use on the collection
+    """
+    if extra_query_filter == "":
+        return {}, None
+    try:
+        query_filter = json.loads(extra_query_filter)
+    except json.JSONDecodeError:
+        logger.error(f"extra_query_filter_str is not a valid json string: {extra_query_filter}")
+        return None, errors.wrong_query_filter
+    err = check_query_filter(collection_name, query_filter)
+    if err is not None:
+        return None, err
+    return query_filter, None
+
+
+def merge_query_filter(query_filter: Dict[str, Any], extra_query_filter: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Combine the query filter of a list request with a filter set by the server
+    """
+    if extra_query_filter is None:
+        return query_filter
+    if len(query_filter) == 0:
+        return extra_query_filter
+    return {'$and': [query_filter, extra_query_filter]}
 
 
 class ServiceInterface(metaclass=ABCMeta):
@@ -4,12 +4,15 @@ This module contains the event handlers for the apiserver service.
 
 import asyncio
 import datetime
+import time
 from typing import Optional, Union
 
 from loguru import logger
 from pydantic import BaseModel
 
 import src.apiserver.service
+from src.apiserver.repo.usage import usage_of
+from src.components import metrics
 from src.components.datamodels import UserStatusEnum, ResourceStatusEnum, PodStatusEnum
 from src.components.events import (
     TemplateCreateEvent, TemplateUpdateEvent, TemplateDeleteEvent,
@@ -21,6 +24,7 @@ from src.components.resources import K8SIngressResource
 from src.components.utils import render_template_str
 
 
+@metrics.tracked("template_create")
 async def handle_template_create_event(srv: Optional['src.apiserver.service.RootService'],
                                        ev: Union[TemplateCreateEvent, BaseModel]) -> Optional[Exception]:
     """
@@ -36,6 +40,7 @@ async def handle_template_create_event(srv: Optional['src.apiserver.service.Root
         return err
 
 
+@metrics.tracked("template_update")
 async def handle_template_update_event(srv: Optional['src.apiserver.service.RootService'],
                                        ev: Union[TemplateUpdateEvent, BaseModel]) -> Optional[Exception]:
     """
@@ -51,6 +56,7 @@ async def handle_template_update_event(srv: Optional['src.apiserver.service.Root
         return err
 
 
+@metrics.tracked("template_delete")
 async def handle_template_delete_event(srv: Optional['src.apiserver.service.RootService'],
                                        ev: Union[TemplateDeleteEvent, BaseModel]) -> Optional[Exception]:
     """
@@ -66,6 +72,7 @@ async def handle_template_delete_event(srv: Optional['src.apiserver.service.Root
         return err
 
 
+@metrics.tracked("user_create")
 async def handle_user_create_event(srv: Optional['src.apiserver.service.RootService'],
                                    ev: Union[UserCreateEvent, BaseModel]) -> Optional[Exception]:
     """
@@ -84,7 +91,7 @@ async def handle_user_create_event(srv: Optional['src.apiserver.service.RootServ
         # create k8s credentials
         err = await srv.k8s_operator_service.create_or_update_user_credentials(
             str(user.uuid),
-            user.htpasswd.get_secret_value().encode()
+            user.htpasswd_entry
         )
 
         if err is not None:
@@ -101,6 +108,7 @@ async def handle_user_create_event(srv: Optional['src.apiserver.service.RootServ
     return None
 
 
+@metrics.tracked("user_update")
 async def handle_user_update_event(srv: Optional['src.apiserver.service.RootService'],
                                    ev: Union[UserUpdateEvent, BaseModel]) -> Optional[Exception]:
     """
@@ -118,7 +126,7 @@ async def handle_user_update_event(srv: Optional['src.apiserver.service.RootServ
         # update k8s credentials
         err = await srv.k8s_operator_service.create_or_update_user_credentials(
             str(user.uuid),
-            user.htpasswd.get_secret_value().encode()
+            user.htpasswd_entry
         )
 
         if err is not None:
@@ -135,6 +143,7 @@ async def handle_user_update_event(srv: Optional['src.apiserver.service.RootServ
     return None
 
 
+@metrics.tracked("user_delete")
 async def handle_user_delete_event(srv: Optional['src.apiserver.service.RootService'],
                                    ev: Union[UserDeleteEvent, BaseModel]) -> Optional[Exception]:
     """
@@ -177,6 +186,12 @@ async def handle_user_delete_event(srv: Optional['src.apiserver.service.RootServ
                 logger.error(f"handle_user_delete_event failed to delete pod {pod.pod_id}: {err}")
                 return err
 
+        # drop the user's usage document
+        err = await srv.pod_service.usage_repo.delete(ev.username)
+        if err is not None:
+            logger.error(f"handle_user_delete_event failed to delete usage of user {ev.username}: {err}")
+            return err
+
         # finally, purge user
         _, err = await srv.user_service.repo.purge(ev.username)
         if err is not None:
@@ -186,11 +201,13 @@ async def handle_user_delete_event(srv: Optional['src.apiserver.service.RootServ
             return err
 
 
+@metrics.tracked("pod_create_update")
 async def handle_pod_create_update_event(srv: Optional['src.apiserver.service.RootService'],
                                          ev: Union[PodCreateUpdateEvent, BaseModel]) -> Optional[Exception]:
     """
     Handle pod create/update event
     """
+    timer = metrics.PhaseTimer("pod_create_update")
 
     # check user's validity
     user, err = await srv.user_service.repo.get(ev.username)
@@ -212,7 +229,8 @@ async def handle_pod_create_update_event(srv: Optional['src.apiserver.service.Ro
         return err
 
     # get template
-    template, err = await srv.template_service.repo.get(str(pod.template_ref))
+    with timer.phase("template_fetch"):
+        template, err = await srv.template_service.repo.get(str(pod.template_ref))
     if err is not None:
         logger.warning(f"handle_pod_create_update_event failed to get template {pod.template_ref}: {err}, "
                        f"fallback to cached template")
@@ -220,14 +238,16 @@ async def handle_pod_create_update_event(srv: Optional['src.apiserver.service.Ro
             logger.error("handle_pod_create_update_event failed to retrieve template")
             return err
         else:
-            kv = pod.values
-            rendered_template_str, _, err = render_template_str(pod.template_str, kv)
-            original_template_str = pod.template_str
+            with timer.phase("render"):
+                kv = pod.values
+                rendered_template_str, _, err = render_template_str(pod.template_str, kv)
+                original_template_str = pod.template_str
     else:
         # render template
-        kv = pod.values | template.values
-        rendered_template_str, _, err = render_template_str(template.template_str, kv)
-        original_template_str, _, _ = render_template_str(template.template_str, template.values)
+        with timer.phase("render"):
+            kv = pod.values | template.values
+            rendered_template_str, _, err = render_template_str(template.template_str, kv)
+            original_template_str, _, _ = render_template_str(template.template_str, template.values)
 
     if err is not None:
         logger.error(f"handle_pod_create_update_event failed to parse template {pod.template_ref}: {err}")
@@ -238,25 +258,30 @@ async def handle_pod_create_update_event(srv: Optional['src.apiserver.service.Ro
     # are removed before the new manifest is applied.
     if pod.template_str is not None and pod.template_str != "" and pod.template_str != original_template_str:
         logger.info(f"template changed for pod {pod.pod_id}, cleaning up non-PVC resources")
-        err = await srv.k8s_operator_service.delete_pod_except_pvc(pod.pod_id)
+        with timer.phase("cleanup"):
+            err = await srv.k8s_operator_service.delete_pod_except_pvc(pod.pod_id)
         if err is not None:
             logger.error(f"handle_pod_create_update_event failed to clean up old resources for pod {pod.pod_id}: {err}")
             return err
 
     # create pod ingress
     ingress_resource = K8SIngressResource.new(pod, srv.opt)
-    err = await srv.k8s_operator_service.create_apply_ingress(ingress_resource)
+    with timer.phase("ingress"):
+        err = await srv.k8s_operator_service.create_apply_ingress(ingress_resource)
     if err is not None:
         logger.error(f"handle_pod_create_update_event failed to create pod {pod.pod_id}: {err}")
         return err
 
     # create pod on k8s
-    err = await srv.k8s_operator_service.create_or_update_pod(pod.pod_id, rendered_template_str)
+    applied_at = time.time()
+    with timer.phase("apply"):
+        err = await srv.k8s_operator_service.create_or_update_pod(pod.pod_id, rendered_template_str)
     if err is not None:
         logger.error(f"handle_pod_create_update_event failed to create pod {pod.pod_id}: {err}")
         return err
 
-    reason, err = await srv.k8s_operator_service.wait_pod(pod.pod_id, pod.target_status)
+    with timer.phase("wait"):
+        reason, err = await srv.k8s_operator_service.wait_pod(pod.pod_id, pod.target_status)
     if err is not None:
         logger.error(
             f"handle_pod_create_update_event failed to wait pod {pod.pod_id}: {err} ({reason})"
@@ -265,13 +290,35 @@ async def handle_pod_create_update_event(srv: Optional['src.apiserver.service.Ro
     else:
         pod_current_status = pod.target_status
 
+    # break the wait down from the timestamps of the K8s Pod, failed starts included, and keep the timings of the
+    # last start on the pod: stopping a pod keeps them
+    timings = None
+    if pod.target_status == PodStatusEnum.running:
+        for phase, seconds in (await srv.k8s_operator_service.get_pod_start_timings(pod.pod_id, applied_at)).items():
+            timer.record(phase, seconds)
+        timings = timer.total()
+        logger.info(f"pod {pod.pod_id} {pod_current_status.value} after {timings['total']}ms: {timings}")
+
+    # a failed pod no longer holds compute, give it back to the user. The wait can take minutes: a stop or delete
+    # meanwhile already gave it back, so release only what the pod held when it was marked failed
+    if pod_current_status == PodStatusEnum.failed:
+        held_pod, err = await srv.pod_service.repo.fail(pod.pod_id)
+        if err is not None:
+            logger.error(f"handle_pod_create_update_event failed to mark pod {pod.pod_id} failed: {err}")
+        elif held_pod is not None:
+            held, idle = usage_of(held_pod), usage_of(held_pod, holds_compute=False)
+            err = await srv.pod_service.usage_repo.release(held_pod.username,
+                                                           {k: held[k] - idle[k] for k in held.keys()})
+            if err is not None:
+                logger.error(f"handle_pod_create_update_event failed to release usage of pod {pod.pod_id}: {err}")
+
     # Update pod's status. We always overwrite `current_status_reason`:
     # - when the pod failed with a known reason, store it
     # - otherwise (success, or failed-without-a-reason), clear any stale value
     # so a previous failure can never linger and confuse the user.
     should_set_reason = pod_current_status == PodStatusEnum.failed and reason
     _now = datetime.datetime.utcnow()
-    _, err = await srv.pod_service.repo.update(
+    updated_pod, err = await srv.pod_service.repo.update(
         pod_id=pod.pod_id,
         started_at=_now,
         accessed_at=_now,
@@ -279,10 +326,17 @@ async def handle_pod_create_update_event(srv: Optional['src.apiserver.service.Ro
         template_str=original_template_str,
         current_status_reason=reason if should_set_reason else None,
         clear_status_reason=not should_set_reason,
+        timings=timings,
     )
     if err is not None:
         logger.error(f"handle_pod_create_update_event failed to update pod {pod.pod_id}: {err}")
         return err
+    srv.pod_service.publish_status(updated_pod)
+
+    # successful starts only, a failed start would skew the latency of its template
+    if timings is not None and pod_current_status == PodStatusEnum.running:
+        for phase, ms in timings.items():
+            metrics.POD_START_PHASE_DURATION.observe(ms / 1000, str(pod.template_ref), phase)
 
     # finally commit
     err = await srv.pod_service.repo.commit(ev.pod_id)
@@ -293,6 +347,7 @@ async def handle_pod_create_update_event(srv: Optional['src.apiserver.service.Ro
         return err
 
 
+@metrics.tracked("pod_delete")
 async def handle_pod_delete_event(srv: Optional['src.apiserver.service.RootService'],
                                   ev: Union[PodDeleteEvent, BaseModel]) -> Optional[Exception]:
     """
@@ -300,7 +355,8 @@ async def handle_pod_delete_event(srv: Optional['src.apiserver.service.RootServi
     """
 
     # delete pod and ingress from cluster
-    err = await srv.k8s_operator_service.delete_pod(ev.pod_id)
+    with metrics.RECONCILE_PHASE_DURATION.time("pod_delete", "delete"):
+        err = await srv.k8s_operator_service.delete_pod(ev.pod_id)
     if err is not None:
         logger.error(f"handle_pod_delete_event failed to delete pod {ev.pod_id}: {err}")
         return err
@@ -318,5 +374,5 @@ async def handle_user_heartbeat_event(srv: Optional['src.apiserver.service.RootS
                                       ev: Union[UserHeartbeatEvent, BaseModel]) -> Optional[Exception]:
     err = await srv.heartbeat_service.ping(ev.username)
     if err is not None:
-        logger.error(f"handle_user_heartbeat_event failed to list pods: {err}")
+        logger.error(f"handle_user_heartbeat_event failed to record heartbeat: {err}")
         return err
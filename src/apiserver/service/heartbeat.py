@@ -2,29 +2,45 @@
 Heartbeat service
 """
 
-import asyncio
 import datetime
-from typing import Dict, Optional
+from typing import Optional, Set, Tuple
 
 from .common import ServiceInterface
 
 
 class HeartbeatService(ServiceInterface):
+    """
+    Heartbeats are buffered in memory and written behind: a user with several open connections,
+    or a pod serving many requests, is touched once, and everything buffered is flushed with a
+    single write per interval.
+    """
+
     def __init__(self):
         super().__init__()
-        self._db: Dict[str, datetime.datetime] = {}
+        self._pending_usernames: Set[str] = set()
+        self._pending_pods: Set[Tuple[str, str]] = set()  # (username, pod_id)
 
     async def ping(self, username: str) -> Optional[Exception]:
-        srv = self.parent
-        # list pods
-        _, pods, err = await srv.pod_service.repo.list(extra_query_filter={"$and": [
-            {'username': username},
-            {'current_status': 'running'}
-        ]})
-        if err is not None:
-            return err
-
-        # update running pod.access_at owned by current user
-        tasks = [srv.pod_service.repo.update(pod_id=pod.pod_id) for pod in pods]
-        await asyncio.gather(*tasks)
+        # record the user, running pods are touched on the next flush
+        self._pending_usernames.add(username)
         return None
+
+    def touch_pod(self, username: str, pod_id: str) -> None:
+        # record the pod of the user, called on the auth hot path so it must not do any I/O
+        self._pending_pods.add((username, pod_id))
+
+    async def flush(self) -> Optional[Exception]:
+        if len(self._pending_usernames) == 0 and len(self._pending_pods) == 0:
+            return None
+
+        # swap the buffers so that pings arriving during the write go to the next flush
+        usernames, self._pending_usernames = self._pending_usernames, set()
+        pods, self._pending_pods = self._pending_pods, set()
+
+        # update running pod.access_at owned by buffered users or accessed directly by their owner
+        err = await self.parent.pod_service.repo.touch(list(usernames), list(pods), datetime.datetime.utcnow())
+        if err is not None:
+            # retry on next flush
+            self._pending_usernames |= usernames
+            self._pending_pods |= pods
+        return err
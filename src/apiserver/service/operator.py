@@ -5,7 +5,7 @@ import asyncio
 import base64
 import io
 import time
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import kubernetes
 import yaml
@@ -13,13 +13,14 @@ from kubernetes import client
 from kubernetes.client import ApiException
 from loguru import logger
 
-from src.components import errors
+from src.components import errors, metrics
 from src.components.config import (
     CONFIG_K8S_CREDENTIAL_FMT,
     CONFIG_K8S_POD_LABEL_FMT,
     CONFIG_K8S_POD_LABEL_KEY,
     CONFIG_K8S_NAMESPACE,
-    CONFIG_K8S_SERVICE_FMT, CONFIG_K8S_DEPLOYMENT_FMT
+    CONFIG_K8S_SERVICE_FMT, CONFIG_K8S_DEPLOYMENT_FMT,
+    CONFIG_POD_TIMINGS_MAX_SKEW_S
 )
 # Reasons we surface verbatim to the user; anything else is summarized generically.
 _K8S_USER_VISIBLE_WAITING_REASONS = {
@@ -35,6 +36,14 @@ from src.components.resources import K8SIngressResource
 from .common import ServiceInterface
 
 
+def _timed_k8s_call(kind: str, verb: str, fn):
+    def wrapper(*args, **kwargs):
+        with metrics.K8S_REQUEST_DURATION.time(kind, verb):
+            return fn(*args, **kwargs)
+
+    return wrapper
+
+
 class K8SOperatorService(ServiceInterface):
 
     def __init__(self, c: Optional[client], namespace: str = CONFIG_K8S_NAMESPACE):
@@ -76,16 +85,21 @@ class K8SOperatorService(ServiceInterface):
                 'list': self.v1.list_namespaced_persistent_volume_claim,
             },  # TODO: add more resources
         }
+        self._resource_function_map = {
+            kind: {verb: _timed_k8s_call(kind, verb, fn) for verb, fn in functions.items()}
+            for kind, functions in self._resource_function_map.items()
+        }
 
     async def is_secret_exists(self, secret_name: str) -> Tuple[Optional[bool], Optional[Exception]]:
         """
         Check if a secret exists in the cluster
         """
         try:
-            ret = self.v1.read_namespaced_secret(
-                secret_name,
-                self.namespace
-            )
+            with metrics.K8S_REQUEST_DURATION.time("Secret", "get"):
+                ret = self.v1.read_namespaced_secret(
+                    secret_name,
+                    self.namespace
+                )
             if ret is not None:
                 return True, None
             else:
@@ -262,10 +276,11 @@ class K8SOperatorService(ServiceInterface):
         while True:
             try:
                 # check the status of deployment
-                ret = self.app_v1.read_namespaced_deployment_status(
-                    CONFIG_K8S_DEPLOYMENT_FMT.format(pod_id),
-                    self.namespace
-                )
+                with metrics.K8S_REQUEST_DURATION.time("Deployment", "status"):
+                    ret = self.app_v1.read_namespaced_deployment_status(
+                        CONFIG_K8S_DEPLOYMENT_FMT.format(pod_id),
+                        self.namespace
+                    )
 
                 # check if the status is the target status
                 _current_status = PodStatusEnum.from_k8s_status(ret.status)
@@ -303,10 +318,11 @@ class K8SOperatorService(ServiceInterface):
         """
         try:
             pod_label = CONFIG_K8S_POD_LABEL_FMT.format(pod_id)
-            ret = self.v1.list_namespaced_pod(
-                self.namespace,
-                label_selector=f"{CONFIG_K8S_POD_LABEL_KEY}={pod_label}",
-            )
+            with metrics.K8S_REQUEST_DURATION.time("Pod", "list"):
+                ret = self.v1.list_namespaced_pod(
+                    self.namespace,
+                    label_selector=f"{CONFIG_K8S_POD_LABEL_KEY}={pod_label}",
+                )
         except ApiException as e:
             logger.warning(f"failed to list pods for failure-reason lookup: {e}")
             return None
@@ -333,6 +349,59 @@ class K8SOperatorService(ServiceInterface):
 
         return None
 
+    async def get_pod_start_timings(self, pod_id: str, since: float) -> Dict[str, float]:
+        """
+        Break down the start of the newest K8s Pod of this deployment, in
+        seconds, from the timestamps K8s recorded:
+
+        - ``scheduling`` — from the creation of the Pod until it is bound to a node
+        - ``image_pull`` — until its last container started; this also covers
+          init containers and mounting volumes
+        - ``readiness`` — until the Pod is ready, i.e. its probes pass
+
+        Returns an empty dict when the newest Pod was created before ``since``
+        (a timestamp, give or take the clock skew between us and K8s), i.e.
+        nothing was started, or when the Pods cannot be listed.
+        """
+        try:
+            pod_label = CONFIG_K8S_POD_LABEL_FMT.format(pod_id)
+            with metrics.K8S_REQUEST_DURATION.time("Pod", "list"):
+                ret = self.v1.list_namespaced_pod(
+                    self.namespace,
+                    label_selector=f"{CONFIG_K8S_POD_LABEL_KEY}={pod_label}",
+                )
+        except Exception as e:
+            logger.warning(f"failed to list pods for start timings: {e}")
+            return {}
+
+        pods = [
+            p for p in (ret.items or [])
+            if p.metadata is not None and p.metadata.creation_timestamp is not None and p.status is not None
+        ]
+        if len(pods) == 0:
+            return {}
+        p = max(pods, key=lambda x: x.metadata.creation_timestamp)
+        created_at = p.metadata.creation_timestamp
+        if created_at.timestamp() < since - CONFIG_POD_TIMINGS_MAX_SKEW_S:
+            return {}
+
+        conditions = {c.type: c.last_transition_time for c in (p.status.conditions or []) if c.status == "True"}
+        started = [
+            cs.state.running.started_at for cs in (p.status.container_statuses or [])
+            if cs.state is not None and cs.state.running is not None and cs.state.running.started_at is not None
+        ]
+        timings, last = {}, created_at
+        for phase, at in (
+                ("scheduling", conditions.get("PodScheduled")),
+                ("image_pull", max(started) if len(started) > 0 else None),
+                ("readiness", conditions.get("Ready")),
+        ):
+            if at is None:
+                break
+            timings[phase] = max((at - last).total_seconds(), 0.)
+            last = at
+        return timings
+
     @staticmethod
     def _format_reason(reason: Optional[str], message: Optional[str]) -> str:
         reason = (reason or "").strip()
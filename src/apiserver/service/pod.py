@@ -1,91 +1,48 @@
 """
 Pod service
 """
-from enum import Enum
-import json
-from typing import Tuple, Union
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-from loguru import logger
 from sanic import Sanic
 
 from src.apiserver.controller.types import *
-from src.apiserver.repo import PodRepo
-from src.components import datamodels, errors
-from src.components.events import PodCreateUpdateEvent, PodDeleteEvent
-from .common import ServiceInterface
+from src.apiserver.repo import PodRepo, UsageRepo
+from src.apiserver.repo.usage import usage_of
+from src.components import config, datamodels, errors
+from src.components.events import PodCreateUpdateEvent, PodDeleteEvent, PodStatusEvent
+from src.components.hlc import version_span
+from src.components.watch import PodWatchHub
+from .common import ServiceInterface, merge_query_filter, parse_query_filter
 from .handler import handle_pod_create_update_event, handle_pod_delete_event
 
 
-class ModeEnum(str, Enum):
-    create = "create"
-    update = "update"
+def _percentile(values: List[int], q: int) -> int:
+    """
+    The q-th percentile of values, by the nearest-rank method
+    """
+    values = sorted(values)
+    return values[max(-(-len(values) * q // 100) - 1, 0)]
 
 
 class PodService(ServiceInterface):
-    def __init__(self, pod_repo: PodRepo):
+    def __init__(self, pod_repo: PodRepo, usage_repo: UsageRepo):
         super().__init__()
         self.repo: PodRepo = pod_repo
+        self.usage_repo: UsageRepo = usage_repo
+        self.watch = PodWatchHub(
+            queue_size=config.CONFIG_WATCH_QUEUE_SIZE,
+            backlog_size=config.CONFIG_WATCH_BACKLOG_SIZE,
+            lookback=version_span(config.CONFIG_WATCH_LOOKBACK_S),
+        )
 
     @staticmethod
-    def check_quota(
-            user: datamodels.UserModel,
-            pods: List[datamodels.PodModel],
-            req: Union[PodCreateRequest, PodUpdateRequest],
-            mode: ModeEnum
-    ) -> bool:
+    def quota_limits(user: datamodels.UserModel, *keys: str) -> Optional[Dict[str, int]]:
+        """
+        Build the usage limits enforced by UsageRepo.reserve from the user's quota.
+        """
         if user.quota is None:
-            return True
-
-        if mode == ModeEnum.create:
-            # Create mode: only check pod count and storage (total across all pods)
-            # CPU/mem/GPU checks are deferred to when the pod is started (update to running)
-            num_pods = len(pods) + 1
-            storage_mb = sum([pod.storage_lim_mb for pod in pods]) + req.storage_lim_mb
-
-            if any([
-                num_pods > user.quota.pod_n,
-                storage_mb > user.quota.storage_mb,
-            ]):
-                return False
-            return True
-
-        elif mode == ModeEnum.update:
-            # Exclude the pod being updated from totals; we'll add the requested values back in.
-            other_pods = [p for p in pods if p.pod_id != req.pod_id]
-
-            req_cpu = req.cpu_lim_m_cpu if req.cpu_lim_m_cpu is not None else 0
-            req_mem = req.mem_lim_mb if req.mem_lim_mb is not None else 0
-            req_storage = req.storage_lim_mb if req.storage_lim_mb is not None else 0
-            req_gpu = req.gpu if req.gpu is not None else 0
-
-            # Storage and pod count are charged whether or not the pod is running.
-            storage_mb = sum([p.storage_lim_mb for p in other_pods]) + req_storage
-            if storage_mb > user.quota.storage_mb:
-                return False
-
-            # When the pod is not being started, cpu/mem/gpu are not consumed.
-            if req.target_status != datamodels.PodStatusEnum.running:
-                return True
-
-            # Starting (or already running): count this pod's requested resources
-            # together with the resources held by other currently-running pods.
-            other_running_pods = [
-                p for p in other_pods if p.current_status == datamodels.PodStatusEnum.running
-            ]
-            cpu_m = sum([p.cpu_lim_m_cpu for p in other_running_pods]) + req_cpu
-            mem_mb = sum([p.mem_lim_mb for p in other_running_pods]) + req_mem
-            gpu = sum([p.gpu for p in other_running_pods]) + req_gpu
-
-            if any([
-                cpu_m > user.quota.cpu_m,
-                mem_mb > user.quota.memory_mb,
-                gpu > user.quota.gpu,
-            ]):
-                return False
-            return True
-
-        else:
-            return False
+            return None
+        return {k: getattr(user.quota, k) for k in keys}
 
     async def get(self,
                   app: Sanic,
@@ -98,23 +55,103 @@ class PodService(ServiceInterface):
 
     async def list(self,
                    app: Sanic,
-                   req: PodListRequest) -> Tuple[int, List[datamodels.PodModel], Optional[Exception]]:
+                   req: PodListRequest,
+                   extra_query_filter: Optional[Dict[str, Any]] = None,
+                   count_all: bool = True) -> Tuple[int, List[datamodels.PodModel], Optional[Exception]]:
         """
-        List pods.
+        List pods. extra_query_filter is combined with the filter of the request, the count of all pods is only
+        returned if count_all.
         """
 
         # build query filter from json string
-        if req.extra_query_filter != "":
-            try:
-                query_filter = json.loads(req.extra_query_filter)
-            except json.JSONDecodeError:
-                logger.error(f"extra_query_filter_str is not a valid json string: {req.extra_query_filter}")
-                return 0, [], errors.wrong_query_filter
-        else:
-            query_filter = {}
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.pod_collection_name)
+        if err is not None:
+            return 0, [], err
+        query_filter = merge_query_filter(query_filter, extra_query_filter)
         return await self.repo.list(index_start=req.index_start,
                                     index_end=req.index_end,
-                                    extra_query_filter=query_filter)
+                                    extra_query_filter=query_filter,
+                                    count_all=count_all)
+
+    def iterate(self,
+                app: Sanic,
+                req: PodListRequest) -> Tuple[Optional[AsyncIterator[datamodels.PodModel]], Optional[Exception]]:
+        """
+        Iterate over the pods a list request returns, without reading them all at once. The iterator raises on
+        database errors.
+        """
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.pod_collection_name)
+        if err is not None:
+            return None, err
+        return self.repo.iterate(index_start=req.index_start,
+                                 index_end=req.index_end,
+                                 extra_query_filter=query_filter), None
+
+    async def get_version(self,
+                          app: Sanic,
+                          req: PodGetRequest) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+        """
+        Get the resource_version of a pod, to answer conditional requests without reading it.
+        """
+        return await self.repo.get_version(pod_id=req.pod_id)
+
+    async def list_version(self,
+                           app: Sanic,
+                           req: PodListRequest,
+                           extra_query_filter: Optional[Dict[str, Any]] = None,
+                           count_all: bool = True
+                           ) -> Tuple[int, int, int, int, Optional[Exception]]:
+        """
+        Get the max resource_version, version digest and count of the pods a list request returns, and the count
+        of all pods (0 unless count_all). extra_query_filter is combined with the filter of the request.
+        """
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.pod_collection_name)
+        if err is not None:
+            return 0, 0, 0, 0, err
+        query_filter = merge_query_filter(query_filter, extra_query_filter)
+        return await self.repo.list_version(extra_query_filter=query_filter, count_all=count_all)
+
+    async def list_status(self,
+                          app: Sanic,
+                          since: int,
+                          username: Optional[str] = None) -> Tuple[List[PodStatusEvent], Optional[Exception]]:
+        """
+        List the status of the pods written after version since, of one user or of all users.
+        """
+        query_filter = None if username is None else {'username': username}
+        return await self.repo.list_status(since, extra_query_filter=query_filter)
+
+    async def summarize_timings(self, app: Sanic) -> Tuple[List[PodTimingsSummaryModel], Optional[Exception]]:
+        """
+        Summarize the timings of the last start of the pods by template: the p50 and p95 of each phase.
+        """
+        documents, err = await self.repo.list_timings()
+        if err is not None:
+            return [], err
+
+        by_template: Dict[str, Dict[str, List[int]]] = {}
+        pods: Dict[str, int] = {}
+        for document in documents:
+            template_ref = str(document['template_ref'])
+            pods[template_ref] = pods.get(template_ref, 0) + 1
+            phases = by_template.setdefault(template_ref, {})
+            for phase, ms in document['timings'].items():
+                phases.setdefault(phase, []).append(ms)
+
+        return [
+            PodTimingsSummaryModel(
+                template_ref=template_ref,
+                pods=pods[template_ref],
+                p50_ms={phase: _percentile(values, 50) for phase, values in phases.items()},
+                p95_ms={phase: _percentile(values, 95) for phase, values in phases.items()},
+            ) for template_ref, phases in sorted(by_template.items())
+        ], None
+
+    def publish_status(self, pod: datamodels.PodModel) -> None:
+        """
+        Deliver the status of pod to the watchers of this process, without waiting for the next poll.
+        """
+        self.watch.publish(PodStatusEvent(**pod.model_dump(include=set(PodStatusEvent.model_fields.keys()))))
 
     async def create(self,
                      app: Sanic,
@@ -134,13 +171,18 @@ class PodService(ServiceInterface):
         ]):
             return None, errors.user_not_found
 
-        # list all pods of the user
-        _, pods, err = await self.parent.pod_service.repo.list(extra_query_filter={"username": req.username})
-
-        # check if user has reached the quota
-        ret = self.check_quota(user, pods, req, mode=ModeEnum.create)
-        if not ret:
-            return None, errors.quota_exceeded
+        # reserve the pod slot and storage. A new pod starts right away, so its cpu/mem/gpu are
+        # charged as well, but only checked against the quota when the pod is (re)started
+        usage = {
+            "pod_n": 1,
+            "storage_mb": req.storage_lim_mb,
+            "cpu_m": req.cpu_lim_m_cpu,
+            "memory_mb": req.mem_lim_mb,
+            "gpu": req.gpu,
+        }
+        err = await self.usage_repo.reserve(req.username, usage, self.quota_limits(user, "pod_n", "storage_mb"))
+        if err is not None:
+            return None, err
 
         pod, err = await self.repo.create(
             name=req.name,
@@ -156,7 +198,7 @@ class PodService(ServiceInterface):
             values=req.values,
         )
 
-        # if success, trigger pod create event
+        # if success, trigger pod create event, otherwise give the reservation back
         if err is None:
             await app.add_task(
                 handle_pod_create_update_event(
@@ -164,6 +206,8 @@ class PodService(ServiceInterface):
                     PodCreateUpdateEvent(pod_id=pod.pod_id, username=pod.username)
                 )
             )
+        else:
+            _ = await self.usage_repo.release(req.username, usage)
 
         return pod, err
 
@@ -189,9 +233,6 @@ class PodService(ServiceInterface):
         else:
             req.user_uuid = str(user.uuid)
 
-        # list all pods of the user
-        _, pods, err = await self.parent.pod_service.repo.list(extra_query_filter={"username": req.username})
-
         # Validate and resolve template_ref switch.
         if req.template_ref is not None and req.template_ref != str(old_pod.template_ref):
             if old_pod.current_status != datamodels.PodStatusEnum.stopped:
@@ -228,11 +269,35 @@ class PodService(ServiceInterface):
         req.storage_lim_mb = old_pod.storage_lim_mb
         req.gpu = effective_gpu
 
+        # Restarting a failed pod clears the failure so that it holds compute again.
+        current_status = None
+        if req.target_status == datamodels.PodStatusEnum.running and \
+                old_pod.current_status == datamodels.PodStatusEnum.failed:
+            current_status = datamodels.PodStatusEnum.pending
+
         # Enforce the user's quota using the effective spec (covers both spec edits
         # and start-the-pod requests so a user can never exceed their allowance).
-        ret = self.check_quota(user, pods, req, mode=ModeEnum.update)
-        if not ret:
-            return None, errors.quota_exceeded
+        # The check and the reservation are a single conditional update on the usage document.
+        # The reservation is computed from old_pod, so the pod is only written if it is still at that version.
+        old_usage = usage_of(old_pod)
+        new_usage = usage_of(old_pod.model_copy(update={
+            "cpu_lim_m_cpu": effective_cpu,
+            "mem_lim_mb": effective_mem,
+            "gpu": effective_gpu,
+            "target_status": req.target_status if req.target_status is not None else old_pod.target_status,
+            "current_status": current_status if current_status is not None else old_pod.current_status,
+        }))
+        if req.username == old_pod.username:
+            reserved = {k: new_usage[k] - old_usage[k] for k in new_usage.keys()}
+            released = {}
+        else:
+            reserved, released = new_usage, old_usage
+        if any(reserved.values()):
+            err = await self.usage_repo.reserve(
+                req.username, reserved, self.quota_limits(user, *reserved.keys())
+            )
+            if err is not None:
+                return None, err
 
         pod, err = await self.repo.update(
             pod_id=req.pod_id,
@@ -247,8 +312,17 @@ class PodService(ServiceInterface):
             mem_lim_mb=effective_mem if spec_requested else None,
             storage_lim_mb=None,
             gpu=effective_gpu if spec_requested else None,
+            current_status=current_status,
+            resource_version=old_pod.resource_version,
         )
 
+        # keep usage in line with the outcome of the update
+        if err is not None:
+            if any(reserved.values()):
+                _ = await self.usage_repo.release(req.username, reserved)
+        elif any(released.values()):
+            _ = await self.usage_repo.release(old_pod.username, released)
+
         # if success and target_status is pending, trigger pod create event
         if err is None and pod.resource_status == datamodels.ResourceStatusEnum.pending:
             await app.add_task(
@@ -269,8 +343,10 @@ class PodService(ServiceInterface):
 
         pod, err = await self.repo.delete(pod_id=req.pod_id)
 
-        # if success, trigger pod delete event
+        # if success, release its usage and trigger pod delete event
         if err is None:
+            if pod.resource_status != datamodels.ResourceStatusEnum.deleted:
+                _ = await self.usage_repo.release(pod.username, usage_of(pod))
             await app.add_task(
                 handle_pod_delete_event(self.parent, PodDeleteEvent(pod_id=pod.pod_id, username=pod.username))
             )
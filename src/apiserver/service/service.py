@@ -7,7 +7,7 @@ from typing import Optional
 
 from kubernetes import client
 
-from src.apiserver.repo import UserRepo, TemplateRepo, PodRepo
+from src.apiserver.repo import UserRepo, TemplateRepo, PodRepo, UsageRepo
 from src.components.config import APIServerConfig
 from .auth import AuthService
 from .common import RootServiceInterface
@@ -55,6 +55,7 @@ def new_root_service(opt: APIServerConfig,
                      user_repo: UserRepo,
                      template_repo: TemplateRepo,
                      pod_repo: PodRepo,
+                     usage_repo: UsageRepo,
                      k8s_client: Optional[client] = None):
     global _service
     _service = RootService(
@@ -62,7 +63,7 @@ def new_root_service(opt: APIServerConfig,
         auth_service=AuthService(user_repo),
         user_service=UserService(user_repo),
         template_service=TemplateService(template_repo),
-        pod_service=PodService(pod_repo),
+        pod_service=PodService(pod_repo, usage_repo),
         k8s_operator_service=K8SOperatorService(k8s_client, opt.k8s_namespace),
         heartbeat_service=HeartbeatService(),
     )
@@ -2,17 +2,15 @@
 Template service
 """
 
-import json
-from typing import Tuple
+from typing import Any, Dict, Optional, Tuple
 
-from loguru import logger
 from sanic import Sanic
 
 from src.apiserver.controller.types import *
 from src.apiserver.repo import TemplateRepo
-from src.components import datamodels, errors
+from src.components import datamodels
 from src.components.events import TemplateCreateEvent, TemplateUpdateEvent, TemplateDeleteEvent
-from .common import ServiceInterface
+from .common import ServiceInterface, merge_query_filter, parse_query_filter
 from .handler import handle_template_create_event, handle_template_update_event, handle_template_delete_event
 
 
@@ -31,24 +29,42 @@ class TemplateService(ServiceInterface):
 
     async def list(self,
                    app: Sanic,
-                   req: UserListRequest) -> Tuple[int, List[datamodels.TemplateModel], Optional[Exception]]:
+                   req: TemplateListRequest) -> Tuple[int, List[datamodels.TemplateModel], Optional[Exception]]:
         """
         List templates.
         """
 
         # build query filter from json string
-        if req.extra_query_filter != "":
-            try:
-                query_filter = json.loads(req.extra_query_filter)
-            except json.JSONDecodeError:
-                logger.error(f"extra_query_filter_str is not a valid json string: {req.extra_query_filter}")
-                return 0, [], errors.wrong_query_filter
-        else:
-            query_filter = {}
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.template_collection_name)
+        if err is not None:
+            return 0, [], err
         return await self.repo.list(index_start=req.index_start,
                                     index_end=req.index_end,
                                     extra_query_filter=query_filter)
 
+    async def get_version(self,
+                          app: Sanic,
+                          req: TemplateGetRequest) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+        """
+        Get the resource_version of a template, to answer conditional requests without reading it.
+        """
+        return await self.repo.get_version(template_id=req.template_id)
+
+    async def list_version(self,
+                           app: Sanic,
+                           req: TemplateListRequest,
+                           extra_query_filter: Optional[Dict[str, Any]] = None
+                           ) -> Tuple[int, int, int, int, Optional[Exception]]:
+        """
+        Get the max resource_version, version digest and count of the templates a list request returns, and the
+        count of all templates. extra_query_filter is combined with the filter of the request.
+        """
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.template_collection_name)
+        if err is not None:
+            return 0, 0, 0, 0, err
+        query_filter = merge_query_filter(query_filter, extra_query_filter)
+        return await self.repo.list_version(extra_query_filter=query_filter)
+
     async def create(self,
                      app: Sanic,
                      req: TemplateCreateRequest) -> Tuple[datamodels.TemplateModel, Optional[Exception]]:
@@ -2,17 +2,16 @@
 User service
 """
 
-import json
-from typing import Tuple
+import asyncio
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
 
-from loguru import logger
 from sanic import Sanic
 
 from src.apiserver.controller.types import *
 from src.apiserver.repo import UserRepo
-from src.components import datamodels, errors
+from src.components import config, datamodels, errors
 from src.components.events import UserCreateEvent, UserUpdateEvent, UserDeleteEvent
-from .common import ServiceInterface
+from .common import ServiceInterface, merge_query_filter, parse_query_filter
 from .handler import handle_user_create_event, handle_user_update_event, handle_user_delete_event
 
 
@@ -38,18 +37,50 @@ class UserService(ServiceInterface):
         """
 
         # build query filter from json string
-        if req.extra_query_filter != "":
-            try:
-                query_filter = json.loads(req.extra_query_filter)
-            except json.JSONDecodeError:
-                logger.error(f"extra_query_filter_str is not a valid json string: {req.extra_query_filter}")
-                return 0, [], errors.wrong_query_filter
-        else:
-            query_filter = {}
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.user_collection_name)
+        if err is not None:
+            return 0, [], err
         return await self.repo.list(index_start=req.index_start,
                                     index_end=req.index_end,
                                     extra_query_filter=query_filter)
 
+    def iterate(self,
+                app: Sanic,
+                req: UserListRequest) -> Tuple[Optional[AsyncIterator[datamodels.UserModel]], Optional[Exception]]:
+        """
+        Iterate over the users a list request returns, without reading them all at once. The iterator raises on
+        database errors.
+        """
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.user_collection_name)
+        if err is not None:
+            return None, err
+        return self.repo.iterate(index_start=req.index_start,
+                                 index_end=req.index_end,
+                                 extra_query_filter=query_filter), None
+
+    async def get_version(self,
+                          app: Sanic,
+                          req: UserGetRequest) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+        """
+        Get the resource_version of a user, to answer conditional requests without reading it.
+        """
+        return await self.repo.get_version(username=req.username)
+
+    async def list_version(self,
+                           app: Sanic,
+                           req: UserListRequest,
+                           extra_query_filter: Optional[Dict[str, Any]] = None
+                           ) -> Tuple[int, int, int, int, Optional[Exception]]:
+        """
+        Get the max resource_version, version digest and count of the users a list request returns, and the count
+        of all users. extra_query_filter is combined with the filter of the request.
+        """
+        query_filter, err = parse_query_filter(req.extra_query_filter, datamodels.user_collection_name)
+        if err is not None:
+            return 0, 0, 0, 0, err
+        query_filter = merge_query_filter(query_filter, extra_query_filter)
+        return await self.repo.list_version(extra_query_filter=query_filter)
+
     async def create(self,
                      app: Sanic,
                      req: UserCreateRequest) -> Tuple[datamodels.UserModel, Optional[Exception]]:
@@ -68,6 +99,28 @@ class UserService(ServiceInterface):
             await app.add_task(handle_user_create_event(self.parent, UserCreateEvent(username=user.username)))
         return user, err
 
+    async def create_many(self,
+                          app: Sanic,
+                          req: UserBatchCreateRequest) -> Tuple[List[datamodels.UserModel], Dict[str, Exception]]:
+        """
+        Create many users concurrently, as many at once as passwords are hashed in parallel.
+        """
+        semaphore = asyncio.Semaphore(config.CONFIG_HASH_POOL_SIZE)
+
+        async def _create(user_req: UserCreateRequest) -> Tuple[Optional[datamodels.UserModel], Optional[Exception]]:
+            async with semaphore:
+                return await self.create(app, user_req)
+
+        results = await asyncio.gather(*[_create(user_req) for user_req in req.users])
+
+        users, failed = [], {}
+        for user_req, (user, err) in zip(req.users, results):
+            if err is not None:
+                failed[user_req.username] = err
+            else:
+                users.append(user)
+        return users, failed
+
     async def update(self,
                      app: Sanic,
                      req: UserUpdateRequest) -> Tuple[Optional[datamodels.UserModel], Optional[Exception]]:
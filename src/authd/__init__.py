@@ -0,0 +1 @@
+from .server import authd_prepare_run, authd_check_option
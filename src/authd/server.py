@@ -0,0 +1,103 @@
+"""
+authd serves the auth-url of the workspace ingress, nothing else. It only needs the token secret:
+no MongoDB or Kubernetes client, no openapi, so it starts fast and can run as many small replicas.
+"""
+import base64
+import http
+
+from loguru import logger
+from sanic import Sanic
+from sanic.response import json as json_response
+
+from src.components import config
+from src.components.config import APIServerConfig
+from src.components.utils import parse_basic
+from src.components.validator import DeviceTokenValidator, handle_token_validate
+
+authd_app = Sanic("clpl_authd")
+
+# attention: sanic loads sanic-ext when it is installed, which is what authd avoids
+authd_app.config.update({'AUTO_EXTEND': False})
+
+
+def _basic_response(status: http.HTTPStatus):
+    return json_response(
+        body={'description': '', 'status': status.value, 'message': status.phrase.upper()},
+        headers={'WWW-Authenticate': "Basic realm=Auth Required"},
+        status=status
+    )
+
+
+@authd_app.get("/v1/auth/token/validate/<username:str>", name="token_validate_user")
+async def token_validate(request, username: str):
+    """
+    Same as the apiserver's token_validate, without recording pod activity
+    """
+    return await handle_token_validate(request,
+                                       username,
+                                       request.app.ctx.token_validator,
+                                       cache_duration_s=request.app.ctx.opt.config_auth_cache_duration_s)
+
+
+async def basic(request, username: str = None):
+    """
+    Basic auth for any user, or for a specific user
+    """
+    if request.headers.authorization is None:
+        return _basic_response(http.HTTPStatus.UNAUTHORIZED)
+    username_password, err = parse_basic(request.headers.authorization)
+    if err is not None:
+        return _basic_response(http.HTTPStatus.UNAUTHORIZED)
+    input_username, input_password = username_password
+
+    # if username is not None, check if username is the same as input_username
+    if username is not None and username != input_username:
+        return _basic_response(http.HTTPStatus.UNAUTHORIZED)
+
+    from src.components.datamodels import UserStatusEnum
+    user, err = await request.app.ctx.user_repo.get(input_username)
+    if err is not None or user is None:
+        return _basic_response(http.HTTPStatus.UNAUTHORIZED)
+
+    # password-less accounts (e.g. OIDC users) cannot log in with a password, not even an empty one
+    if any([
+        user.status != UserStatusEnum.active,
+        user.htpasswd is None,
+    ]):
+        return _basic_response(http.HTTPStatus.UNAUTHORIZED)
+
+    # check password
+    if not user.verify_password(input_password):
+        return _basic_response(http.HTTPStatus.UNAUTHORIZED)
+
+    return _basic_response(http.HTTPStatus.OK)
+
+
+def authd_check_option(opt: APIServerConfig) -> APIServerConfig:
+    """
+    Check options, the token secret must be the one of the apiserver
+    """
+    if opt.config_token_secret is None or len(opt.config_token_secret) == 0:
+        logger.error("token secret is not set, authd cannot verify tokens issued by the apiserver")
+        exit(1)
+
+    # attention: same transformation as apiserver_check_option, sanic-jwt signs with the encoded secret
+    opt.config_token_secret = base64.encodebytes(opt.config_token_secret.encode('utf-8'))
+    return opt
+
+
+def authd_prepare_run(opt: APIServerConfig) -> Sanic:
+    """
+    Prepare to run authd
+    """
+    authd_app.ctx.opt = opt
+    authd_app.ctx.token_validator = DeviceTokenValidator(opt.config_token_secret, config.CONFIG_JWT_ALGORITHM)
+
+    # basic auth has to look up users, only then the database is needed
+    if opt.authd_basic_auth:
+        from src.apiserver.repo import DBRepo, UserRepo
+        authd_app.ctx.user_repo = UserRepo(DBRepo(opt.to_sanic_config()))
+        authd_app.add_route(basic, "/v1/auth/basic", name="basic")
+        authd_app.add_route(basic, "/v1/auth/basic/<username:str>", name="basic_user")
+
+    return authd_app
@@ -3,16 +3,38 @@ Authentication module
 """
 import base64
 import secrets
+from typing import Optional, Tuple
 
 from loguru import logger
 from sanic import request, response
 from sanic_jwt import Configuration, Responses, exceptions, Authentication
 
+import src.components.config as config
 import src.components.datamodels as datamodels
 import src.components.errors as errors
+from src.components.authz import get_jwt_payload
 from src.apiserver.service import get_root_service
 
 
+async def get_user(req: request.Request) -> Tuple[Optional[datamodels.UserModel], Optional[Exception]]:
+    """
+    Get the user of the request's token, read from the database at most once per request
+    """
+    if hasattr(req.ctx, 'user_model'):
+        return req.ctx.user_model, None
+
+    payload, err = get_jwt_payload(req)
+    if err is not None:
+        return None, err
+
+    user, err = await get_root_service().user_service.repo.get(payload.get('username'))
+    if err is not None:
+        return None, err
+
+    req.ctx.user_model = user
+    return user, None
+
+
 async def authenticate(req: request.Request):
     """
     Authenticate user by username and password
@@ -64,6 +86,11 @@ class MyJWTConfig(Configuration):
     # are recommended
     secret = base64.encodebytes(secrets.token_bytes(32))
 
+    # -------------- algorithm -------------------------
+    # [Description] Signing algorithm, authd verifies tokens with the same one
+    # [Default] 'HS256'
+    algorithm = config.CONFIG_JWT_ALGORITHM
+
     # -------------- expiration_delta ----------------------
     # [Description] Expiration time, in seconds
     # [Default] 30 minutes, that is: 60 * 30
@@ -97,6 +124,35 @@ class MyJWTConfig(Configuration):
 
 
 class MyJWTAuthentication(Authentication):
+    async def _verify(self,
+                      req,
+                      return_payload=False,
+                      verify=True,
+                      raise_missing=False,
+                      request_args=None,
+                      request_kwargs=None,
+                      *args,
+                      **kwargs):
+        """
+        Reuse the payload verified by authz.get_jwt_payload, so that @protected() and @validate_role()
+        verify the token only once. Unverified reads and failures go through sanic-jwt, for its error reasons.
+        """
+        if verify:
+            payload, err = get_jwt_payload(req)
+            if err is None:
+                return payload if return_payload else (True, 200, None)
+            if err is errors.token_revoked:
+                return None if return_payload else (False, 401, [str(err)])
+
+        return await super()._verify(req,
+                                     return_payload=return_payload,
+                                     verify=verify,
+                                     raise_missing=raise_missing,
+                                     request_args=request_args,
+                                     request_kwargs=request_kwargs,
+                                     *args,
+                                     **kwargs)
+
     async def retrieve_user(self, req, **kwargs):
         """
         Parse the user information from the payload, and then return the found user
@@ -104,7 +160,12 @@ class MyJWTAuthentication(Authentication):
         user_id_attribute = self.config.user_id()
         if 'payload' in kwargs.keys():
             user_id = kwargs['payload'].get(user_id_attribute)
-            user, err = await get_root_service().user_service.repo.get(user_id)
+            payload, err = get_jwt_payload(req)
+            if err is None and payload.get(user_id_attribute) == user_id:
+                user, err = await get_user(req)
+            else:
+                # e.g. the refresh endpoint, which reads the payload of an expired token
+                user, err = await get_root_service().user_service.repo.get(user_id)
             if err is not None or user.status not in [datamodels.UserStatusEnum.active]:
                 raise exceptions.AuthenticationFailed(str(err))
             else:
@@ -122,7 +183,7 @@ class MyJWTAuthentication(Authentication):
         user_id_attribute = self.config.user_id()  # should be 'username'
         user_id = payload.get(user_id_attribute)  # username of user
         user, _ = await get_root_service().user_service.repo.get(user_id)  # get user from database
-        payload.update({'email': user.email, 'role': user.role, 'uid': user.uid})  # For example, add gender attribute
+        payload.update({'email': user.email, 'role': user.role, 'uid': user.uid, 'epoch': user.status_epoch})
         return payload
 
     async def extract_payload(self, req, verify=True, *args, **kwargs):
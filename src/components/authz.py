@@ -4,15 +4,49 @@ Authorization Decorator
 
 import http
 from functools import wraps
-from typing import Iterable, Optional
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 import jwt
 from loguru import logger
 from sanic.response import json as json_response
 
+from src.components import errors
 from src.components.utils import parse_bearer
 
 
+def get_jwt_payload(request) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+    """
+    Verify the bearer token of the request and return its payload. The token is verified once per request,
+    the result is kept on request.ctx for @protected() and @validate_role() alike.
+    Tokens of users that were deactivated, deleted or changed role since are rejected, see RevocationTable.
+    """
+    if hasattr(request.ctx, 'jwt_payload'):
+        return request.ctx.jwt_payload, request.ctx.jwt_error
+
+    try:
+        # header: Authorization: Bearer <jwt>s
+        token, err = parse_bearer(request.headers.get('Authorization'))
+        if err is not None:
+            raise err
+
+        # decode the jwt and check the signature
+        payload = jwt.decode(
+            token,
+            request.app.config.get('JWT_SECRET'),
+            algorithms=request.app.config.get('JWT_ALGORITHM')
+        )
+        revocations = getattr(request.app.ctx, 'revocations', None)
+        if revocations is not None and revocations.is_revoked(payload):
+            raise errors.token_revoked
+    except Exception as e:
+        # logging the error
+        logger.debug(str(e))
+        payload, err = None, e
+
+    request.ctx.jwt_payload, request.ctx.jwt_error = payload, err
+    return payload, err
+
+
 def validate_role(role: Optional[Iterable[str]] = None):
     """
     Authenticate User by JWT
@@ -27,27 +61,13 @@ def validate_role(role: Optional[Iterable[str]] = None):
         @wraps(f)
         async def decorated_function(request, *args, **kwargs):
 
-            try:
-                # header: Authorization: Bearer <jwt>s
-                token, err = parse_bearer(request.headers.get('Authorization'))
-                if err is not None:
-                    raise err
-
-                # decode the jwt and check the signature
-                payload = jwt.decode(
-                    token,
-                    request.app.config.get('JWT_SECRET'),
-                    algorithms=request.app.config.get('JWT_ALGORITHM')
-                )
-
-            except Exception as e:
-                # logging the error
-                logger.debug(str(e))
+            payload, err = get_jwt_payload(request)
+            if err is not None:
                 return json_response(
                     {
                         'description': '',
                         'status': http.HTTPStatus.UNAUTHORIZED,
-                        'message': str(e)
+                        'message': str(err)
                     },
                     http.HTTPStatus.UNAUTHORIZED
                 )
@@ -0,0 +1,80 @@
+"""
+This module contains in-process caches.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar('V')
+
+
+class TTLCache(Generic[V]):
+    """
+    Bounded LRU cache whose entries carry their own expiry (a time.time() timestamp).
+    Not thread-safe, meant to be used from the event loop of a single worker.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: 'OrderedDict[Hashable, Tuple[float, V]]' = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, now: Optional[float] = None) -> Optional[V]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= (time.time() if now is None else now):
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value: V, expires_at: float) -> None:
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Optional[V]:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key into one: the first caller runs the coroutine, the others
+    await its result. Nothing is cached once the call is done.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def start(self, key: Hashable, fn: Callable[[], Awaitable[V]]) -> 'asyncio.Task[V]':
+        """
+        Start the call if none is in flight, without waiting for it
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        return task
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[V]]) -> V:
+        # attention: a cancelled caller must not cancel the call the others are waiting on
+        return await asyncio.shield(self.start(key, fn))
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
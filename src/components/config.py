@@ -5,6 +5,7 @@ Configuration Component
 import argparse
 import os
 import os.path as osp
+import tempfile
 from typing import List, Any, Tuple, Optional, Dict
 
 import yaml
@@ -39,6 +40,8 @@ CONFIG_AUTH_COOKIES_NAME = "clpl_auth_token"
 CONFIG_PROXY_ORIGIN_URL_HEADER = "x-original-url"
 CONFIG_LOG_PATH_KEY = CONFIG_PROJECT_NAME.upper() + "_LOG_PATH"
 CONFIG_LOG_PATH_DEFAULT = "./logs/apiserver"
+CONFIG_METRICS_DIR_KEY = CONFIG_PROJECT_NAME.upper() + "_METRICS_DIR"
+CONFIG_METRICS_DIR_DEFAULT = osp.join(tempfile.gettempdir(), f"{CONFIG_PROJECT_NAME}-metrics")
 CONFIG_DEFAULT_CONFIG_SEARCH_PATH = osp.join(CONFIG_HOME_PATH, ".config", CONFIG_PROJECT_NAME)
 CONFIG_DEFAULT_CONFIG_PATH = osp.join(CONFIG_DEFAULT_CONFIG_SEARCH_PATH, f"{CONFIG_CONFIG_NAME}.yaml")
 CONFIG_EVENT_QUEUE_NAME = "clpl_event_queue"
@@ -46,6 +49,8 @@ CONFIG_GLOBAL_COLLECTION_NAME = "clpl_global"
 CONFIG_USER_COLLECTION_NAME = "clpl_users"
 CONFIG_POD_COLLECTION_NAME = "clpl_pods"
 CONFIG_TEMPLATE_COLLECTION_NAME = "clpl_templates"
+CONFIG_USAGE_COLLECTION_NAME = "clpl_usages"
+CONFIG_REVOCATION_COLLECTION_NAME = "clpl_revocations"
 CONFIG_K8S_CREDENTIAL_FMT = "{}-basic-auth"
 CONFIG_K8S_DEPLOYMENT_FMT = "clpl-{}"
 CONFIG_K8S_POD_LABEL_FMT = "apps.clpl-{}"
@@ -53,11 +58,57 @@ CONFIG_K8S_POD_LABEL_KEY = "k8s-app"
 CONFIG_K8S_SERVICE_FMT = "clpl-svc-{}"
 CONFIG_K8S_NAMESPACE = "clpl"
 CONFIG_SCAN_POD_INTERVAL_S = 120
+CONFIG_AUDIT_USAGE_INTERVAL_S = 600
 CONFIG_HEARTBEAT_INTERVAL_S = 120
+CONFIG_HEARTBEAT_FLUSH_INTERVAL_S = 30
+CONFIG_HEARTBEAT_WHEEL_SLOTS = 60
 CONFIG_SHUTDOWN_GRACE_PERIOD_S = 60
 
 CONFIG_DEVICE_TOKEN_EXPIRE_S = 7 * 24 * 60 * 60
 CONFIG_DEVICE_TOKEN_RENEW_THRESHOLD_S = 6 * 24 * 60 * 60
+CONFIG_TOKEN_CACHE_SIZE = 10000
+CONFIG_JWT_ALGORITHM = "HS256"
+CONFIG_BCRYPT_ROUNDS = 12
+CONFIG_HASH_POOL_SIZE = os.cpu_count() or 1
+CONFIG_REVOCATION_POLL_INTERVAL_S = 2
+CONFIG_REVOCATION_LOOKBACK_EPOCHS = 256  # more than the status changes in flight at once
+CONFIG_UID_BLOCK_SIZE = 32
+CONFIG_JWKS_DEFAULT_TTL_S = 300
+CONFIG_JWKS_MAX_TTL_S = 24 * 60 * 60
+CONFIG_JWKS_MIN_REFETCH_INTERVAL_S = 30
+CONFIG_JWKS_NEGATIVE_TTL_S = 60
+CONFIG_OIDC_HTTP_MAX_CONNECTIONS = 100
+CONFIG_OIDC_HTTP_MAX_KEEPALIVE_CONNECTIONS = 20
+CONFIG_OIDC_HTTP_KEEPALIVE_EXPIRY_S = 30
+CONFIG_OIDC_HTTP_TIMEOUT_S = 10
+CONFIG_OIDC_HTTP_CONNECT_TIMEOUT_S = 5
+CONFIG_WATCH_QUEUE_SIZE = 256
+CONFIG_WATCH_BACKLOG_SIZE = 1024
+CONFIG_WATCH_POLL_INTERVAL_S = 1
+CONFIG_WATCH_LOOKBACK_S = 2
+CONFIG_WATCH_KEEPALIVE_S = 15
+CONFIG_WATCH_RETRY_MS = 3000
+CONFIG_STREAM_BATCH_SIZE = 500
+CONFIG_STREAM_CHUNK_SIZE = 64 * 1024
+CONFIG_QUERY_MAX_DEPTH = 4
+CONFIG_QUERY_MAX_IN = 100
+CONFIG_QUERY_SLOW_MS = 200
+CONFIG_QUERY_EXPLAIN_MIN_DOCS = 10000
+CONFIG_QUERY_PLAN_CACHE_SIZE = 256
+CONFIG_DB_REPEATED_COMMANDS_WARN = 5
+CONFIG_METRICS_FLUSH_INTERVAL_S = 5
+CONFIG_METRICS_STALE_S = 30
+CONFIG_METRICS_LOOP_LAG_INTERVAL_S = 0.5
+CONFIG_POD_TIMINGS_MAX_SKEW_S = 5
+CONFIG_STALL_SAMPLE_INTERVAL_S = 0.01
+CONFIG_STALL_CHECK_INTERVAL_S = 0.1
+CONFIG_STALL_STACK_DEPTH = 20
+CONFIG_PROFILE_MAX_S = 50  # the response must be sent before sanic's RESPONSE_TIMEOUT, 60s by default
+CONFIG_PROFILE_SAMPLE_INTERVAL_S = 0.005
+CONFIG_PROFILE_TOP_N = 20
+CONFIG_PROFILE_MAX_TOP_N = 100
+CONFIG_PROFILE_POLL_INTERVAL_S = 0.5
+CONFIG_PROFILE_BROADCAST_GRACE_S = 3
 
 
 class APIServerConfig(BaseModel):
@@ -67,6 +118,12 @@ class APIServerConfig(BaseModel):
     api_host: str = "0.0.0.0"
     api_port: int = 8080
     api_access_log: bool = False
+    api_stall_threshold_ms: int = 0
+
+    authd_num_workers: int = 1
+    authd_host: str = "0.0.0.0"
+    authd_port: int = 8081
+    authd_basic_auth: bool = False
 
     mq_host: str = "127.0.0.1"
     mq_port: int = 5672
@@ -79,6 +136,8 @@ class APIServerConfig(BaseModel):
     db_username: str = CONFIG_PROJECT_NAME
     db_password: str = CONFIG_PROJECT_NAME
     db_database: str = CONFIG_PROJECT_NAME
+    db_query_max_time_ms: int = 5000
+    db_query_explain: bool = False
 
     k8s_host: str = "10.96.0.1"
     k8s_port: int = 6443
@@ -117,6 +176,8 @@ class APIServerConfig(BaseModel):
     config_workspace_tls_secret: str = ""
     config_nginx_class: str = "nginx"
     config_use_oidc: bool = False
+    config_auth_cache_duration_s: int = 60
+    config_auth_cache_status_codes: str = "200 202"
 
     @logger.catch
     def from_dict(self, d: Dict[str, Any]):
@@ -127,12 +188,20 @@ class APIServerConfig(BaseModel):
         self.api_host = str(d["api"]["host"])
         self.api_port = int(d["api"]["port"])
         self.api_access_log = bool(d["api"]["accessLog"])
+        self.api_stall_threshold_ms = int(d["api"]["stallThresholdMS"])
+
+        self.authd_num_workers = int(d["authd"]["numWorkers"])
+        self.authd_host = str(d["authd"]["host"])
+        self.authd_port = int(d["authd"]["port"])
+        self.authd_basic_auth = bool(d["authd"]["basicAuth"])
 
         self.db_host = str(d["db"]["host"])
         self.db_port = int(d["db"]["port"])
         self.db_username = str(d["db"]["username"])
         self.db_password = str(d["db"]["password"])
         self.db_database = str(d["db"]["database"])
+        self.db_query_max_time_ms = int(d["db"]["queryMaxTimeMS"])
+        self.db_query_explain = bool(d["db"]["queryExplain"])
 
         self.mq_host = str(d["mq"]["host"])
         self.mq_port = int(d["mq"]["port"])
@@ -177,6 +246,8 @@ class APIServerConfig(BaseModel):
         self.config_workspace_tls_secret = str(d["config"]["workspaceTLSSecret"])
         self.config_nginx_class = str(d["config"]["nginxClass"])
         self.config_use_oidc = bool(d["config"]["useOIDC"])
+        self.config_auth_cache_duration_s = int(d["config"]["authCacheDurationS"])
+        self.config_auth_cache_status_codes = str(d["config"]["authCacheStatusCodes"])
         # <<< Define Values <<<
         return self
 
@@ -189,12 +260,20 @@ class APIServerConfig(BaseModel):
         self.api_host = v.get_string("api.host")
         self.api_port = v.get_int("api.port")
         self.api_access_log = v.get_bool("api.accessLog")
+        self.api_stall_threshold_ms = v.get_int("api.stallThresholdMS")
+
+        self.authd_num_workers = v.get_int("authd.numWorkers")
+        self.authd_host = v.get_string("authd.host")
+        self.authd_port = v.get_int("authd.port")
+        self.authd_basic_auth = v.get_bool("authd.basicAuth")
 
         self.db_host = v.get_string("db.host")
         self.db_port = v.get_int("db.port")
         self.db_username = v.get_string("db.username")
         self.db_password = v.get_string("db.password")
         self.db_database = v.get_string("db.database")
+        self.db_query_max_time_ms = v.get_int("db.queryMaxTimeMS")
+        self.db_query_explain = v.get_bool("db.queryExplain")
 
         self.mq_host = v.get_string("mq.host")
         self.mq_port = v.get_int("mq.port")
@@ -239,6 +318,8 @@ class APIServerConfig(BaseModel):
         self.config_workspace_tls_secret = v.get_string("config.workspaceTLSSecret")
         self.config_nginx_class = v.get_string("config.nginxClass")
         self.config_use_oidc = v.get_bool("config.useOIDC")
+        self.config_auth_cache_duration_s = v.get_int("config.authCacheDurationS")
+        self.config_auth_cache_status_codes = v.get_string("config.authCacheStatusCodes")
         # <<< Define Values <<<
 
         return self
@@ -251,7 +332,14 @@ class APIServerConfig(BaseModel):
                 "numWorkers": self.api_num_workers,
                 "host": self.api_host,
                 "port": self.api_port,
-                "accessLog": self.api_access_log
+                "accessLog": self.api_access_log,
+                "stallThresholdMS": self.api_stall_threshold_ms
+            },
+            "authd": {
+                "numWorkers": self.authd_num_workers,
+                "host": self.authd_host,
+                "port": self.authd_port,
+                "basicAuth": self.authd_basic_auth,
             },
             "db": {
                 "host": self.db_host,
@@ -259,6 +347,8 @@ class APIServerConfig(BaseModel):
                 "username": self.db_username,
                 "password": self.db_password,
                 "database": self.db_database,
+                "queryMaxTimeMS": self.db_query_max_time_ms,
+                "queryExplain": self.db_query_explain,
             },
             "mq": {
                 "host": self.mq_host,
@@ -308,6 +398,8 @@ class APIServerConfig(BaseModel):
                 "workspaceTLSSecret": self.config_workspace_tls_secret,
                 "nginxClass": self.config_nginx_class,
                 "useOIDC": self.config_use_oidc,
+                "authCacheDurationS": self.config_auth_cache_duration_s,
+                "authCacheStatusCodes": self.config_auth_cache_status_codes,
             }
         }
         # <<< Define Values <<<
@@ -320,11 +412,18 @@ class APIServerConfig(BaseModel):
             "API_HOST": self.api_host,
             "API_PORT": self.api_port,
             "API_ACCESS_LOG": self.api_access_log,
+            "API_STALL_THRESHOLD_MS": self.api_stall_threshold_ms,
+            "AUTHD_NUMWORKERS": self.authd_num_workers,
+            "AUTHD_HOST": self.authd_host,
+            "AUTHD_PORT": self.authd_port,
+            "AUTHD_BASIC_AUTH": self.authd_basic_auth,
             "DB_HOST": self.db_host,
             "DB_PORT": self.db_port,
             "DB_USERNAME": self.db_username,
             "DB_PASSWORD": self.db_password,
             "DB_DATABASE": self.db_database,
+            "DB_QUERY_MAX_TIME_MS": self.db_query_max_time_ms,
+            "DB_QUERY_EXPLAIN": self.db_query_explain,
             "MQ_HOST": self.mq_host,
             "MQ_PORT": self.mq_port,
             "MQ_USERNAME": self.mq_username,
@@ -364,6 +463,8 @@ class APIServerConfig(BaseModel):
             "CONFIG_WORKSPACE_TLS_SECRET": self.config_workspace_tls_secret,
             "CONFIG_NGINX_CLASS": self.config_nginx_class,
             "CONFIG_USE_OIDC": self.config_use_oidc,
+            "CONFIG_AUTH_CACHE_DURATION_S": self.config_auth_cache_duration_s,
+            "CONFIG_AUTH_CACHE_STATUS_CODES": self.config_auth_cache_status_codes,
         }
         # <<< Define Values <<<
 
@@ -379,12 +480,20 @@ class APIServerConfig(BaseModel):
         v.set_default("api.host", _DEFAULT.api_host)
         v.set_default("api.port", _DEFAULT.api_port)
         v.set_default("api.accessLog", _DEFAULT.api_access_log)
+        v.set_default("api.stallThresholdMS", _DEFAULT.api_stall_threshold_ms)
+
+        v.set_default("authd.numWorkers", _DEFAULT.authd_num_workers)
+        v.set_default("authd.host", _DEFAULT.authd_host)
+        v.set_default("authd.port", _DEFAULT.authd_port)
+        v.set_default("authd.basicAuth", _DEFAULT.authd_basic_auth)
 
         v.set_default("db.host", _DEFAULT.db_host)
         v.set_default("db.port", _DEFAULT.db_port)
         v.set_default("db.username", _DEFAULT.db_username)
         v.set_default("db.password", _DEFAULT.db_password)
         v.set_default("db.database", _DEFAULT.db_database)
+        v.set_default("db.queryMaxTimeMS", _DEFAULT.db_query_max_time_ms)
+        v.set_default("db.queryExplain", _DEFAULT.db_query_explain)
 
         v.set_default("mq.host", _DEFAULT.mq_host)
         v.set_default("mq.port", _DEFAULT.mq_port)
@@ -429,6 +538,8 @@ class APIServerConfig(BaseModel):
         v.set_default("config.workspaceTLSSecret", _DEFAULT.config_workspace_tls_secret)
         v.set_default("config.nginxClass", _DEFAULT.config_nginx_class)
         v.set_default("config.useOIDC", _DEFAULT.config_use_oidc)
+        v.set_default("config.authCacheDurationS", _DEFAULT.config_auth_cache_duration_s)
+        v.set_default("config.authCacheStatusCodes", _DEFAULT.config_auth_cache_status_codes)
         # <<< Set Default Values <<<
 
         return v
@@ -445,12 +556,20 @@ class APIServerConfig(BaseModel):
         parser.add_argument("--api.host", type=str, help="api host")
         parser.add_argument("--api.port", type=int, help="api port")
         parser.add_argument("--api.accessLog", type=bool, help="api accessLog enable")
+        parser.add_argument("--api.stallThresholdMS", type=int, help="api event loop stall threshold in ms, 0 for off")
+
+        parser.add_argument("--authd.numWorkers", type=int, help="authd num workers")
+        parser.add_argument("--authd.host", type=str, help="authd host")
+        parser.add_argument("--authd.port", type=int, help="authd port")
+        parser.add_argument("--authd.basicAuth", type=bool, help="authd serves basic auth")
 
         parser.add_argument("--db.host", type=str, help="db host")
         parser.add_argument("--db.port", type=int, help="db port")
         parser.add_argument("--db.username", type=str, help="db username")
         parser.add_argument("--db.password", type=str, help="db password")
         parser.add_argument("--db.database", type=str, help="db database")
+        parser.add_argument("--db.queryMaxTimeMS", type=int, help="db time limit of list queries, 0 for none")
+        parser.add_argument("--db.queryExplain", type=bool, help="db rejects list queries that scan the collection")
 
         parser.add_argument("--mq.host", type=str, help="mq host")
         parser.add_argument("--mq.port", type=int, help="mq port")
@@ -495,6 +614,8 @@ class APIServerConfig(BaseModel):
         parser.add_argument("--config.workspaceTLSSecret", type=str, help="config workspace tlsSecret")
         parser.add_argument("--config.nginxClass", type=str, help="config nginx class")
         parser.add_argument("--config.useOIDC", type=bool, help="config useOIDC")
+        parser.add_argument("--config.authCacheDurationS", type=int, help="config auth cache duration")
+        parser.add_argument("--config.authCacheStatusCodes", type=str, help="config auth cache status codes")
         # <<< Set Default Values <<<
 
         return parser
@@ -531,12 +652,20 @@ class APIServerConfig(BaseModel):
         v.bind_env("api.host")
         v.bind_env("api.port")
         v.bind_env("api.accessLog")
+        v.bind_env("api.stallThresholdMS")
+
+        v.bind_env("authd.numWorkers")
+        v.bind_env("authd.host")
+        v.bind_env("authd.port")
+        v.bind_env("authd.basicAuth")
 
         v.bind_env("db.host")
         v.bind_env("db.port")
         v.bind_env("db.username")
         v.bind_env("db.password")
         v.bind_env("db.database")
+        v.bind_env("db.queryMaxTimeMS")
+        v.bind_env("db.queryExplain")
 
         v.bind_env("mq.host")
         v.bind_env("mq.port")
@@ -581,6 +710,8 @@ class APIServerConfig(BaseModel):
         v.bind_env("config.workspaceTLSSecret")
         v.bind_env("config.nginxClass")
         v.bind_env("config.useOIDC")
+        v.bind_env("config.authCacheDurationS")
+        v.bind_env("config.authCacheStatusCodes")
         # <<< Set Env Values <<<
 
         x = cls()
@@ -620,7 +751,9 @@ class APIServerConfig(BaseModel):
     def auth_config_values(self):
         return {
             "CONFIG_AUTH_COOKIES_NAME": CONFIG_AUTH_COOKIES_NAME,
-            "CONFIG_AUTH_ENDPOINT": self.config_auth_endpoint
+            "CONFIG_AUTH_ENDPOINT": self.config_auth_endpoint,
+            # nginx proxy_cache_valid syntax, e.g. "200 202 60s"
+            "CONFIG_AUTH_CACHE_DURATION": f"{self.config_auth_cache_status_codes} {max(self.config_auth_cache_duration_s, 0)}s",
         }
 
     def verify(self) -> Tuple[bool, Optional[Exception]]:
@@ -635,6 +768,8 @@ class APIServerConfig(BaseModel):
             ]),
             self.config_workspace_hostname == "" and (msg.append("no config_workspace_hostname") == None),
             self.config_workspace_tls_secret == "" and (msg.append("no config_workspace_tls_secret") == None),
+            not all(code.isdigit() for code in self.config_auth_cache_status_codes.split()) and (
+                    msg.append("malformed config_auth_cache_status_codes") == None),
         ]):
             return False, Exception("\n".join(msg))
         else:
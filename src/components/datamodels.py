@@ -9,13 +9,14 @@ from enum import Enum
 from hashlib import sha256
 from typing import List, Optional, Dict, Any, Union, Self
 
-import bcrypt
 import kubernetes
 import shortuuid
 from pydantic import BaseModel, UUID4, EmailStr, SecretStr
 from pydantic import field_validator, field_serializer
 
 import src.components.config as config
+from src.components.hashing import make_htpasswd
+from src.components.hlc import next_resource_version
 from src.components.utils import render_template_str
 
 database_name = config.CONFIG_PROJECT_NAME
@@ -23,6 +24,11 @@ global_collection_name = config.CONFIG_GLOBAL_COLLECTION_NAME
 user_collection_name = config.CONFIG_USER_COLLECTION_NAME
 pod_collection_name = config.CONFIG_POD_COLLECTION_NAME
 template_collection_name = config.CONFIG_TEMPLATE_COLLECTION_NAME
+usage_collection_name = config.CONFIG_USAGE_COLLECTION_NAME
+revocation_collection_name = config.CONFIG_REVOCATION_COLLECTION_NAME
+
+# the password of password-less accounts (e.g. OIDC users), as stored
+empty_password_hash = sha256(b"").hexdigest()
 
 
 class GlobalModel(BaseModel):
@@ -30,6 +36,7 @@ class GlobalModel(BaseModel):
     Global model, used to store global settings in the database
     """
     uid_counter: int = 0
+    status_epoch: int = 0  # bumped on every user status or role change, see UserModel.status_epoch
     flag_crashed: bool = False  # record if last run crashed
     version: str = config.CONFIG_BUILD_VERSION
 
@@ -165,16 +172,31 @@ class QuotaModel(BaseModel):
         return res
 
 
+class UsageModel(BaseModel):
+    """
+    Usage model, the materialized resource consumption of a user. Fields mirror
+    QuotaModel so that quota admission can be expressed as a conditional $inc.
+    """
+    username: str
+    cpu_m: int = 0
+    memory_mb: int = 0
+    storage_mb: int = 0
+    gpu: int = 0
+    pod_n: int = 0
+
+
 class UserModel(BaseModel):
     """
     User model, used to define user
     """
     version: str
     resource_status: ResourceStatusEnum = ResourceStatusEnum.pending
+    resource_version: int = 0  # bumped on every write, see hlc.py
     uid: int
     uuid: Optional[UUID4]
     username: str
     status: UserStatusEnum = UserStatusEnum.active
+    status_epoch: int = 0  # global status epoch of the last status or role change, tokens carry it as 'epoch'
     email: Optional[EmailStr]
     password: SecretStr
     htpasswd: Optional[SecretStr] = None  # used for htpasswd authentication
@@ -205,6 +227,14 @@ class UserModel(BaseModel):
     def serialize_password(self, v: SecretStr, _info):
         return v.get_secret_value()
 
+    @field_validator("htpasswd")
+    def htpasswd_must_not_match_an_empty_password(cls, v, info):
+        # password-less accounts created before they had no htpasswd carry one of the empty password
+        password = info.data.get('password')
+        if password is not None and password.get_secret_value() == empty_password_hash:
+            v = None
+        return v
+
     @field_serializer('htpasswd')
     def serialize_htpasswd(self, v: SecretStr, _info):
         if v is None:
@@ -232,6 +262,15 @@ class UserModel(BaseModel):
             v = QuotaModel(**v)
         return v
 
+    @property
+    def htpasswd_entry(self) -> bytes:
+        """
+        htpasswd line of the user's k8s credentials, password-less accounts get a locked entry no password matches
+        """
+        if self.htpasswd is None:
+            return f"{self.username}:!".encode()
+        return self.htpasswd.get_secret_value().encode()
+
     def verify_password(self, plain_password: str) -> bool:
         password_hashed = sha256(str(plain_password).encode()).hexdigest()
         if secrets.compare_digest(
@@ -250,15 +289,23 @@ class UserModel(BaseModel):
             role: UserRoleEnum,
             email: Optional[str] = None,
             quota: Optional[Dict[str, Any]] = None,
-            extra_info: Optional[Dict[str, Any]] = None):
+            extra_info: Optional[Dict[str, Any]] = None,
+            htpasswd: Optional[str] = None):
+        """
+        htpasswd is hashed from password when not given, pass it when it was hashed off the event loop.
+        Password-less accounts have no htpasswd.
+        """
+        if htpasswd is None:
+            htpasswd = make_htpasswd(username, password)
         return cls(
             version=config.CONFIG_BUILD_VERSION,
+            resource_version=next_resource_version(),
             uid=uid,
             uuid=None,
             username=username,
             email=email,
             password=sha256(password.encode()).hexdigest(),
-            htpasswd=f"{username}:" + bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=12)).decode(),
+            htpasswd=htpasswd,
             role=role,
             owned_pod_ids=[],
             quota=quota,
@@ -293,6 +340,7 @@ class TemplateModel(BaseModel):
     """
     version: str
     resource_status: ResourceStatusEnum = ResourceStatusEnum.pending
+    resource_version: int = 0  # bumped on every write, see hlc.py
     template_id: UUID4
     name: str
     description: str
@@ -340,6 +388,7 @@ class TemplateModel(BaseModel):
             enabled: bool = True):
         return cls(
             version=config.CONFIG_BUILD_VERSION,
+            resource_version=next_resource_version(),
             template_id=uuid.uuid4(),
             name=name,
             description=description,
@@ -384,12 +433,20 @@ class TemplateModel(BaseModel):
         return res
 
 
+def _format_datetime(v: datetime.datetime) -> str:
+    # attention: same as v.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), without the locale-aware formatting
+    if v.tzinfo is not None:
+        v = v.replace(tzinfo=None)
+    return v.isoformat(timespec="microseconds") + "Z"
+
+
 class PodModel(BaseModel):
     """
     Pod model, used to define pod
     """
     version: str
     resource_status: ResourceStatusEnum = ResourceStatusEnum.pending
+    resource_version: int = 0  # bumped on every write, see hlc.py
     pod_id: str
     name: str
     description: str
@@ -408,6 +465,7 @@ class PodModel(BaseModel):
     current_status: PodStatusEnum
     target_status: PodStatusEnum
     current_status_reason: Optional[str] = None  # populated when scheduling/start fails
+    timings: Optional[Dict[str, int]] = None  # milliseconds spent in each phase of the last start, by phase
 
     @field_validator("version")
     def version_must_be_valid(cls, v):
@@ -419,39 +477,26 @@ class PodModel(BaseModel):
     def serialize_uuid(self, v: uuid.UUID, _info):
         return str(v)
 
-    @field_validator('created_at')
-    def validate_created_at(cls, v: Union[str, datetime.datetime]):
-        if isinstance(v, str):
-            v = datetime.datetime.strptime(v, "%Y-%m-%dT%H:%M:%S.%fZ")
-        return v
-
     @field_serializer('user_uuid')
     def serialize_user_uuid(self, v: uuid.UUID, _info):
         return str(v)
 
-    @field_serializer('created_at')
-    def serialize_created_at(self, v: datetime.datetime, _info):
-        return v.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-
-    @field_validator('started_at')
-    def validate_started_at(cls, v: Union[str, datetime.datetime]):
+    @field_validator('created_at', 'started_at', 'accessed_at')
+    def validate_datetime(cls, v: Union[str, datetime.datetime]):
         if isinstance(v, str):
             v = datetime.datetime.strptime(v, "%Y-%m-%dT%H:%M:%S.%fZ")
         return v
 
-    @field_serializer('started_at')
-    def serialize_started_at(self, v: datetime.datetime, _info):
-        return v.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    @field_serializer('created_at', 'started_at', 'accessed_at')
+    def serialize_datetime(self, v: datetime.datetime, _info):
+        return _format_datetime(v)
 
-    @field_validator('accessed_at')
-    def validate_accessed_at(cls, v: Union[str, datetime.datetime]):
-        if isinstance(v, str):
-            v = datetime.datetime.strptime(v, "%Y-%m-%dT%H:%M:%S.%fZ")
-        return v
-
-    @field_serializer('accessed_at')
-    def serialize_accessed_at(self, v: datetime.datetime, _info):
-        return v.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    @property
+    def holds_compute(self) -> bool:
+        """
+        whether cpu/mem/gpu of this pod are charged to the owner's usage
+        """
+        return self.target_status == PodStatusEnum.running and self.current_status != PodStatusEnum.failed
 
     @property
     def values(self):
@@ -485,6 +530,7 @@ class PodModel(BaseModel):
             timeout_s: int = 3600):
         return cls(
             version=config.CONFIG_BUILD_VERSION,
+            resource_version=next_resource_version(),
             pod_id=shortuuid.uuid(),
             name=name,
             description=description,
@@ -511,6 +557,8 @@ class PodModel(BaseModel):
             d['gpu'] = 0
         if 'current_status_reason' not in d:
             d['current_status_reason'] = None
+        if 'timings' not in d:
+            d['timings'] = None
         res = cls(**d)
         res.version = config.CONFIG_BUILD_VERSION
         return res
@@ -10,6 +10,8 @@ header_malformed = Exception("header malformed")
 header_missing = Exception("header missing")
 invalid_request_body = Exception("invalid request body")
 invalid_token = Exception("invalid token")
+jwks_fetch_failed = Exception("jwks fetch failed")
+jwks_key_not_found = Exception("jwks key not found")
 k8s_config_not_found = Exception("Kubernetes config not found")
 k8s_failed_to_create = Exception("Kubernetes failed to create")
 k8s_failed_to_delete = Exception("Kubernetes failed to delete")
@@ -19,8 +21,13 @@ k8s_failed_to_update = Exception("Kubernetes failed to update")
 k8s_timeout = Exception("Kubernetes timeout")
 k8s_pod_failed = Exception("Kubernetes pod failed to reach target status")
 old_password_required = Exception("old password required")
+pod_changed = Exception("pod changed meanwhile, retry")
 pod_not_found = Exception("pod not found")
 pod_not_stopped = Exception("pod must be stopped to edit its specs")
+profile_running = Exception("a profile is already running in this worker")
+query_filter_not_allowed = Exception("query filter uses fields or operators that are not allowed")
+query_not_indexed = Exception("query filter cannot use an index")
+query_timeout = Exception("query timed out")
 quota_exceeded = Exception("quota exceeded")
 template_invalid = Exception("template invalid")
 template_key_not_exists = BaseException("template key not exists")
@@ -28,6 +35,7 @@ template_key_not_used = Exception("template key not used")
 template_not_committed = Exception("template is not committed")
 template_disabled = Exception("template is disabled")
 template_not_found = Exception("template not found")
+token_revoked = Exception("token revoked")
 unknown_error = Exception("unknown error")
 user_not_found = Exception("user not found")
 user_not_allowed = Exception("user not allowed")
@@ -47,6 +55,11 @@ USER_ERROR_HTTP_STATUS = {
     id(quota_exceeded): http.HTTPStatus.BAD_REQUEST,
     id(invalid_request_body): http.HTTPStatus.BAD_REQUEST,
     id(wrong_pod_profile): http.HTTPStatus.BAD_REQUEST,
+    id(wrong_query_filter): http.HTTPStatus.BAD_REQUEST,
+    id(query_filter_not_allowed): http.HTTPStatus.BAD_REQUEST,
+    id(query_not_indexed): http.HTTPStatus.BAD_REQUEST,
+    id(query_timeout): http.HTTPStatus.SERVICE_UNAVAILABLE,  # the filter is too expensive, or the db overloaded
+    id(pod_changed): http.HTTPStatus.CONFLICT,
     id(pod_not_found): http.HTTPStatus.NOT_FOUND,
     id(template_disabled): http.HTTPStatus.NOT_FOUND,
     id(template_not_found): http.HTTPStatus.NOT_FOUND,
@@ -54,6 +67,7 @@ USER_ERROR_HTTP_STATUS = {
     id(user_not_found): http.HTTPStatus.NOT_FOUND,
     id(username_required): http.HTTPStatus.BAD_REQUEST,
     id(user_not_allowed): http.HTTPStatus.FORBIDDEN,
+    id(profile_running): http.HTTPStatus.CONFLICT,
 }
 
 
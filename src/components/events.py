@@ -9,6 +9,8 @@ from typing import Optional, Tuple, Union
 
 from pydantic import BaseModel
 
+from src.components.datamodels import PodStatusEnum, ResourceStatusEnum
+
 
 class UserBaseEvent(BaseModel):
     type: str = "user_base_event"
@@ -62,6 +64,19 @@ class PodTimeoutEvent(PodBaseEvent):
     type: str = "pod_timeout_event"
 
 
+class PodStatusEvent(PodBaseEvent):
+    """
+    A snapshot of the status of a pod, streamed to watchers. Not sent through the event queue.
+    """
+    type: str = "pod_status_event"
+    name: str = ""
+    target_status: PodStatusEnum
+    current_status: PodStatusEnum
+    current_status_reason: Optional[str] = None
+    resource_status: ResourceStatusEnum
+    resource_version: int = 0
+
+
 class UserHeartbeatEvent(BaseModel):
     type: str = "user_heartbeat_event"
     username: str
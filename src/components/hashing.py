@@ -0,0 +1,45 @@
+"""
+This module computes htpasswd entries (bcrypt) off the event loop.
+
+bcrypt costs about 250ms of CPU per hash at 12 rounds. bcrypt releases the GIL while hashing, so a bounded
+thread pool spreads hashes over the cores. A process pool is not an option, sanic workers are daemonic
+processes and cannot have children.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import bcrypt
+
+from src.components import config
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # attention: created on first use, that is after the worker has been forked
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=config.CONFIG_HASH_POOL_SIZE, thread_name_prefix="clpl-hash")
+    return _executor
+
+
+def make_htpasswd(username: str, password: str) -> Optional[str]:
+    """
+    Return the htpasswd entry of a user, None for password-less accounts (e.g. OIDC users), nothing to hash.
+    Blocks, use make_htpasswd_async on the event loop.
+    """
+    if password == "":
+        return None
+    return f"{username}:" + bcrypt.hashpw(password.encode(),
+                                          bcrypt.gensalt(rounds=config.CONFIG_BCRYPT_ROUNDS)).decode()
+
+
+async def make_htpasswd_async(username: str, password: str) -> Optional[str]:
+    """
+    Same as make_htpasswd, hashed on the pool
+    """
+    if password == "":
+        return None
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), make_htpasswd, username, password)
@@ -0,0 +1,117 @@
+"""
+This module implements the per-worker websocket heartbeat hub.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, List, Optional, Set
+
+from loguru import logger
+
+
+class HeartbeatConnection:
+    """
+    A registered websocket. Kept small since a worker may hold thousands of them.
+    """
+    __slots__ = ('ws', 'username', 'slot', 'waiter')
+
+    def __init__(self, ws, username: str, slot: int):
+        self.ws = ws
+        self.username = username
+        self.slot = slot
+        self.waiter: Optional[asyncio.Future] = None  # resolved when the pong of the last ping arrives
+
+
+class HeartbeatHub:
+    """
+    Connections are bucketed on a timer wheel of `n_slots` slots, one slot is visited per tick and
+    a full revolution takes `interval_s`. On each visit a connection is sent a native ping frame;
+    if the pong of the previous ping has not arrived by then, the socket is considered dead and
+    reaped. Connections that answered are reported through `on_alive`.
+
+    A single task drives the wheel, no task is spawned per connection.
+    """
+
+    def __init__(self,
+                 interval_s: float,
+                 n_slots: int,
+                 on_alive: Callable[[str], Awaitable[Optional[Exception]]]):
+        self.interval_s = interval_s
+        self.n_slots = n_slots
+        self.on_alive = on_alive
+        self._slots: List[Set[HeartbeatConnection]] = [set() for _ in range(n_slots)]
+        self._cursor = 0
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+    @property
+    def tick_s(self) -> float:
+        return self.interval_s / self.n_slots
+
+    def register(self, ws, username: str) -> HeartbeatConnection:
+        """
+        Register a websocket, it is first visited one revolution later.
+        """
+        conn = HeartbeatConnection(ws, username, (self._cursor - 1) % self.n_slots)
+        self._slots[conn.slot].add(conn)
+        return conn
+
+    def unregister(self, conn: HeartbeatConnection) -> None:
+        self._slots[conn.slot].discard(conn)
+
+    @staticmethod
+    async def _ping(conn: HeartbeatConnection) -> bool:
+        try:
+            conn.waiter = await conn.ws.ping()
+            return True
+        except Exception as e:
+            logger.debug(f"failed to ping websocket of user {conn.username}: {e}")
+            return False
+
+    async def tick(self) -> int:
+        """
+        Visit the slot under the cursor and advance. Return the number of reaped connections.
+        """
+        slot = self._slots[self._cursor]
+        self._cursor = (self._cursor + 1) % self.n_slots
+
+        # sort connections into answered and dead ones
+        alive, dead = [], []
+        for conn in slot:
+            if conn.waiter is None or (conn.waiter.done() and not conn.waiter.cancelled() and
+                                       conn.waiter.exception() is None):
+                alive.append(conn)
+            else:
+                dead.append(conn)
+
+        # ping the batch, a failing send counts as dead as well
+        results = await asyncio.gather(*[self._ping(conn) for conn in alive])
+        dead.extend(conn for conn, ok in zip(alive, results) if not ok)
+
+        # reap dead sockets, the handler's recv() then returns and unregisters again (no-op)
+        for conn in dead:
+            slot.discard(conn)
+            try:
+                conn.ws.fail_connection(1011, "heartbeat timeout")
+            except Exception as e:
+                logger.debug(f"failed to close websocket of user {conn.username}: {e}")
+
+        # report users with at least one live connection
+        for username in {conn.username for conn, ok in zip(alive, results) if ok}:
+            _ = await self.on_alive(username)
+
+        return len(dead)
+
+    async def run(self) -> None:
+        logger.info(f"heartbeat hub started, {self.n_slots} slots, {self.tick_s:.2f}s per tick")
+        while True:
+            try:
+                await asyncio.sleep(self.tick_s)
+                reaped = await self.tick()
+                if reaped > 0:
+                    logger.info(f"heartbeat hub reaped {reaped} dead connections")
+            except asyncio.CancelledError:
+                logger.info("heartbeat hub cancelled")
+                break
+            except Exception as e:
+                logger.exception(e)
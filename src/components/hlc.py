@@ -0,0 +1,38 @@
+"""
+This module issues resource versions from a hybrid logical clock.
+
+A version is (milliseconds << 12 | logical counter) << 8 | node. The counter keeps versions increasing within a
+process when the wall clock stalls or steps back, the node (low bits of the pid) keeps versions of different
+workers apart. Versions issued later are larger, across workers up to the clock skew between them, which is
+what list ETags (max version plus count) rely on.
+"""
+
+import os
+import time
+
+
+class HybridLogicalClock:
+    def __init__(self):
+        self._last = 0
+
+    def now(self) -> int:
+        logical = max((time.time_ns() // 1_000_000) << 12, self._last + 1)
+        self._last = logical
+        return (logical << 8) | (os.getpid() & 0xFF)
+
+
+clock = HybridLogicalClock()
+
+
+def next_resource_version() -> int:
+    """
+    Return a new resource version, to be stored with every write of a document
+    """
+    return clock.now()
+
+
+def version_span(seconds: float) -> int:
+    """
+    Return the difference between two versions issued seconds apart
+    """
+    return int(seconds * 1000) << 20
@@ -0,0 +1,147 @@
+"""
+This module caches the JSON Web Key Set of the OIDC identity provider.
+
+The key set is kept for the max-age of its Cache-Control header and refreshed in the background before it
+expires. A token signed with an unknown kid (the IdP rotated its keys) triggers one refetch, shared by all
+concurrent callers, and kids still unknown afterwards are negatively cached so that forged tokens cannot
+make us hammer the IdP.
+"""
+
+import json
+import re
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+import jwt
+from loguru import logger
+
+from src.components import config, errors
+from src.components.cache import SingleFlight, TTLCache
+
+_MAX_AGE_RE = re.compile(r"max-age\s*=\s*(\d+)")
+
+
+def parse_max_age(cache_control: Optional[str], default: float) -> float:
+    """
+    Return the max-age of a Cache-Control header value, default if absent, 0 for no-store/no-cache
+    """
+    if cache_control is None:
+        return default
+    cache_control = cache_control.lower()
+    if "no-store" in cache_control or "no-cache" in cache_control:
+        return 0
+    match = _MAX_AGE_RE.search(cache_control)
+    if match is None:
+        return default
+    return min(int(match.group(1)), config.CONFIG_JWKS_MAX_TTL_S)
+
+
+class JWKSCache:
+    """
+    JWKS of one jwks_url, kid -> public key. One instance per worker, used from its event loop.
+    """
+
+    def __init__(self,
+                 client: httpx.AsyncClient,
+                 jwks_url: str,
+                 default_ttl_s: float = config.CONFIG_JWKS_DEFAULT_TTL_S,
+                 min_refetch_interval_s: float = config.CONFIG_JWKS_MIN_REFETCH_INTERVAL_S,
+                 negative_ttl_s: float = config.CONFIG_JWKS_NEGATIVE_TTL_S):
+        self._client = client
+        self._jwks_url = jwks_url
+        self._default_ttl_s = default_ttl_s
+        self._min_refetch_interval_s = min_refetch_interval_s
+        self._negative_ttl_s = negative_ttl_s
+
+        self._keys: Dict[str, Any] = {}
+        self._parsed: Dict[str, Any] = {}  # canonical jwk -> key, parsing an RSA key is not free
+        self._fetched_at = 0.0
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._unknown_kids: TTLCache[bool] = TTLCache(maxsize=1024)
+        self._flight = SingleFlight()
+
+    @property
+    def keys(self) -> Dict[str, Any]:
+        return dict(self._keys)
+
+    async def refresh(self) -> Optional[Exception]:
+        """
+        Fetch the key set, concurrent callers share one request
+        """
+        return await self._flight.do("jwks", self._fetch)
+
+    def refresh_in_background(self) -> None:
+        """
+        Start a refresh without waiting for it, the single-flight table keeps a reference to the task
+        """
+        self._flight.start("jwks", self._fetch)
+
+    async def _fetch(self) -> Optional[Exception]:
+        try:
+            res = await self._client.get(self._jwks_url)
+            res.raise_for_status()
+            jwks = res.json()
+        except Exception as e:
+            logger.error(f"failed to fetch jwks from {self._jwks_url}: {e}")
+            # keep serving the stale key set, but do not retry on every request
+            self._fetched_at = time.time()
+            self._expires_at = self._refresh_at = self._fetched_at + self._min_refetch_interval_s
+            return errors.jwks_fetch_failed
+
+        keys, parsed = {}, {}
+        for jwk in jwks.get('keys', []):
+            if 'kid' not in jwk or jwk.get('kty') != 'RSA':
+                continue
+            canonical = json.dumps(jwk, sort_keys=True)
+            key = self._parsed.get(canonical)
+            if key is None:
+                try:
+                    key = jwt.get_algorithm_by_name('RS256').from_jwk(canonical)
+                except Exception as e:
+                    logger.warning(f"skip malformed jwk {jwk['kid']}: {e}")
+                    continue
+            keys[jwk['kid']] = key
+            parsed[canonical] = key
+
+        now = time.time()
+        # attention: an IdP sending no-store must not make us fetch on every request
+        ttl = max(parse_max_age(res.headers.get('cache-control'), self._default_ttl_s), self._min_refetch_interval_s)
+        self._keys, self._parsed = keys, parsed
+        self._fetched_at = now
+        self._expires_at = now + ttl
+        self._refresh_at = now + ttl * 0.8
+        self._unknown_kids.clear()
+        logger.debug(f"jwks refreshed, kids={list(keys)}, ttl={ttl}s")
+        return None
+
+    async def get_key(self, kid: str) -> Tuple[Optional[Any], Optional[Exception]]:
+        """
+        Return the public key of kid
+        """
+        now = time.time()
+        if now >= self._expires_at:
+            err = await self.refresh()
+            if err is not None and len(self._keys) == 0:
+                return None, err
+            # a stale key set is better than none while the IdP is unreachable
+        elif now >= self._refresh_at:
+            self.refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            return key, None
+
+        if self._unknown_kids.get(kid) is not None:
+            return None, errors.jwks_key_not_found
+
+        # unknown kid, the IdP may have rotated its keys
+        if time.time() - self._fetched_at >= self._min_refetch_interval_s:
+            await self.refresh()
+            key = self._keys.get(kid)
+            if key is not None:
+                return key, None
+
+        self._unknown_kids.put(kid, True, time.time() + self._negative_ttl_s)
+        return None, errors.jwks_key_not_found
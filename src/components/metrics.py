@@ -0,0 +1,325 @@
+"""
+This module collects metrics and exposes them in the Prometheus text format.
+
+Each worker collects its own metrics in memory, observing a value costs a dict lookup and a bisect, so that
+instrumenting hot paths like token validation stays cheap. Workers are separate processes: each one periodically
+writes its metrics to a file of its own in METRICS_DIR, and the worker that answers a scrape merges the
+files of all workers. Counters and histograms are summed across workers, gauges are reported per worker.
+"""
+
+import bisect
+import contextlib
+import functools
+import glob
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from src.components import config
+from src.components.query_guard import attributed
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_DIR = os.environ.get(config.CONFIG_METRICS_DIR_KEY, config.CONFIG_METRICS_DIR_DEFAULT)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+RECONCILE_BUCKETS = (.1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300., 600.)
+
+Labels = Tuple[str, ...]
+
+# all metrics, by name
+REGISTRY: Dict[str, '_Metric'] = {}
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, Any] = {}
+        REGISTRY[name] = self
+
+    def collect(self) -> List[Tuple[Labels, Any]]:
+        return list(self._values.items())
+
+    def clear(self) -> None:
+        self._values.clear()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A gauge, either set by the code or read from function when collected
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def collect(self) -> List[Tuple[Labels, Any]]:
+        if self.function is not None:
+            try:
+                self._values[()] = self.function()
+            except Exception as e:
+                logger.debug(f"gauge {self.name} not collected: {e}")
+        return super().collect()
+
+
+class Histogram(_Metric):
+    """
+    A histogram. Each label set holds the count of each bucket (not cumulative, the last one is +Inf) followed by
+    the sum of the observed values.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str) -> None:
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """
+        Observe the duration of the block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "clpl_http_request_duration_seconds", "Duration of HTTP requests until the response is sent, by route",
+    ("route", "method", "status"))
+DB_OPERATION_DURATION = Histogram(
+    "clpl_db_operation_duration_seconds", "Duration of database operations, by repo method", ("method",))
+DB_OPERATION_ERRORS = Counter(
+    "clpl_db_operation_errors_total", "Database operations that returned an error, by repo method", ("method",))
+DB_COMMANDS = Counter(
+    "clpl_db_commands_total", "Database commands, by the route, task or event handler they ran for",
+    ("route", "command", "collection"))
+DB_COMMAND_DURATION = Histogram(
+    "clpl_db_command_duration_seconds", "Duration of database commands, by command and collection",
+    ("command", "collection"))
+DB_COMMAND_DOCUMENTS = Counter(
+    "clpl_db_command_documents_total", "Documents returned or written by database commands, by route",
+    ("route", "collection"))
+K8S_REQUEST_DURATION = Histogram(
+    "clpl_k8s_request_duration_seconds", "Duration of Kubernetes API calls, by resource kind and verb",
+    ("kind", "verb"))
+OIDC_REQUEST_DURATION = Histogram(
+    "clpl_oidc_request_duration_seconds", "Duration of IdP calls until response headers, by endpoint", ("endpoint",))
+RECONCILE_DURATION = Histogram(
+    "clpl_reconcile_duration_seconds", "Duration of event handlers, by handler and outcome", ("handler", "outcome"),
+    buckets=RECONCILE_BUCKETS)
+RECONCILE_PHASE_DURATION = Histogram(
+    "clpl_reconcile_phase_duration_seconds", "Duration of the phases of event handlers", ("handler", "phase"),
+    buckets=RECONCILE_BUCKETS)
+POD_START_PHASE_DURATION = Histogram(
+    "clpl_pod_start_phase_duration_seconds", "Duration of the phases of successful pod starts, by template",
+    ("template", "phase"), buckets=RECONCILE_BUCKETS)
+RECONCILE_IN_FLIGHT = Gauge(
+    "clpl_reconcile_in_flight", "Event handlers started and not finished yet, by handler", ("handler",))
+EVENT_LOOP_LAG = Histogram(
+    "clpl_event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task")
+ASYNCIO_TASKS = Gauge(
+    "clpl_asyncio_tasks", "Tasks of the event loop, pending or running")
+WATCH_SUBSCRIBERS = Gauge(
+    "clpl_watch_subscribers", "Connected pod status watches")
+HEARTBEAT_CONNECTIONS = Gauge(
+    "clpl_heartbeat_connections", "Connected heartbeat websockets")
+
+
+def tracked(handler: str):
+    """
+    Decorate an event handler returning Optional[Exception]: count it while in flight, time it by outcome, and
+    attribute its database commands to it.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            RECONCILE_IN_FLIGHT.inc(handler)
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                with attributed(f"handler:{handler}"):
+                    err = await fn(*args, **kwargs)
+                outcome = "ok" if err is None else "error"
+                return err
+            finally:
+                RECONCILE_IN_FLIGHT.dec(handler)
+                RECONCILE_DURATION.observe(time.perf_counter() - start, handler, outcome)
+
+        return wrapper
+
+    return decorator
+
+
+class PhaseTimer:
+    """
+    Time the phases of an event handler. Each phase is observed in RECONCILE_PHASE_DURATION and kept in timings,
+    in milliseconds, so that it can be stored with the resource.
+    """
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.timings: Dict[str, int] = {}
+        self._start = time.perf_counter()
+
+    def record(self, phase: str, seconds: float) -> None:
+        """
+        Record a phase measured elsewhere, e.g. from the timestamps of Kubernetes
+        """
+        RECONCILE_PHASE_DURATION.observe(seconds, self.handler, phase)
+        self.timings[phase] = round(seconds * 1000)
+
+    @contextlib.contextmanager
+    def phase(self, phase: str) -> Iterator[None]:
+        """
+        Time the block as phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def total(self) -> Dict[str, int]:
+        """
+        Return the timings, with the time elapsed since the timer was created as total
+        """
+        return self.timings | {'total': round((time.perf_counter() - self._start) * 1000)}
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    Collect the metrics of this worker
+    """
+    return {
+        'pid': os.getpid(),
+        'at': time.time(),
+        'metrics': {
+            name: [[list(labels), value] for labels, value in metric.collect()] for name, metric in REGISTRY.items()
+        },
+    }
+
+
+def write_snapshot(directory: str = METRICS_DIR) -> None:
+    """
+    Write the metrics of this worker to its file in directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot(), f)
+    os.replace(path + ".tmp", path)  # readers never see a partial file
+
+
+def read_snapshots(directory: str = METRICS_DIR) -> List[Dict[str, Any]]:
+    """
+    Read the metrics of all workers from directory
+    """
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.debug(f"metrics file {path} not read: {e}")
+    return snapshots
+
+
+def reset_directory(directory: str = METRICS_DIR) -> None:
+    """
+    Remove the files of the workers of a previous run
+    """
+    for path in glob.glob(os.path.join(directory, "*.json*")):
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshots: List[Dict[str, Any]]) -> str:
+    """
+    Merge the metrics of the workers and render them in the Prometheus text format. Gauges of workers that have
+    not written their metrics for CONFIG_METRICS_STALE_S are left out, they are gone.
+    """
+    now = time.time()
+    lines = []
+    for name, metric in REGISTRY.items():
+        merged: Dict[Labels, Any] = {}
+        labelnames = metric.labelnames
+        if metric.kind == "gauge":
+            labelnames = labelnames + ("worker",)
+        for s in snapshots:
+            for labels, value in s['metrics'].get(name, []):
+                labels = tuple(labels)
+                if metric.kind == "gauge":
+                    if now - s['at'] > config.CONFIG_METRICS_STALE_S:
+                        continue
+                    merged[labels + (str(s['pid']),)] = value
+                elif metric.kind == "histogram":
+                    if len(value) != len(metric.buckets) + 2:
+                        continue  # written with other buckets
+                    state = merged.get(labels)
+                    merged[labels] = value if state is None else [a + b for a, b in zip(state, value)]
+                else:
+                    merged[labels] = merged.get(labels, 0) + value
+
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.kind}")
+        for labels, value in sorted(merged.items()):
+            if metric.kind != "histogram":
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float("inf"),), value[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labelnames + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {_format_value(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(labelnames, labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,181 @@
+"""
+This module profiles a running worker on demand.
+
+The cpu mode samples the stack of the event loop's thread from another thread and counts the collapsed stacks
+("outer;...;inner count", the input of flame graph tools); time the loop spends idle shows up as the frames of the
+loop itself. The alloc mode compares two tracemalloc snapshots taken seconds apart and returns the lines that
+allocated the most. To profile all workers, the worker serving the request writes a request file to PROFILES_DIR,
+the other workers poll for it, run the same profile and write their results next to it.
+"""
+
+import asyncio
+import collections
+import contextlib
+import glob
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from types import FrameType
+from typing import Any, Dict, List, Optional, Tuple
+
+import shortuuid
+from loguru import logger
+
+from src.components import config, errors, metrics
+from src.components.stalls import short_path
+
+PROFILES_DIR = os.path.join(metrics.METRICS_DIR, "profiles")
+
+_running = False  # one profile at a time in a worker, tracemalloc is global
+
+
+def _collapse(frame: FrameType) -> str:
+    names = []
+    while frame is not None:
+        names.append(f"{short_path(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _sample_stacks(thread_id: int, seconds: float, interval_s: float) -> Tuple[Dict[str, int], int]:
+    stacks = collections.Counter()
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is not None:
+            stacks[_collapse(frame)] += 1
+            samples += 1
+        time.sleep(interval_s)
+    return dict(stacks), samples
+
+
+async def _profile_cpu(seconds: float) -> Dict[str, Any]:
+    # attention: called on the loop, so the current thread is the loop's thread
+    stacks, samples = await asyncio.to_thread(
+        _sample_stacks, threading.get_ident(), seconds, config.CONFIG_PROFILE_SAMPLE_INTERVAL_S
+    )
+    return {'pid': os.getpid(), 'mode': 'cpu', 'samples': samples, 'stacks': stacks}
+
+
+async def _profile_alloc(seconds: float, top: int) -> Dict[str, Any]:
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>"))
+        before = tracemalloc.take_snapshot().filter_traces(ignored)
+        await asyncio.sleep(seconds)
+        after = tracemalloc.take_snapshot().filter_traces(ignored)
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    stats = after.compare_to(before, 'lineno')
+    return {'pid': os.getpid(), 'mode': 'alloc', 'allocations': [
+        {
+            'location': f"{short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+            'size_diff_kb': round(stat.size_diff / 1024, 1),
+            'count_diff': stat.count_diff,
+            'size_kb': round(stat.size / 1024, 1),
+            'pid': os.getpid(),
+        } for stat in stats[:top]
+    ]}
+
+
+def is_running() -> bool:
+    return _running
+
+
+async def run_profile(mode: str, seconds: float, top: int) -> Tuple[Optional[Dict[str, Any]], Optional[Exception]]:
+    """
+    Profile this worker for seconds, mode is cpu or alloc
+    """
+    global _running
+    if _running:
+        return None, errors.profile_running
+    _running = True
+    try:
+        logger.info(f"profiling worker {os.getpid()} for {seconds}s, mode {mode}")
+        if mode == 'alloc':
+            return await _profile_alloc(seconds, top), None
+        return await _profile_cpu(seconds), None
+    finally:
+        _running = False
+
+
+def merge_results(results: List[Dict[str, Any]], top: int) -> Dict[str, Any]:
+    """
+    Merge the profiles of the workers: the counts of the stacks are summed, the allocations ranked together
+    """
+    stacks = collections.Counter()
+    allocations = []
+    for result in results:
+        stacks.update(result.get('stacks', {}))
+        allocations.extend(result.get('allocations', []))
+    return {
+        'workers': sorted(result['pid'] for result in results),
+        'samples': sum(result.get('samples', 0) for result in results),
+        'collapsed': [f"{stack} {count}" for stack, count in stacks.most_common()],
+        'allocations': sorted(allocations, key=lambda a: a['size_diff_kb'], reverse=True)[:top],
+    }
+
+
+def _write_json(path: str, data: Dict[str, Any]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)  # readers never see a partial file
+
+
+def request_profile(mode: str, seconds: float, top: int, directory: str = PROFILES_DIR) -> str:
+    """
+    Ask the other workers to run a profile, return the id of the profile
+    """
+    profile_id = shortuuid.uuid()
+    _write_json(os.path.join(directory, f"{profile_id}.request.json"), {
+        'id': profile_id, 'pid': os.getpid(), 'mode': mode, 'seconds': seconds, 'top': top, 'at': time.time(),
+    })
+    return profile_id
+
+
+def pending_requests(directory: str = PROFILES_DIR) -> List[Dict[str, Any]]:
+    """
+    List the profiles requested by other workers that are not over yet
+    """
+    requests = []
+    for r in metrics.read_snapshots(directory):
+        if 'id' in r and r['pid'] != os.getpid() and time.time() < r['at'] + r['seconds']:
+            requests.append(r)
+    return requests
+
+
+def write_result(profile_id: str, result: Dict[str, Any], directory: str = PROFILES_DIR) -> None:
+    """
+    Write the result of this worker for a profile requested by another worker
+    """
+    _write_json(os.path.join(directory, profile_id, f"{os.getpid()}.json"), result)
+
+
+async def collect_results(profile_id: str, n: int, timeout_s: float,
+                          directory: str = PROFILES_DIR) -> List[Dict[str, Any]]:
+    """
+    Wait until n workers wrote their result for a profile, or timeout_s passed, and return the results. The files
+    of the profile are removed.
+    """
+    deadline = time.monotonic() + timeout_s
+    results = metrics.read_snapshots(os.path.join(directory, profile_id))
+    while len(results) < n and time.monotonic() < deadline:
+        await asyncio.sleep(config.CONFIG_PROFILE_POLL_INTERVAL_S)
+        results = metrics.read_snapshots(os.path.join(directory, profile_id))
+
+    for path in glob.glob(os.path.join(directory, profile_id, "*")) + \
+            glob.glob(os.path.join(directory, f"{profile_id}.request.json")):
+        with contextlib.suppress(OSError):
+            os.remove(path)
+    with contextlib.suppress(OSError):
+        os.rmdir(os.path.join(directory, profile_id))
+    return results
@@ -0,0 +1,172 @@
+"""
+This module guards the query filters clients send with list requests.
+
+A filter may only use the operators and fields allowed for its collection: clients cannot filter on secrets (e.g. by
+password hash), run code on the server ($where, $function) or send operators that cannot use an index ($text,
+unanchored or negated $regex). Queries run with a time limit, slow and rejected ones are logged with the route they
+ran for.
+Every database command is attributed to the route, background task or event handler it runs for, see
+db.CommandMonitor.
+"""
+
+import collections
+import contextlib
+import time
+from contextvars import ContextVar
+from typing import Any, Counter, Dict, Iterator, Optional, Set, Tuple
+
+import pymongo.errors
+from loguru import logger
+
+from src.components import config, errors
+
+# the route the current query runs for, set for each request, background task and event handler
+query_route: ContextVar[str] = ContextVar('query_route', default='-')
+# the database commands run for the current request or event handler, by command and collection
+command_counts: ContextVar[Optional[Counter[Tuple[str, str]]]] = ContextVar('command_counts', default=None)
+
+_LOGICAL_OPERATORS = {'$and', '$or', '$nor'}
+_FIELD_OPERATORS = {'$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$exists', '$not', '$regex'}
+
+# the fields of each collection clients may filter on, by collection name
+ALLOWED_FIELDS: Dict[str, Set[str]] = {
+    config.CONFIG_USER_COLLECTION_NAME: {
+        'uid', 'uuid', 'username', 'email', 'role', 'status', 'resource_status', 'resource_version',
+    },
+    config.CONFIG_POD_COLLECTION_NAME: {
+        'pod_id', 'name', 'template_ref', 'username', 'user_uuid', 'cpu_lim_m_cpu', 'mem_lim_mb', 'storage_lim_mb',
+        'gpu', 'timeout_s', 'created_at', 'started_at', 'accessed_at', 'current_status', 'target_status',
+        'resource_status', 'resource_version',
+    },
+    config.CONFIG_TEMPLATE_COLLECTION_NAME: {
+        'template_id', 'name', 'image_ref', 'enabled', 'resource_status', 'resource_version',
+    },
+}
+
+
+def _check_condition(condition: Any, depth: int) -> Optional[str]:
+    if depth > config.CONFIG_QUERY_MAX_DEPTH:
+        return "filter is nested too deeply"
+    if isinstance(condition, list) and len(condition) > config.CONFIG_QUERY_MAX_IN:
+        return f"more than {config.CONFIG_QUERY_MAX_IN} values"
+    if not isinstance(condition, dict) or not any(k.startswith('$') for k in condition):
+        return None  # equality
+
+    for op, arg in condition.items():
+        if op not in _FIELD_OPERATORS:
+            return f"operator {op} is not allowed"
+        if op in ('$in', '$nin') and (not isinstance(arg, list) or len(arg) > config.CONFIG_QUERY_MAX_IN):
+            return f"{op} takes a list of up to {config.CONFIG_QUERY_MAX_IN} values"
+        if op == '$regex' and (not isinstance(arg, str) or not arg.startswith('^')):
+            return "$regex must be anchored with ^"
+        if op == '$not':
+            if not isinstance(arg, dict):
+                return "$not takes an operator expression"
+            if '$regex' in arg:
+                return "$regex cannot be negated"  # the complement of a prefix is not an index range
+            reason = _check_condition(arg, depth + 1)
+            if reason is not None:
+                return reason
+    return None
+
+
+def _check_filter(fields: Set[str], query_filter: Any, depth: int) -> Optional[str]:
+    if not isinstance(query_filter, dict):
+        return "filter must be an object"
+    if depth > config.CONFIG_QUERY_MAX_DEPTH:
+        return "filter is nested too deeply"
+
+    for key, value in query_filter.items():
+        if key in _LOGICAL_OPERATORS:
+            if not isinstance(value, list) or not 0 < len(value) <= config.CONFIG_QUERY_MAX_IN:
+                return f"{key} takes a list of up to {config.CONFIG_QUERY_MAX_IN} filters"
+            for sub_filter in value:
+                reason = _check_filter(fields, sub_filter, depth + 1)
+                if reason is not None:
+                    return reason
+        elif key.startswith('$'):
+            return f"operator {key} is not allowed"
+        elif key not in fields:
+            return f"field {key} is not allowed"
+        else:
+            reason = _check_condition(value, depth + 1)
+            if reason is not None:
+                return reason
+    return None
+
+
+def check_query_filter(collection_name: str, query_filter: Any) -> Optional[Exception]:
+    """
+    Check a query filter sent by a client against the fields and operators allowed for the collection
+    """
+    reason = _check_filter(ALLOWED_FIELDS.get(collection_name, set()), query_filter, 0)
+    if reason is None:
+        return None
+    logger.warning(f"query on {collection_name} rejected for {query_route.get()}: {reason}, filter: {query_filter}")
+    return errors.query_filter_not_allowed
+
+
+def query_shape(query_filter: Any) -> Any:
+    """
+    Return the shape of a query filter, the filter with its values replaced by their type. Queries of the same
+    shape get the same plan.
+    """
+    if isinstance(query_filter, dict):
+        return tuple((k, query_shape(v)) for k, v in sorted(query_filter.items()))
+    if isinstance(query_filter, list):
+        return tuple(query_shape(v) for v in query_filter)
+    return type(query_filter).__name__
+
+
+def query_error(e: BaseException) -> Exception:
+    """
+    Map an exception raised by a query to the error returned to the client
+    """
+    if e is errors.query_not_indexed:
+        return errors.query_not_indexed
+    if isinstance(e, pymongo.errors.ExecutionTimeout):
+        logger.warning(f"query timed out for {query_route.get()}: {e}")
+        return errors.query_timeout
+    logger.error(f"get_collection error: {e}")
+    return errors.db_connection_error
+
+
+@contextlib.contextmanager
+def log_slow_query(collection_name: str, query_filter: Dict[str, Any]) -> Iterator[None]:
+    """
+    Log the query run in the block if it takes longer than CONFIG_QUERY_SLOW_MS
+    """
+    start = time.perf_counter()
+    yield
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    if elapsed_ms > config.CONFIG_QUERY_SLOW_MS:
+        logger.warning(f"slow query on {collection_name} for {query_route.get()}: {elapsed_ms:.0f}ms, "
+                       f"filter: {query_filter}")
+
+
+def check_repeated_commands(counts: Counter[Tuple[str, str]]) -> None:
+    """
+    Log the commands run more than CONFIG_DB_REPEATED_COMMANDS_WARN times on a collection for the current route,
+    the sign of documents read or written one by one in a loop
+    """
+    repeated = {
+        f"{command} {collection}": n for (command, collection), n in counts.items()
+        if n > config.CONFIG_DB_REPEATED_COMMANDS_WARN
+    }
+    if len(repeated) > 0:
+        logger.warning(f"repeated database commands for {query_route.get()}: {repeated}")
+
+
+@contextlib.contextmanager
+def attributed(route: str) -> Iterator[None]:
+    """
+    Attribute the database commands run in the block to route, and check them for repeated commands
+    """
+    counts = collections.Counter()
+    route_token, counts_token = query_route.set(route), command_counts.set(counts)
+    try:
+        yield
+    finally:
+        check_repeated_commands(counts)
+        command_counts.reset(counts_token)
+        query_route.reset(route_token)
@@ -26,7 +26,8 @@ metadata:
   annotations:
     nginx.ingress.kubernetes.io/proxy-body-size: "40960M"
     nginx.ingress.kubernetes.io/auth-always-set-cookie: 'true'
-    nginx.ingress.kubernetes.io/auth-cache-key: $cookie__${{ CONFIG_AUTH_COOKIES_NAME }}
+    nginx.ingress.kubernetes.io/auth-cache-key: $cookie_${{ CONFIG_AUTH_COOKIES_NAME }}$http_authorization$arg_${{ CONFIG_AUTH_COOKIES_NAME }}
+    nginx.ingress.kubernetes.io/auth-cache-duration: ${{ CONFIG_AUTH_CACHE_DURATION }}
     nginx.ingress.kubernetes.io/auth-url: ${{ CONFIG_AUTH_ENDPOINT }}/v1/auth/token/validate/${{ POD_USERNAME }}
   name: clpl-ingress-${{ POD_ID }}
 spec:
@@ -89,6 +90,7 @@ spec:
         "POD_USERNAME": "username",
         "TEMPLATE_IMAGE_REF": "davidliyutong/code-server-speit:latest",
         "CONFIG_AUTH_COOKIES_NAME": "clpl_auth_token",
+        "CONFIG_AUTH_CACHE_DURATION": "200 202 60s",
         "CONFIG_WORKSPACE_HOSTNAME": "workspace.example.org",
         "CONFIG_WORKSPACE_TLS_SECRET": "workspace-tls-secret",
         "CONFIG_NGINX_CLASS": "nginx",
@@ -0,0 +1,44 @@
+"""
+This module implements the in-memory token revocation table.
+"""
+
+from typing import Any, Dict, Iterable, Tuple
+
+
+class RevocationTable:
+    """
+    Status epochs of the users whose status or role changed, keyed by uid. Each change takes the next value of
+    the global status epoch, and tokens carry the epoch of their user at issue time. A token is revoked when its
+    user is no longer active, or changed after the token was issued.
+
+    Users that never changed are not in the table, so it stays small. It is refreshed by polling, never read
+    from the database on the request path.
+    """
+    __slots__ = ('epoch', '_users')
+
+    def __init__(self):
+        self.epoch = 0  # the global status epoch the table is up-to-date with
+        self._users: Dict[int, Tuple[int, bool]] = {}
+
+    def __len__(self):
+        return len(self._users)
+
+    def update(self, epoch: int, changes: Iterable[Tuple[int, int, bool]]) -> int:
+        """
+        Apply (uid, epoch, active) changes, up to the global epoch. Return the number of changes that were new.
+        """
+        applied = 0
+        for uid, user_epoch, active in changes:
+            old = self._users.get(uid)
+            if old is None or old[0] < user_epoch:
+                self._users[uid] = (user_epoch, active)
+                applied += 1
+        self.epoch = max(self.epoch, epoch)
+        return applied
+
+    def is_revoked(self, payload: Dict[str, Any]) -> bool:
+        entry = self._users.get(payload.get('uid'))
+        if entry is None:
+            return False
+        epoch, active = entry
+        return not active or payload.get('epoch', 0) < epoch
@@ -0,0 +1,169 @@
+"""
+This module detects stalls of the event loop and finds the code that causes them.
+
+A watchdog thread schedules a callback on the loop and waits for the loop to run it. When the loop does not run it
+within the threshold, a callback is blocking the loop, e.g. a synchronous Kubernetes call, bcrypt or YAML parsing: the
+thread samples the stack of the loop's thread until the loop runs again, and attributes the stall to the location it
+was seen at the most, the innermost frame of our own code. Stalls are aggregated by location. Each worker writes its
+stalls to a file of its own in STALLS_DIR, so that the stalls of all workers are reported together.
+"""
+
+import asyncio
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from src.components import config, metrics
+
+STALLS_DIR = os.path.join(metrics.METRICS_DIR, "stalls")
+
+_SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_ROOT_DIR = os.path.dirname(_SRC_DIR)
+
+
+def short_path(filename: str) -> str:
+    """
+    The path of filename relative to the repository or to site-packages
+    """
+    if filename.startswith(_ROOT_DIR + os.sep):
+        return os.path.relpath(filename, _ROOT_DIR)
+    _, sep, tail = filename.rpartition("site-packages" + os.sep)
+    return tail if sep else os.path.basename(filename)
+
+
+def _location(stack: traceback.StackSummary) -> str:
+    """
+    The innermost frame of our code in stack, or the innermost frame if none is ours
+    """
+    frame = next((f for f in reversed(stack) if f.filename.startswith(_SRC_DIR + os.sep)), stack[-1])
+    return f"{short_path(frame.filename)}:{frame.lineno} in {frame.name}"
+
+
+def _format_stack(stack: traceback.StackSummary) -> List[str]:
+    return [f"{short_path(f.filename)}:{f.lineno} in {f.name}" for f in stack[-config.CONFIG_STALL_STACK_DEPTH:]]
+
+
+class StallWatchdog:
+    """
+    Watch the event loop of this worker for callbacks that run longer than threshold_s
+    """
+
+    def __init__(self,
+                 threshold_s: float,
+                 sample_interval_s: float = config.CONFIG_STALL_SAMPLE_INTERVAL_S,
+                 check_interval_s: float = config.CONFIG_STALL_CHECK_INTERVAL_S,
+                 directory: str = STALLS_DIR):
+        self.threshold_s = threshold_s
+        self.sample_interval_s = sample_interval_s
+        self.check_interval_s = check_interval_s
+        self.directory = directory
+        self.stalls: Dict[str, Dict[str, Any]] = {}  # by location
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Start watching loop, must be called from the thread that runs it
+        """
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="stall-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    def _sample(self) -> Optional[traceback.StackSummary]:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        return None if frame is None else traceback.extract_stack(frame)
+
+    def _run(self) -> None:
+        ran = threading.Event()
+        while not self._stopped.wait(self.check_interval_s):
+            ran.clear()
+            sent_at = time.perf_counter()
+            try:
+                self._loop.call_soon_threadsafe(ran.set)
+            except RuntimeError:
+                return  # the loop is closed
+            if ran.wait(self.threshold_s):
+                continue
+
+            # the loop is stuck in a callback, sample it until it runs again
+            samples = []
+            while True:
+                stack = self._sample()
+                if stack is not None and len(stack) > 0:
+                    samples.append(stack)
+                if ran.wait(self.sample_interval_s) or self._stopped.is_set():
+                    break
+            self.record(samples, time.perf_counter() - sent_at)
+
+    def record(self, samples: List[traceback.StackSummary], duration_s: float) -> None:
+        """
+        Record a stall of duration_s, attributed to the location seen the most in samples, and log it
+        """
+        if len(samples) == 0:
+            return
+        locations = [_location(s) for s in samples]
+        location = collections.Counter(locations).most_common(1)[0][0]
+        stack = _format_stack(samples[locations.index(location)])
+        duration_ms = round(duration_s * 1000)
+
+        with self._lock:
+            stall = self.stalls.setdefault(location, {
+                'location': location, 'count': 0, 'total_ms': 0, 'max_ms': 0, 'stack': stack,
+            })
+            stall['count'] += 1
+            stall['total_ms'] += duration_ms
+            if duration_ms >= stall['max_ms']:
+                stall['max_ms'], stall['stack'] = duration_ms, stack
+        logger.warning(f"event loop stalled for {duration_ms}ms at {location}:\n  " + "\n  ".join(stack))
+
+        try:
+            self.write()
+        except OSError as e:
+            logger.debug(f"stalls not written: {e}")
+
+    def write(self) -> None:
+        """
+        Write the stalls of this worker to its file in directory
+        """
+        with self._lock:
+            stalls = [dict(stall) for stall in self.stalls.values()]
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({'pid': os.getpid(), 'stalls': stalls}, f)
+        os.replace(path + ".tmp", path)  # readers never see a partial file
+
+
+def read_stalls(directory: str = STALLS_DIR) -> List[Dict[str, Any]]:
+    """
+    Read the stalls of all workers from directory and merge them by location, the longest first
+    """
+    merged: Dict[str, Dict[str, Any]] = {}
+    for s in metrics.read_snapshots(directory):
+        for stall in s.get('stalls', []):
+            m = merged.get(stall['location'])
+            if m is None:
+                merged[stall['location']] = dict(stall, workers=[s['pid']])
+                continue
+            m['count'] += stall['count']
+            m['total_ms'] += stall['total_ms']
+            m['workers'].append(s['pid'])
+            if stall['max_ms'] > m['max_ms']:
+                m['max_ms'], m['stack'] = stall['max_ms'], stall['stack']
+    return sorted(merged.values(), key=lambda m: m['total_ms'], reverse=True)
@@ -3,15 +3,20 @@ This module contains tasks that are executed periodically / once.
 """
 import asyncio
 import datetime
-from typing import Optional, Tuple, List
+import time
+from typing import BinaryIO, Optional, Tuple, List
 
 import pymongo
+import pymongo.errors
 from loguru import logger
 from motor.motor_asyncio import AsyncIOMotorClient
 from sanic import Sanic
 
-from src.apiserver.controller.types import PodUpdateRequest
-from src.apiserver.service import get_root_service
+from src.apiserver.controller.response import ndjson_chunks
+from src.apiserver.controller.types import PodListRequest, PodUpdateRequest, UserListRequest
+from src.apiserver.repo import DBRepo, PodRepo, UsageRepo, UserRepo
+from src.apiserver.repo.db import command_monitor
+from src.apiserver.service import PodService, UserService, get_root_service
 from src.apiserver.service.handler import (
     handle_user_update_event,
     handle_user_delete_event,
@@ -20,7 +25,7 @@ from src.apiserver.service.handler import (
     handle_pod_create_update_event,
     handle_pod_delete_event
 )
-from src.components import datamodels, config
+from src.components import datamodels, config, metrics, profiler
 from src.components.config import APIServerConfig
 from src.components.datamodels import PodModel, PodStatusEnum
 from src.components.events import (
@@ -31,6 +36,8 @@ from src.components.events import (
     PodCreateUpdateEvent,
     PodDeleteEvent
 )
+from src.components.hlc import next_resource_version
+from src.components.query_guard import attributed, query_route
 from src.components.utils import get_k8s_client
 
 
@@ -40,7 +47,7 @@ def get_mongo_db_connection(opt: APIServerConfig) -> pymongo.MongoClient:
     """
     _db_uri = f'mongodb://{opt.db_username}:{opt.db_password}@{opt.db_host}:{opt.db_port}'
     logger.debug(f"connecting to MongoDB at {_db_uri}")
-    conn = pymongo.MongoClient(_db_uri, connect=True)
+    conn = pymongo.MongoClient(_db_uri, connect=True, event_listeners=[command_monitor])
     return conn
 
 
@@ -50,7 +57,7 @@ def get_async_mongo_db_connection(opt: APIServerConfig) -> AsyncIOMotorClient:
     """
     _db_uri = f'mongodb://{opt.db_username}:{opt.db_password}@{opt.db_host}:{opt.db_port}'
     logger.debug(f"connecting to MongoDB at {_db_uri}")
-    return AsyncIOMotorClient(_db_uri)
+    return AsyncIOMotorClient(_db_uri, event_listeners=[command_monitor])
 
 
 def check_and_create_admin_user(opt: APIServerConfig) -> Optional[Exception]:
@@ -91,6 +98,98 @@ def check_and_create_admin_user(opt: APIServerConfig) -> Optional[Exception]:
         return e
 
 
+def create_username_index(col: pymongo.collection.Collection) -> None:
+    """
+    Create the unique index on the usernames. A database from before the index may hold duplicate usernames, from
+    the race the index closes: they are logged for an admin to resolve, and the index is created on a later start.
+    """
+    try:
+        col.create_index([("username", pymongo.ASCENDING)], unique=True)
+    except pymongo.errors.OperationFailure as e:
+        if e.code != 11000:  # duplicate key
+            raise
+        duplicates = sorted(d['_id'] for d in col.aggregate([
+            {'$group': {'_id': '$username', 'n': {'$sum': 1}}},
+            {'$match': {'n': {'$gt': 1}}},
+        ]))
+        logger.error(f"unique index on usernames not created, resolve the duplicate usernames {duplicates} "
+                     f"and restart")
+
+
+def lock_password_less_users(col: pymongo.collection.Collection) -> int:
+    """
+    Drop the htpasswd of the password-less accounts created when it was still hashed from the empty password, and
+    set them pending so that their k8s credentials are rewritten with a locked entry. Return the number of users.
+    """
+    ret = col.update_many(
+        {"password": datamodels.empty_password_hash, "htpasswd": {"$ne": None}},
+        {"$set": {"htpasswd": None,
+                  "resource_status": datamodels.ResourceStatusEnum.pending.value,
+                  "resource_version": next_resource_version()}}
+    )
+    return ret.modified_count
+
+
+def migrate_password_less_users(opt: APIServerConfig) -> Optional[Exception]:
+    """
+    Lock the htpasswd of password-less accounts, see lock_password_less_users.
+    """
+    conn = get_mongo_db_connection(opt)
+    try:
+        n = lock_password_less_users(conn[opt.db_database][datamodels.user_collection_name])
+        if n > 0:
+            # recover_from_crash rewrites the credentials of pending users on start
+            logger.info(f"{n} password-less users locked, their credentials are rewritten on start")
+            conn[opt.db_database][datamodels.global_collection_name].update_one(
+                {"_id": "global"}, {"$set": {"flag_crashed": True}}
+            )
+        return None
+    except Exception as e:
+        logger.exception(e)
+        return e
+
+
+def check_and_create_indexes(opt: APIServerConfig) -> Optional[Exception]:
+    """
+    Check and create indexes of collections.
+    """
+
+    # establish MongoDB connection
+    conn = get_mongo_db_connection(opt)
+
+    try:
+        # usernames are unique, concurrent first logins rely on it
+        col = conn[opt.db_database][datamodels.user_collection_name]
+        create_username_index(col)
+
+        # users are listed and streamed sorted by uid
+        col.create_index([("uid", pymongo.ASCENDING)])
+
+        # usage is materialized once per user
+        col = conn[opt.db_database][datamodels.usage_collection_name]
+        col.create_index([("username", pymongo.ASCENDING)], unique=True)
+
+        # pods are touched by pod_id on workspace access
+        col = conn[opt.db_database][datamodels.pod_collection_name]
+        col.create_index([("pod_id", pymongo.ASCENDING)])
+
+        # admins list and stream all pods sorted by name, users their own pods
+        col.create_index([("name", pymongo.ASCENDING)])
+        col.create_index([("username", pymongo.ASCENDING), ("name", pymongo.ASCENDING)])
+
+        # pod watches poll for writes by version
+        col.create_index([("resource_version", pymongo.ASCENDING)])
+
+        # revocations are kept once per uid, and polled by epoch
+        col = conn[opt.db_database][datamodels.revocation_collection_name]
+        col.create_index([("uid", pymongo.ASCENDING)], unique=True)
+        col.create_index([("epoch", pymongo.ASCENDING)])
+        return None
+    except Exception as e:
+        logger.exception(e)
+        return e
+
+
 async def set_crash_flag(opt: APIServerConfig, flag: bool) -> Optional[Exception]:
     conn = get_async_mongo_db_connection(opt)
     col = conn[opt.db_database][datamodels.global_collection_name]
@@ -196,24 +295,27 @@ async def recover_from_crash(app: Sanic) -> Tuple[bool, Optional[Exception]]:
 async def scan_pods(app: Sanic) -> None:
     running_pods: List[PodModel]
     logger.info("pod scanning task started")
+    query_route.set("task:scan_pods")
     await asyncio.sleep(5)  # delay for a short while
     while True:
         try:
             srv = get_root_service()
-            _, running_pods, _ = await srv.pod_service.repo.list(extra_query_filter={"current_status": "running"})
-            now = datetime.datetime.utcnow()
-
-            # filter timeouted pods
-            out_pods = filter(
-                lambda pod: pod.accessed_at + datetime.timedelta(seconds=pod.timeout_s) < now,
-                running_pods
-            )
-
-            # shut-em down
-            tasks = [
-                srv.pod_service.update(app, PodUpdateRequest(pod_id=pod.pod_id, target_status=PodStatusEnum.stopped))
-                for pod in out_pods]
-            await asyncio.gather(*tasks)
+            with attributed("task:scan_pods"):
+                _, running_pods, _ = await srv.pod_service.repo.list(extra_query_filter={"current_status": "running"})
+                now = datetime.datetime.utcnow()
+
+                # filter timeouted pods
+                out_pods = filter(
+                    lambda pod: pod.accessed_at + datetime.timedelta(seconds=pod.timeout_s) < now,
+                    running_pods
+                )
+
+                # shut-em down
+                tasks = [
+                    srv.pod_service.update(
+                        app, PodUpdateRequest(pod_id=pod.pod_id, target_status=PodStatusEnum.stopped)
+                    ) for pod in out_pods]
+                await asyncio.gather(*tasks)
             logger.info(f"pod scanning task looped, {len(tasks)} pods stopped")
         except asyncio.CancelledError:
             logger.info("pod scanning task cancelled")
@@ -222,3 +324,184 @@ async def scan_pods(app: Sanic) -> None:
             logger.exception(e)
 
         await asyncio.sleep(config.CONFIG_SCAN_POD_INTERVAL_S)
+
+
+async def audit_usage(app: Sanic) -> None:
+    """
+    Periodically recompute per-user usage from the pods collection and correct drift.
+    """
+    suspects = {}
+    logger.info("usage audit task started")
+    query_route.set("task:audit_usage")
+    await asyncio.sleep(5)  # delay for a short while
+    while True:
+        try:
+            srv = get_root_service()
+            suspects, err = await srv.pod_service.usage_repo.audit(suspects)
+            if err is not None:
+                logger.error(f"usage audit task failed: {err}")
+            else:
+                logger.info(f"usage audit task looped, {len(suspects)} users drifted")
+        except asyncio.CancelledError:
+            logger.info("usage audit task cancelled")
+            break
+        except Exception as e:
+            logger.exception(e)
+
+        await asyncio.sleep(config.CONFIG_AUDIT_USAGE_INTERVAL_S)
+
+
+async def flush_heartbeats(app: Sanic) -> None:
+    """
+    Periodically write buffered heartbeats to the database.
+    """
+    logger.info("heartbeat flush task started")
+    query_route.set("task:flush_heartbeats")
+    while True:
+        try:
+            await asyncio.sleep(config.CONFIG_HEARTBEAT_FLUSH_INTERVAL_S)
+            with attributed("task:flush_heartbeats"):
+                err = await get_root_service().heartbeat_service.flush()
+            if err is not None:
+                logger.error(f"heartbeat flush task failed: {err}")
+        except asyncio.CancelledError:
+            logger.info("heartbeat flush task cancelled")
+            _ = await get_root_service().heartbeat_service.flush()  # do not lose buffered heartbeats
+            break
+        except Exception as e:
+            logger.exception(e)
+
+
+async def poll_revocations(app: Sanic) -> None:
+    """
+    Keep the revocation table of this worker up-to-date with the global status epoch.
+    """
+    logger.info("revocation poll task started")
+    query_route.set("task:poll_revocations")
+    revocations = app.ctx.revocations
+    while True:
+        try:
+            epoch, changes, err = await get_root_service().user_service.repo.list_revocations(revocations.epoch)
+            if err is not None:
+                logger.error(f"revocation poll task failed: {err}")
+            else:
+                applied = revocations.update(epoch, changes)
+                if applied > 0:
+                    logger.debug(f"revocation table updated to epoch {epoch}, {applied} changes")
+            await asyncio.sleep(config.CONFIG_REVOCATION_POLL_INTERVAL_S)
+        except asyncio.CancelledError:
+            logger.info("revocation poll task cancelled")
+            break
+        except Exception as e:
+            logger.exception(e)
+            await asyncio.sleep(config.CONFIG_REVOCATION_POLL_INTERVAL_S)
+
+
+async def poll_pod_status(app: Sanic) -> None:
+    """
+    Publish the pod status writes of all workers to the watchers of this worker.
+    """
+    logger.info("pod status poll task started")
+    query_route.set("task:poll_pod_status")
+    hub = get_root_service().pod_service.watch
+    while True:
+        try:
+            await asyncio.sleep(config.CONFIG_WATCH_POLL_INTERVAL_S)
+            if len(hub) == 0:
+                continue
+            # look back a little, for writes that were issued a version before others but landed after them
+            events, err = await get_root_service().pod_service.repo.list_status(hub.cursor - hub.lookback)
+            if err is not None:
+                logger.error(f"pod status poll task failed: {err}")
+            for ev in events:
+                hub.publish(ev)
+        except asyncio.CancelledError:
+            logger.info("pod status poll task cancelled")
+            break
+        except Exception as e:
+            logger.exception(e)
+
+
+async def collect_metrics(app: Sanic) -> None:
+    """
+    Measure the event loop lag of this worker, and write its metrics for the worker answering the next scrape.
+    """
+    logger.info("metrics task started")
+    interval = config.CONFIG_METRICS_LOOP_LAG_INTERVAL_S
+    flush_every = max(int(config.CONFIG_METRICS_FLUSH_INTERVAL_S / interval), 1)
+    n = 0
+    while True:
+        try:
+            # the loop wakes this task up late by as long as other callbacks held it
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            metrics.EVENT_LOOP_LAG.observe(max(time.perf_counter() - start - interval, 0))
+
+            n += 1
+            if n % flush_every == 0:
+                metrics.write_snapshot()
+        except asyncio.CancelledError:
+            logger.info("metrics task cancelled")
+            break
+        except Exception as e:
+            logger.exception(e)
+
+
+async def _answer_profile_request(r: dict) -> None:
+    # profile for what is left of the requested window, so that all workers cover the same seconds
+    result, err = await profiler.run_profile(r['mode'], max(r['at'] + r['seconds'] - time.time(), 0), r['top'])
+    if err is not None:
+        logger.warning(f"profile {r['id']} not run: {err}")
+        return
+    profiler.write_result(r['id'], result)
+
+
+async def poll_profile_requests(app: Sanic) -> None:
+    """
+    Run the profiles other workers request from all workers, and write the results for them.
+    """
+    logger.info("profile request task started")
+    answered = set()
+    while True:
+        try:
+            await asyncio.sleep(config.CONFIG_PROFILE_POLL_INTERVAL_S)
+            pending = profiler.pending_requests()
+            answered &= {r['id'] for r in pending}  # forget the requests that are over
+            for r in pending:
+                if r['id'] not in answered:
+                    answered.add(r['id'])
+                    app.add_task(_answer_profile_request(r), name=f"profile_{r['id']}")
+        except asyncio.CancelledError:
+            logger.info("profile request task cancelled")
+            break
+        except Exception as e:
+            logger.exception(e)
+
+
+async def export_ndjson(opt: APIServerConfig,
+                        kind: str,
+                        extra_query_filter: str,
+                        out: BinaryIO) -> Tuple[int, Optional[Exception]]:
+    """
+    Write the users or pods matching extra_query_filter to out as newline-delimited JSON, through the pipeline the
+    admin list endpoints stream with. Return the number of documents written.
+    """
+    repo = DBRepo(opt.to_sanic_config())
+    if kind == "users":
+        models, err = UserService(UserRepo(repo)).iterate(None, UserListRequest(extra_query_filter=extra_query_filter))
+    else:
+        models, err = PodService(PodRepo(repo), UsageRepo(repo)).iterate(
+            None, PodListRequest(extra_query_filter=extra_query_filter)
+        )
+    if err is not None:
+        return 0, err
+
+    n = 0
+    try:
+        async for chunk in ndjson_chunks(models):
+            out.write(chunk)
+            n += chunk.count(b"\n")
+    except Exception as e:
+        logger.exception(e)
+        return n, e
+    return n, None
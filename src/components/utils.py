@@ -9,9 +9,9 @@ import secrets
 import signal
 from functools import wraps
 from typing import Optional, Dict, Any, Tuple, List
+from urllib.parse import urlparse
 
 import mongoquery
-from kubernetes import client
 from loguru import logger
 
 from src.components import errors
@@ -64,10 +64,12 @@ def get_k8s_client(host: str,
                    ca_cert_path: str,
                    token_path: str,
                    verify_ssl: bool = False,
-                   debug: bool = False) -> client:
+                   debug: bool = False):
     """
     Get Kubernetes client.
     """
+    # attention: imported here, kubernetes is slow to import and not needed by authd
+    from kubernetes import client
 
     api_server = f"https://{host}:{str(port)}"
     ca_cert_path = ca_cert_path
@@ -100,6 +102,20 @@ def parse_bearer(bearer_str: Optional[str]) -> Tuple[Optional[str], Optional[Exc
     return authorization_header_split[1], None
 
 
+def parse_pod_id(url: Optional[str], workspace_hostname: str) -> Tuple[Optional[str], Optional[Exception]]:
+    """
+    Parse pod_id from a workspace url, whose host is ${POD_ID}.${WORKSPACE_HOSTNAME}
+    """
+    if url is None or len(url) == 0:
+        return None, errors.header_missing
+    host = urlparse(url).hostname
+    suffix = '.' + workspace_hostname
+    if host is None or not host.endswith(suffix) or len(host) == len(suffix):
+        return None, errors.header_malformed
+
+    return host[:-len(suffix)], None
+
+
 def parse_basic(basic_str: Optional[str]) -> Tuple[Optional[Tuple[str, str]], Optional[Exception]]:
     """
     Parse basic auth header
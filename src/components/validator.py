@@ -0,0 +1,211 @@
+"""
+This module validates the tokens that the ingress forwards to the auth-url, and hands out device tokens.
+
+It is on the hot path of every proxied workspace request, so verified tokens are memoized, and only
+jwt and the project config are imported here.
+"""
+
+import hashlib
+import http
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import jwt
+from loguru import logger
+from sanic.response import json as json_response
+
+from src.components import config, errors
+from src.components.cache import TTLCache
+from src.components.revocation import RevocationTable
+from src.components.utils import parse_bearer
+
+# attention: same as datamodels.UserRoleEnum.device, not imported to keep this module light
+_DEVICE_ROLE = "device"
+
+
+class ValidatedToken:
+    """
+    Result of a successful validation. token is the device token to hand back to the client,
+    it is the presented token itself unless it had to be rotated.
+    """
+    __slots__ = ('payload', 'token', 'expires_at')
+
+    def __init__(self, payload: Dict[str, Any], token: str, expires_at: float):
+        self.payload = payload
+        self.token = token
+        self.expires_at = expires_at
+
+
+class DeviceTokenValidator:
+    """
+    Verify tokens and rotate them into device tokens. Results are cached by token digest until
+    the token expires or its device token falls within the renew threshold, so repeated
+    validations of the same token are a dictionary lookup. Revocations are checked on every call.
+    """
+
+    def __init__(self,
+                 secret: str,
+                 algorithm: str,
+                 maxsize: int = config.CONFIG_TOKEN_CACHE_SIZE,
+                 revocations: Optional[RevocationTable] = None):
+        self.secret = secret
+        self.algorithm = algorithm
+        self.revocations = revocations
+        self._cache: TTLCache[ValidatedToken] = TTLCache(maxsize)
+
+    def _verify(self, token: str, now: float) -> Tuple[Optional[ValidatedToken], Optional[Exception]]:
+        # decode the jwt and check the signature
+        try:
+            payload = jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        except Exception as e:
+            logger.debug(f"validation_err: {str(e)}")
+            return None, errors.invalid_token
+
+        # rotate token if:
+        # case 1: the token will expire in less than 6 days
+        # case 2: the token is not device token
+        if payload['exp'] < now + config.CONFIG_DEVICE_TOKEN_RENEW_THRESHOLD_S or payload['role'] != _DEVICE_ROLE:
+            logger.debug(f"validation_warning: token will expire in less "
+                         f"than {config.CONFIG_DEVICE_TOKEN_RENEW_THRESHOLD_S} seconds, rotate token")
+            device_payload = {
+                'username': payload['username'],
+                'exp': int(now) + config.CONFIG_DEVICE_TOKEN_EXPIRE_S,
+                'iat': int(now),
+                'email': payload.get('email'),
+                'role': _DEVICE_ROLE,
+                'uid': payload.get('uid'),
+                'epoch': payload.get('epoch', 0),
+            }
+            device_token = jwt.encode(device_payload, self.secret, algorithm=self.algorithm)
+        else:
+            device_payload, device_token = payload, token
+
+        # the result holds as long as the presented token is valid and its device token is fresh
+        expires_at = min(payload['exp'], device_payload['exp'] - config.CONFIG_DEVICE_TOKEN_RENEW_THRESHOLD_S)
+        return ValidatedToken(device_payload, device_token, expires_at), None
+
+    def validate(self, token: str, username: str) -> Tuple[Optional[ValidatedToken], Optional[Exception]]:
+        now = time.time()
+        key = hashlib.sha256(token.encode()).digest()
+
+        res = self._cache.get(key, now)
+        if res is None:
+            res, err = self._verify(token, now)
+            if err is not None:
+                return None, err
+            if res.expires_at > now:
+                self._cache.put(key, res, res.expires_at)
+
+        # if user not match, reject
+        if res.payload['username'] != username:
+            logger.debug(f"validation_err: expected user to be {username} but got {res.payload['username']}")
+            return None, errors.user_not_allowed
+
+        # if user was deactivated or changed since the token was issued, reject
+        if self.revocations is not None and self.revocations.is_revoked(res.payload):
+            logger.debug(f"validation_err: token of user {username} revoked")
+            return None, errors.token_revoked
+
+        return res, None
+
+
+def get_authorized_token_response(token: Optional[str], max_age: int = 0):
+    """
+    This function returns an authorized response for token/validation endpoint
+    It also sets a cookie config.CONFIG_AUTH_COOKIES_NAME=token, unless token is None (the client already has it).
+    max_age is how long the ingress may cache the response, X-Accel-Expires overrides its auth-cache-duration.
+    """
+    headers = {'WWW-Authenticate': "Bearer"}
+    if max_age > 0:
+        headers['X-Accel-Expires'] = str(max_age)
+        headers['Cache-Control'] = f"private, max-age={max_age}"
+    else:
+        headers['Cache-Control'] = "no-store"
+
+    r = json_response(
+        body={'description': '', 'status': http.HTTPStatus.OK.value, 'message': 'AUTHORIZED'},
+        headers=headers,
+        status=http.HTTPStatus.OK
+    )
+    if token is not None:
+        r.add_cookie(
+            config.CONFIG_AUTH_COOKIES_NAME,
+            token,
+            max_age=config.CONFIG_DEVICE_TOKEN_EXPIRE_S
+        )
+    return r
+
+
+def get_unauthorized_token_response():
+    """
+    This function returns an unauthorized response for token/validation endpoint
+    It also deletes a the cookie config.CONFIG_AUTH_COOKIES_NAME
+    """
+    r = json_response(
+        body={'description': '', 'status': http.HTTPStatus.UNAUTHORIZED.value, 'message': 'UNAUTHORIZED'},
+        status=http.HTTPStatus.UNAUTHORIZED
+    )
+    r.delete_cookie(config.CONFIG_AUTH_COOKIES_NAME)
+    return r
+
+
+def extract_token(request) -> Tuple[Optional[str], Optional[Exception]]:
+    """
+    Get the token from the cookie, then header.Authorization, then urlParam.clpl_auth_token of the original url
+    """
+    # try to get from cookies
+    token = request.cookies.get(config.CONFIG_AUTH_COOKIES_NAME, None)
+    if token is not None:
+        return token, None
+
+    # cookie does not exists, fallback to header
+    token, err = parse_bearer(request.headers.get('Authorization'))
+    if err is None:
+        return token, None
+
+    # header does not exists, fallback to query
+    logger.debug(f"validation_err: {str(err)}, fallback to query")
+
+    # attention: the proxy must pass the x-original-url header that contains original url
+    origin_url = request.headers.get(config.CONFIG_PROXY_ORIGIN_URL_HEADER)
+    if origin_url is None:
+        logger.debug(f"validation_err: misconfigured proxy, no {config.CONFIG_PROXY_ORIGIN_URL_HEADER}")
+        return None, errors.header_missing
+
+    token = parse_qs(urlparse(origin_url).query).get(config.CONFIG_AUTH_COOKIES_NAME, [None])[0]
+    if token is None:
+        logger.debug(f"validation_err: {config.CONFIG_AUTH_COOKIES_NAME} not found in query")
+        return None, errors.invalid_token
+
+    return token, None
+
+
+async def handle_token_validate(request,
+                                username: str,
+                                validator: DeviceTokenValidator,
+                                on_success: Optional[Callable[[Any, str, Dict[str, Any]], None]] = None,
+                                cache_duration_s: int = 0):
+    """
+    Validate the token of a request forwarded by the ingress, return 200 with the device token as cookie, or 401.
+    on_success is called with the request, the validated username and the device token payload, it must not block.
+    A 200 may be cached by the ingress for cache_duration_s, but never beyond the validity of the token.
+    """
+    token, err = extract_token(request)
+    if err is not None:
+        return get_unauthorized_token_response()
+
+    res, err = validator.validate(token, username)
+    if err is not None:
+        return get_unauthorized_token_response()
+
+    if on_success is not None:
+        on_success(request, username, res.payload)
+
+    # the client already holds the device token as cookie, do not set it again
+    cookie = None if res.token == request.cookies.get(config.CONFIG_AUTH_COOKIES_NAME) else res.token
+    max_age = min(cache_duration_s, int(res.expires_at - time.time()))
+
+    # return authorized response
+    logger.debug("validation_success")
+    return get_authorized_token_response(token=cookie, max_age=max_age)
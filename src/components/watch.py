@@ -0,0 +1,112 @@
+"""
+This module implements the per-worker pod status watch hub.
+"""
+
+import asyncio
+import collections
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from src.components.datamodels import ResourceStatusEnum
+from src.components.events import PodStatusEvent
+from src.components.hlc import next_resource_version
+
+
+def _status_of(ev: PodStatusEvent) -> tuple:
+    return ev.target_status, ev.current_status, ev.current_status_reason, ev.resource_status
+
+
+class WatchSubscriber:
+    """
+    A watching connection. Kept small since a worker may hold thousands of them.
+    """
+    __slots__ = ('username', 'queue', 'lagged')
+
+    def __init__(self, username: Optional[str], queue_size: int):
+        self.username = username  # None watches the pods of all users
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.lagged = False  # set when the queue overflowed, the subscriber resyncs from the database
+
+    def matches(self, ev: PodStatusEvent) -> bool:
+        return self.username is None or self.username == ev.username
+
+
+class PodWatchHub:
+    """
+    Fans pod status events out to the watchers connected to this worker.
+
+    Events are published by the status writes of this worker as they happen, and by polling the pods collection
+    for the writes of other workers. The last version and status of each pod are kept, so that an event is
+    delivered once, and writes that leave the status unchanged (e.g. accessed_at) are not delivered.
+
+    Each subscriber has a bounded queue. A subscriber that does not keep up is not waited for: it is marked
+    lagged and resyncs from the database. Recent events are kept in a backlog, to resume watches by version
+    without reading the database.
+    """
+
+    def __init__(self, queue_size: int, backlog_size: int, lookback: int):
+        self.queue_size = queue_size
+        self.lookback = lookback  # writes may become visible out of version order by up to this many versions
+        self.cursor = 0  # the max version seen
+        self._subscribers: Set[WatchSubscriber] = set()
+        self._backlog: Deque[PodStatusEvent] = collections.deque(maxlen=backlog_size)
+        self._complete_from: Optional[int] = None  # the backlog has all events after this version, None if idle
+        self._known: Dict[str, Tuple[int, tuple]] = {}
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self,
+                  username: Optional[str] = None,
+                  since: Optional[int] = None) -> Tuple[WatchSubscriber, Optional[List[PodStatusEvent]]]:
+        """
+        Register a subscriber. With since, also return the events to replay to resume a watch from version since,
+        or None if the backlog does not reach back that far and they must be read from the database.
+        """
+        if len(self._subscribers) == 0:
+            # nobody polled while idle, start over from now
+            self.cursor = max(self.cursor, next_resource_version())
+            self._complete_from = self.cursor
+        sub = WatchSubscriber(username, self.queue_size)
+        self._subscribers.add(sub)
+
+        if since is None:
+            return sub, []
+        if since - self.lookback < self._complete_from:
+            return sub, None
+        return sub, [ev for ev in self._backlog if ev.resource_version > since - self.lookback and sub.matches(ev)]
+
+    def unsubscribe(self, sub: WatchSubscriber) -> None:
+        self._subscribers.discard(sub)
+        if len(self._subscribers) == 0:
+            self._complete_from = None
+
+    def publish(self, ev: PodStatusEvent) -> bool:
+        """
+        Deliver ev to the matching subscribers, unless it is not newer than, or has the same status as, the last
+        event of the pod. Return whether it was delivered.
+        """
+        self.cursor = max(self.cursor, ev.resource_version)
+        known = self._known.get(ev.pod_id)
+        if known is not None and known[0] >= ev.resource_version:
+            return False
+        status = _status_of(ev)
+        if ev.resource_status == ResourceStatusEnum.deleted:
+            self._known.pop(ev.pod_id, None)  # the document is purged next
+        else:
+            self._known[ev.pod_id] = (ev.resource_version, status)
+        if known is not None and known[1] == status:
+            return False
+
+        # keep track of how far back the backlog reaches
+        if len(self._backlog) == self._backlog.maxlen and self._complete_from is not None:
+            self._complete_from = max(self._complete_from, self._backlog[0].resource_version)
+        self._backlog.append(ev)
+
+        for sub in self._subscribers:
+            if sub.lagged or not sub.matches(ev):
+                continue
+            try:
+                sub.queue.put_nowait(ev)
+            except asyncio.QueueFull:
+                sub.lagged = True
+        return True
@@ -0,0 +1,279 @@
+"""
+Shared helpers of the tests: run a coroutine to completion, and an in-memory stand-in for a motor collection.
+
+Import them with e.g. `from conftest import run, FakeCollection, FakeDB`. make_pod_service builds a pod service
+on them, to test quota admission through the usage repo.
+"""
+import asyncio
+import copy
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import mongoquery
+import pymongo
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def _project(document: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    if not projection:
+        return dict(document)
+    included = {k for k, v in projection.items() if v and k != '_id'}
+    if included:
+        keys = included | ({'_id'} if projection.get('_id', 1) else set())
+        return {k: v for k, v in document.items() if k in keys}
+    return {k: v for k, v in document.items() if k not in projection}
+
+
+def _apply_update(document: Dict[str, Any], update: Dict[str, Any]) -> None:
+    for k, v in update.get('$set', {}).items():
+        document[k] = v
+    for k, v in update.get('$inc', {}).items():
+        document[k] = document.get(k, 0) + v
+    for k, v in update.get('$max', {}).items():
+        document[k] = v if document.get(k) is None else max(document[k], v)
+    for k in update.get('$unset', {}):
+        document.pop(k, None)
+
+
+def _evaluate(expression: Any, document: Dict[str, Any]) -> Any:
+    if isinstance(expression, str) and expression.startswith('$'):
+        return document.get(expression[1:])
+    if isinstance(expression, dict) and '$mod' in expression:
+        value, divisor = (_evaluate(e, document) for e in expression['$mod'])
+        return (value or 0) % divisor
+    return expression
+
+
+class FakeCursor:
+    """
+    Sorts, skips and limits the documents the way the server does, and records the skip and the limit. explain
+    returns the winning plan of the collection.
+    """
+
+    def __init__(self, documents: List[Dict[str, Any]], plan: Optional[Dict[str, Any]] = None):
+        self.documents = documents
+        self.plan = plan
+        self.skipped = 0
+        self.limited = 0
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        self.documents = sorted(self.documents, key=lambda d: d[key], reverse=direction == pymongo.DESCENDING)
+        return self
+
+    def skip(self, n):
+        self.skipped = n
+        return self
+
+    def limit(self, n):
+        self.limited = n
+        return self
+
+    def _selected(self) -> List[Dict[str, Any]]:
+        documents = self.documents[self.skipped:]
+        return documents[:self.limited] if self.limited > 0 else documents
+
+    async def explain(self):
+        return {'queryPlanner': {'winningPlan': self.plan}}
+
+    async def to_list(self, length=None):
+        documents = self._selected()
+        return documents if length is None else documents[:length]
+
+    async def _iter(self):
+        for document in self._selected():
+            yield document
+
+    def __aiter__(self):
+        return self._iter()
+
+
+class FakeCollection:
+    """
+    Keeps the documents in memory and matches filters with mongoquery. Supports the $set, $inc, $max and $unset
+    updates, and the $match and $group ($sum and $max) aggregation stages. Every call is recorded in calls, by
+    method name, and every write yields to the loop first, so concurrent callers interleave.
+    """
+
+    def __init__(self, documents=(), name: str = "fake", plan: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.plan = plan
+        self.documents: List[Dict[str, Any]] = []
+        self.calls: List[str] = []
+        self.cursor: Optional[FakeCursor] = None
+        for document in documents:
+            self._add(dict(document))
+
+    def _add(self, document: Dict[str, Any]) -> Dict[str, Any]:
+        document.setdefault('_id', len(self.documents) + 1)
+        self.documents.append(document)
+        return document
+
+    def _matching(self, query_filter: Dict[str, Any]) -> List[Dict[str, Any]]:
+        query = mongoquery.Query(query_filter)
+        return [d for d in self.documents if query.match(d)]
+
+    async def estimated_document_count(self, **kwargs):
+        self.calls.append('estimated_document_count')
+        return len(self.documents)
+
+    async def count_documents(self, query_filter, **kwargs):
+        self.calls.append('count_documents')
+        return len(self._matching(query_filter))
+
+    async def find_one(self, query_filter, projection=None, **kwargs):
+        self.calls.append('find_one')
+        matched = self._matching(query_filter)
+        return _project(matched[0], projection) if matched else None
+
+    def find(self, query_filter=None, projection=None, **kwargs):
+        self.calls.append('find')
+        self.cursor = FakeCursor([_project(d, projection) for d in self._matching(query_filter or {})], self.plan)
+        return self.cursor
+
+    async def insert_one(self, document):
+        self.calls.append('insert_one')
+        await asyncio.sleep(0)
+        document = self._add(copy.deepcopy(document))
+        return SimpleNamespace(inserted_id=document['_id'], acknowledged=True)
+
+    async def _update(self, query_filter, update, many: bool, upsert: bool):
+        await asyncio.sleep(0)
+        matched = self._matching(query_filter)
+        matched = matched if many else matched[:1]
+        for document in matched:
+            _apply_update(document, update)
+        if not matched and upsert:
+            document = {k: v for k, v in query_filter.items() if not k.startswith('$') and not isinstance(v, dict)}
+            _apply_update(document, update)
+            self._add(document)
+        return SimpleNamespace(matched_count=len(matched), modified_count=len(matched), acknowledged=True)
+
+    async def update_one(self, query_filter, update, upsert=False, **kwargs):
+        self.calls.append('update_one')
+        return await self._update(query_filter, update, False, upsert)
+
+    async def update_many(self, query_filter, update, upsert=False, **kwargs):
+        self.calls.append('update_many')
+        return await self._update(query_filter, update, True, upsert)
+
+    async def find_one_and_update(self, query_filter, update, projection=None, upsert=False, return_document=False,
+                                  **kwargs):
+        self.calls.append('find_one_and_update')
+        await asyncio.sleep(0)
+        matched = self._matching(query_filter)
+        if not matched:
+            if not upsert:
+                return None
+            matched = [self._add({
+                k: v for k, v in query_filter.items() if not k.startswith('$') and not isinstance(v, dict)
+            })]
+        before = copy.deepcopy(matched[0])
+        _apply_update(matched[0], update)
+        return _project(matched[0] if return_document else before, projection)
+
+    async def find_one_and_replace(self, query_filter, replacement, projection=None, return_document=False,
+                                   **kwargs):
+        self.calls.append('find_one_and_replace')
+        await asyncio.sleep(0)
+        matched = self._matching(query_filter)
+        if not matched:
+            return None
+        before = copy.deepcopy(matched[0])
+        self.documents[self.documents.index(matched[0])] = copy.deepcopy(replacement)
+        return _project(replacement if return_document else before, projection)
+
+    async def delete_one(self, query_filter, **kwargs):
+        self.calls.append('delete_one')
+        matched = self._matching(query_filter)[:1]
+        for document in matched:
+            self.documents.remove(document)
+        return SimpleNamespace(deleted_count=len(matched), acknowledged=True)
+
+    def aggregate(self, pipeline, **kwargs):
+        self.calls.append('aggregate')
+        documents = self.documents
+        for stage in pipeline:
+            if '$match' in stage:
+                query = mongoquery.Query(stage['$match'])
+                documents = [d for d in documents if query.match(d)]
+            elif '$group' in stage:
+                groups: Dict[Any, Dict[str, Any]] = {}
+                for document in documents:
+                    key = _evaluate(stage['$group']['_id'], document)
+                    group = groups.setdefault(key, {'_id': key})
+                    for field, accumulator in stage['$group'].items():
+                        if field == '_id':
+                            continue
+                        (op, expression), = accumulator.items()
+                        value = _evaluate(expression, document)
+                        if op == '$sum':
+                            group[field] = group.get(field, 0) + value
+                        elif op == '$max':
+                            group[field] = value if group.get(field) is None else max(group[field], value)
+                documents = list(groups.values())
+        return FakeCursor(documents)
+
+
+class FakeDB:
+    """Stands in for DBRepo: returns the collection of the name, or the only collection."""
+
+    query_explain = False
+    query_max_time_ms = None
+
+    def __init__(self, *collections: FakeCollection):
+        self.collections = {c.name: c for c in collections}
+
+    def get_db_collection(self, db_name, collection_name):
+        if len(self.collections) == 1:
+            return next(iter(self.collections.values()))
+        return self.collections[collection_name]
+
+
+def make_pod_service(user, pods=()):
+    """
+    A PodService on fake pod and usage collections holding pods, with the usage they charge to their owners
+    materialized. The user repo returns user.
+    """
+    from src.apiserver.repo import PodRepo, UsageRepo
+    from src.apiserver.repo.usage import usage_of
+    from src.apiserver.service.pod import PodService
+    from src.components import datamodels
+
+    usages: Dict[str, Dict[str, Any]] = {}
+    for pod in pods:
+        usage = usages.setdefault(pod.username, datamodels.UsageModel(username=pod.username).model_dump())
+        for k, v in usage_of(pod).items():
+            usage[k] += v
+
+    db = FakeDB(
+        FakeCollection([pod.model_dump() for pod in pods], name=datamodels.pod_collection_name),
+        FakeCollection(usages.values(), name=datamodels.usage_collection_name),
+    )
+    service = PodService.__new__(PodService)
+    service.repo = PodRepo.__wrapped__(db)
+    service.usage_repo = UsageRepo.__wrapped__(db)
+
+    async def get_user(username):
+        return user, None
+
+    service.parent = SimpleNamespace(user_service=SimpleNamespace(repo=SimpleNamespace(get=get_user)),
+                                     pod_service=service)
+    return service
+
+
+def stored_usage(service, username: str = "user1") -> Dict[str, Any]:
+    """The materialized usage of username in the usage collection of a service made by make_pod_service"""
+    from src.components import datamodels
+
+    collection = service.usage_repo.db.collections[datamodels.usage_collection_name]
+    return next(d for d in collection.documents if d['username'] == username)
+
+
+class FakeApp:
+    """Drops the tasks the services add, e.g. the pod event handlers."""
+
+    async def add_task(self, coro, *args, **kwargs):
+        coro.close()
@@ -0,0 +1,59 @@
+"""
+Tests for: the standalone auth validation server.
+"""
+import base64
+import http
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import jwt
+
+from src.components import config, errors
+from src.components.config import APIServerConfig
+
+from conftest import run
+
+
+def test_authd_does_not_import_apiserver_dependencies():
+    code = (
+        "import sys, src.authd; "
+        "print(','.join(m for m in ('kubernetes', 'motor', 'sanic_ext', 'src.apiserver') if m in sys.modules))"
+    )
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == ""
+
+
+def test_authd_verifies_tokens_signed_with_the_apiserver_secret():
+    from src.apiserver.server import apiserver_check_option
+    from src.authd import authd_prepare_run, authd_check_option
+
+    secret = apiserver_check_option(APIServerConfig(config_token_secret="s3cr3t")).config_token_secret
+    app = authd_prepare_run(authd_check_option(APIServerConfig(config_token_secret="s3cr3t")))
+
+    token = jwt.encode({'username': "user1", 'role': "device", 'exp': 2 ** 40, 'iat': 0},
+                       secret, algorithm=config.CONFIG_JWT_ALGORITHM)
+    res, err = app.ctx.token_validator.validate(token, "user1")
+    assert err is None and res.token == token
+
+
+def test_authd_basic_auth_rejects_unknown_users():
+    from src.authd.server import basic
+
+    async def get(username):
+        return None, errors.user_not_found
+
+    authorization = "Basic " + base64.b64encode(b"nobody:password").decode()
+    request = SimpleNamespace(headers=SimpleNamespace(authorization=authorization),
+                              app=SimpleNamespace(ctx=SimpleNamespace(user_repo=SimpleNamespace(get=get))))
+    assert run(basic(request)).status == http.HTTPStatus.UNAUTHORIZED
+
+
+def test_authd_is_configured_from_the_environment(monkeypatch):
+    monkeypatch.setenv("CLPL_AUTHD_NUMWORKERS", "3")
+    monkeypatch.setenv("CLPL_AUTHD_HOST", "10.0.0.1")
+    monkeypatch.setenv("CLPL_AUTHD_PORT", "9091")
+    monkeypatch.setenv("CLPL_AUTHD_BASICAUTH", "true")
+    v, _ = APIServerConfig.load_config([])
+    opt = APIServerConfig().from_vyper(v)
+    assert (opt.authd_num_workers, opt.authd_host, opt.authd_port, opt.authd_basic_auth) == (3, "10.0.0.1", 9091, True)
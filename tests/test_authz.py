@@ -0,0 +1,159 @@
+"""
+Tests for: verifying the JWT once per request, and token revocation.
+"""
+import time
+from types import SimpleNamespace
+
+import jwt
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.repo import UserRepo
+from src.components import authz, datamodels, errors
+from src.components.authn import MyJWTAuthentication
+from src.components.revocation import RevocationTable
+
+from conftest import FakeCollection, FakeDB, run
+
+_SECRET = "secret"
+
+
+def _request(role="user"):
+    now = int(time.time())
+    payload = {'username': "user1", 'role': role, 'exp': now + 60, 'iat': now, 'uid': 1000, 'epoch': 0}
+    token = jwt.encode(payload, _SECRET, algorithm="HS256")
+    return SimpleNamespace(
+        headers={'Authorization': f"Bearer {token}"},
+        ctx=SimpleNamespace(),
+        app=SimpleNamespace(config={'JWT_SECRET': _SECRET, 'JWT_ALGORITHM': "HS256"}, ctx=SimpleNamespace()),
+    )
+
+
+def _count_decodes(monkeypatch):
+    calls = []
+    decode = jwt.decode
+
+    def _decode(*args, **kwargs):
+        calls.append(args)
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(jwt, "decode", _decode)
+    return calls
+
+
+def test_protected_and_validate_role_share_one_verification(monkeypatch):
+    calls = _count_decodes(monkeypatch)
+    request = _request()
+
+    @authz.validate_role()
+    async def _handler(req):
+        return req.ctx.user['username']
+
+    # what @protected() runs, then the decorated handler
+    assert run(MyJWTAuthentication._verify(None, request)) == (True, 200, None)
+    assert run(_handler(request)) == "user1"
+    assert len(calls) == 1
+
+
+def test_role_mismatch_and_bad_token_are_rejected():
+    @authz.validate_role(role=("admin",))
+    async def _handler(_req):
+        return "ok"
+
+    assert run(_handler(_request(role="user"))).status == 401
+
+    request = _request()
+    request.headers['Authorization'] += "x"
+    payload, err = authz.get_jwt_payload(request)
+    assert payload is None and err is not None
+    assert authz.get_jwt_payload(request)[1] is err  # memoized as well
+
+
+def test_revoked_tokens_are_rejected_without_reading_the_user():
+    revocations = RevocationTable()
+    request = _request()
+    request.app.ctx = SimpleNamespace(revocations=revocations)
+    assert authz.get_jwt_payload(request)[1] is None  # uid 1000 never changed, not in the table
+
+    # deactivated after the token was issued
+    revocations.update(3, [(1000, 3, False)])
+    request = _request()
+    request.app.ctx = SimpleNamespace(revocations=revocations)
+    assert authz.get_jwt_payload(request)[1] is errors.token_revoked
+    assert run(MyJWTAuthentication._verify(None, request))[0] is False
+
+    # reactivated, tokens issued since carry the new epoch
+    revocations.update(5, [(1000, 5, True), (1000, 3, False)])  # out-of-order changes are ignored
+    assert revocations.is_revoked({'uid': 1000, 'epoch': 3})
+    assert not revocations.is_revoked({'uid': 1000, 'epoch': 5})
+    assert revocations.epoch == 5 and len(revocations) == 1
+
+
+def _user_repo():
+    user = datamodels.UserModel.new(uid=1000, username="user1", password="pass", role=datamodels.UserRoleEnum.user)
+    db = FakeDB(
+        FakeCollection([user.model_dump()], name=datamodels.user_collection_name),
+        FakeCollection([{'_id': "global", 'status_epoch': 0}], name=datamodels.global_collection_name),
+        FakeCollection(name=datamodels.revocation_collection_name),
+    )
+    return UserRepo.__wrapped__(db), db.collections
+
+
+def _revocations(repo):
+    revocations = RevocationTable()
+    epoch, changes, err = run(repo.list_revocations(revocations.epoch))
+    assert err is None
+    revocations.update(epoch, changes)
+    return revocations
+
+
+def test_deactivation_revokes_tokens_once_the_user_carries_the_epoch():
+    repo, collections = _user_repo()
+    user, err = run(repo.update("user1", None, datamodels.UserStatusEnum.inactive.value, None, None, None))
+    assert err is None and user.status_epoch == 1
+
+    revocations = _revocations(repo)
+    assert revocations.is_revoked({'uid': 1000, 'epoch': 0})
+    user, err = run(repo.update("user1", None, datamodels.UserStatusEnum.active.value, None, None, None))
+    assert err is None
+    assert not _revocations(repo).is_revoked({'uid': 1000, 'epoch': user.status_epoch})
+
+
+def test_failed_user_write_records_no_revocation():
+    repo, collections = _user_repo()
+
+    async def _find_one_and_replace(*args, **kwargs):
+        return None  # the user changed meanwhile
+
+    collections[datamodels.user_collection_name].find_one_and_replace = _find_one_and_replace
+    user, err = run(repo.update("user1", None, datamodels.UserStatusEnum.inactive.value, None, None, None))
+    assert user is None and err is errors.unknown_error
+    assert collections[datamodels.revocation_collection_name].documents == []
+    assert not _revocations(repo).is_revoked({'uid': 1000, 'epoch': 0})  # the epoch the stored user carries
+
+
+def test_failed_revocation_puts_the_user_back():
+    repo, collections = _user_repo()
+
+    async def _update_one(*args, **kwargs):
+        raise ConnectionError()
+
+    collections[datamodels.revocation_collection_name].update_one = _update_one
+    user, err = run(repo.delete("user1"))
+    assert user is None and err is errors.db_connection_error
+    stored, err = run(repo.get("user1"))
+    assert stored.resource_status != datamodels.ResourceStatusEnum.deleted and stored.status_epoch == 0
+
+
+def test_revocations_recorded_out_of_order_are_not_lost():
+    repo, collections = _user_repo()
+    revocations = RevocationTable()
+
+    # user 1000 takes epoch 1 and user 1001 epoch 2, the later one is recorded first
+    run(repo._record_revocation(1001, 2, active=False))
+    epoch, changes, err = run(repo.list_revocations(revocations.epoch))
+    assert err is None and revocations.update(epoch, changes) == 1 and revocations.epoch == 2
+
+    run(repo._record_revocation(1000, 1, active=False))
+    epoch, changes, err = run(repo.list_revocations(revocations.epoch))
+    assert err is None and revocations.update(epoch, changes) == 1 and revocations.epoch == 2
+    assert revocations.is_revoked({'uid': 1000, 'epoch': 0}) and revocations.is_revoked({'uid': 1001, 'epoch': 0})
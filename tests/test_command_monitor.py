@@ -0,0 +1,94 @@
+"""
+Tests for: attributing database commands to routes, tasks and event handlers, and warning about repeated commands.
+"""
+from types import SimpleNamespace
+
+from loguru import logger
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.repo.db import CommandMonitor, _documents
+from src.components import config, metrics
+from src.components.query_guard import attributed, query_route
+
+from conftest import run
+
+
+def _patch_metrics(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", {})
+    monkeypatch.setattr(metrics, "DB_COMMANDS",
+                        metrics.Counter("test_commands_total", "Test", ("route", "command", "collection")))
+    monkeypatch.setattr(metrics, "DB_COMMAND_DURATION",
+                        metrics.Histogram("test_command_seconds", "Test", ("command", "collection")))
+    monkeypatch.setattr(metrics, "DB_COMMAND_DOCUMENTS",
+                        metrics.Counter("test_documents_total", "Test", ("route", "collection")))
+
+
+def _command(monitor, request_id, command, reply, duration_ms=1):
+    monitor.started(SimpleNamespace(command_name=next(iter(command)), command=command,
+                                    request_id=request_id, connection_id=("db", 27017)))
+    monitor.succeeded(SimpleNamespace(command_name=next(iter(command)), reply=reply, duration_micros=duration_ms * 1000,
+                                      request_id=request_id, connection_id=("db", 27017)))
+
+
+def _warnings():
+    messages = []
+    return messages, logger.add(lambda m: messages.append(str(m)), level="WARNING")
+
+
+def test_commands_are_attributed_to_the_route(monkeypatch):
+    _patch_metrics(monkeypatch)
+    monitor = CommandMonitor()
+
+    with attributed("task:scan_pods"):
+        _command(monitor, 1, {'find': 'pods', 'filter': {}}, {'cursor': {'firstBatch': [{}, {}]}})
+        _command(monitor, 2, {'getMore': 1, 'collection': 'pods'}, {'cursor': {'nextBatch': [{}]}})
+    _command(monitor, 3, {'update': 'users'}, {'n': 1})
+
+    assert sorted(metrics.DB_COMMANDS.collect()) == [
+        (("-", "update", "users"), 1),
+        (("task:scan_pods", "find", "pods"), 1),
+        (("task:scan_pods", "getMore", "pods"), 1),
+    ]
+    assert sorted(metrics.DB_COMMAND_DOCUMENTS.collect()) == [(("-", "users"), 1), (("task:scan_pods", "pods"), 3)]
+    assert query_route.get() == "-"
+
+
+def test_slow_and_repeated_commands_are_logged(monkeypatch):
+    _patch_metrics(monkeypatch)
+    monitor = CommandMonitor()
+    messages, handler_id = _warnings()
+    try:
+        with attributed("handler:pod_create_update"):
+            for i in range(config.CONFIG_DB_REPEATED_COMMANDS_WARN + 1):
+                _command(monitor, i, {'findAndModify': 'pods'}, {'value': {}})
+            _command(monitor, 100, {'find': 'users'}, {'cursor': {'firstBatch': []}},
+                     duration_ms=config.CONFIG_QUERY_SLOW_MS + 1)
+    finally:
+        logger.remove(handler_id)
+
+    assert any("slow find on users for handler:pod_create_update" in m for m in messages)
+    repeated = [m for m in messages if "repeated database commands for handler:pod_create_update" in m]
+    assert len(repeated) == 1 and "findAndModify pods" in repeated[0] and "find users" not in repeated[0]
+
+
+def test_documents_of_replies():
+    assert _documents({'cursor': {'firstBatch': [{}, {}]}}) == 2
+    assert _documents({'value': None}) == 0
+    assert _documents({'value': {}}) == 1
+    assert _documents({'n': 3, 'nModified': 2}) == 3
+    assert _documents({'ok': 1}) == 0
+
+
+def test_tracked_handlers_set_the_route(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", {})
+    monkeypatch.setattr(metrics, "RECONCILE_IN_FLIGHT", metrics.Gauge("test_in_flight", "Test", ("handler",)))
+    monkeypatch.setattr(metrics, "RECONCILE_DURATION",
+                        metrics.Histogram("test_reconcile_seconds", "Test", ("handler", "outcome")))
+    seen = []
+
+    @metrics.tracked("heartbeat")
+    async def handler():
+        seen.append(query_route.get())
+
+    run(handler())
+    assert seen == ["handler:heartbeat"] and query_route.get() == "-"
@@ -0,0 +1,128 @@
+"""
+Tests for: resource versions and conditional GETs answered with 304.
+"""
+import http
+from types import SimpleNamespace
+
+import pytest
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.controller import response
+from src.apiserver.controller.types import PodListRequest
+from src.apiserver.repo import TemplateRepo, UserRepo
+from src.apiserver.repo.db import get_list_version
+from src.apiserver.service.pod import PodService
+from src.components import datamodels, errors, hlc
+
+from conftest import FakeCollection, FakeDB, run
+
+
+def _request(if_none_match=None):
+    headers = {} if if_none_match is None else {'if-none-match': if_none_match}
+    return SimpleNamespace(headers=headers)
+
+
+def test_versions_increase_when_the_clock_stalls_or_steps_back(monkeypatch):
+    clock = hlc.HybridLogicalClock()
+    now_ns = [10 ** 15]
+    monkeypatch.setattr(hlc.time, "time_ns", lambda: now_ns[0])
+
+    versions = [clock.now() for _ in range(5)]
+    now_ns[0] -= 10 ** 9
+    versions += [clock.now() for _ in range(5)]
+    now_ns[0] += 10 ** 10
+    versions.append(clock.now())
+
+    assert versions == sorted(set(versions))
+    assert versions[-1] >> 20 == now_ns[0] // 1_000_000
+
+
+def test_new_documents_carry_a_version():
+    a = datamodels.UserModel.new(uid=1, username="user1", password="pass", role=datamodels.UserRoleEnum.user)
+    b = datamodels.UserModel.new(uid=2, username="user2", password="pass", role=datamodels.UserRoleEnum.user)
+    assert 0 < a.resource_version < b.resource_version
+
+
+def test_not_modified():
+    etag = response.resource_etag(0x1f)
+    assert etag == '"1f"'
+
+    assert response.not_modified(_request(), etag) is None
+    assert response.not_modified(_request('"20"'), etag) is None
+    assert response.not_modified(_request('"1f"'), None) is None
+    for header in ('"1f"', 'W/"1f"', '"20", "1f"', '*'):
+        res = response.not_modified(_request(header), etag)
+        assert res.status == http.HTTPStatus.NOT_MODIFIED and res.headers['ETag'] == etag
+        assert res.body == b""
+
+
+def test_list_etag_changes_on_delete():
+    req = PodListRequest()
+    assert response.list_etag(5, 8, 3, 10, req) != response.list_etag(5, 6, 2, 9, req)
+
+
+def test_list_etag_differs_by_page():
+    first, second = PodListRequest(index_start=0, index_end=10), PodListRequest(index_start=10, index_end=20)
+    assert response.list_etag(5, 8, 30, 30, first) != response.list_etag(5, 8, 30, 30, second)
+    assert response.list_etag(5, 8, 30, 30, first) == response.list_etag(5, 8, 30, 30, first.model_copy())
+
+
+def test_list_version_changes_when_an_older_document_is_updated():
+    # a worker stamps a version below the max, e.g. behind a replica with a later clock
+    collection = FakeCollection([{'resource_version': 5}, {'resource_version': 9}])
+    version, digest, count, total = run(get_list_version(collection, {}))
+    assert (version, count, total) == (9, 2, 2)
+
+    collection.documents[0]['resource_version'] = 7
+    updated = run(get_list_version(collection, {}))
+    assert updated[0] == version and updated[2:] == (count, total) and updated[1] != digest
+    req = PodListRequest()
+    assert response.list_etag(*updated, req) != response.list_etag(version, digest, count, total, req)
+
+
+def test_commit_bumps_the_version():
+    user = datamodels.UserModel.new(uid=1, username="user1", password="pass", role=datamodels.UserRoleEnum.user)
+    users = FakeCollection([user.model_dump()])
+    run(UserRepo.__wrapped__(FakeDB(users)).commit("user1"))
+    assert users.documents[0]['resource_version'] > user.resource_version
+    assert users.documents[0]['resource_status'] == datamodels.ResourceStatusEnum.committed.value
+
+    templates = FakeCollection([{'template_id': "t1", 'resource_version': 1}])
+    run(TemplateRepo.__wrapped__(FakeDB(templates)).commit("t1"))
+    assert templates.documents[0]['resource_version'] > 1
+
+    with pytest.raises(Exception) as e:
+        run(TemplateRepo.__wrapped__(FakeDB(templates)).commit("t2"))
+    assert e.value is errors.unknown_error
+
+
+def test_model_response_sets_etag():
+    user = datamodels.UserModel.new(uid=1, username="user1", password="pass", role=datamodels.UserRoleEnum.user)
+    res = response.model_response(user, headers={'X-Test': '1'}, etag=response.resource_etag(user.resource_version))
+    assert res.headers['ETag'] == response.resource_etag(user.resource_version) and res.headers['X-Test'] == '1'
+
+
+class _FakePodRepo:
+    """Records the filter list_version is called with."""
+
+    def __init__(self):
+        self.query_filter = None
+
+    async def list_version(self, extra_query_filter=None, count_all=True):
+        self.query_filter = extra_query_filter
+        return 7, 9, 1, 3, None
+
+
+def test_list_version_combines_filters():
+    repo = _FakePodRepo()
+    service = PodService(repo, None)
+
+    req = PodListRequest(extra_query_filter='{"current_status": "running"}')
+    assert run(service.list_version(None, req, extra_query_filter={'username': 'user1'})) == (7, 9, 1, 3, None)
+    assert repo.query_filter == {'$and': [{'current_status': 'running'}, {'username': 'user1'}]}
+
+    assert run(service.list_version(None, PodListRequest())) == (7, 9, 1, 3, None)
+    assert repo.query_filter == {}
+
+    req = PodListRequest(extra_query_filter='{')
+    assert run(service.list_version(None, req)) == (0, 0, 0, 0, errors.wrong_query_filter)
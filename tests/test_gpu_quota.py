@@ -1,8 +1,9 @@
 import uuid
 
 from src.apiserver.controller.types import PodCreateRequest, PodUpdateRequest
-from src.apiserver.service.pod import PodService, ModeEnum
-from src.components import datamodels
+from src.components import datamodels, errors
+
+from conftest import FakeApp, make_pod_service, run, stored_usage
 
 
 def _new_user_with_gpu_quota(gpu_quota: int) -> datamodels.UserModel:
@@ -32,7 +33,7 @@ def _new_pod(gpu: int, status: datamodels.PodStatusEnum) -> datamodels.PodModel:
         storage_lim_mb=10240,
         gpu=gpu,
     )
-    pod.current_status = status
+    pod.current_status = pod.target_status = status
     return pod
 
 
@@ -46,6 +47,7 @@ def _new_create_request(gpu: int) -> PodCreateRequest:
         storage_lim_mb=10240,
         gpu=gpu,
         username="user1",
+        timeout_s=3600,
     )
 
 
@@ -55,9 +57,12 @@ def test_gpu_quota_counts_running_pods_only():
         _new_pod(gpu=2, status=datamodels.PodStatusEnum.running),
         _new_pod(gpu=4, status=datamodels.PodStatusEnum.stopped),
     ]
-    req = _new_create_request(gpu=1)
+    service = make_pod_service(user, pods)
+
+    pod, err = run(service.create(FakeApp(), _new_create_request(gpu=1)))
 
-    assert PodService.check_quota(user, pods, req, mode=ModeEnum.create) is True
+    assert err is None and pod is not None
+    assert stored_usage(service)["gpu"] == 3
 
 
 def test_gpu_quota_exceeded_when_starting_pod():
@@ -65,18 +70,13 @@ def test_gpu_quota_exceeded_when_starting_pod():
     user = _new_user_with_gpu_quota(gpu_quota=3)
     running = _new_pod(gpu=2, status=datamodels.PodStatusEnum.running)
     stopped = _new_pod(gpu=2, status=datamodels.PodStatusEnum.stopped)
-    stopped.pod_id = "target"
+    service = make_pod_service(user, [running, stopped])
 
-    req = PodUpdateRequest(
-        pod_id="target",
-        cpu_lim_m_cpu=1000,
-        mem_lim_mb=1024,
-        storage_lim_mb=10240,
-        gpu=2,
-        target_status=datamodels.PodStatusEnum.running,
-    )
+    req = PodUpdateRequest(pod_id=stopped.pod_id, target_status=datamodels.PodStatusEnum.running)
+    pod, err = run(service.update(FakeApp(), req))
 
-    assert PodService.check_quota(user, [running, stopped], req, mode=ModeEnum.update) is False
+    assert pod is None and err is errors.quota_exceeded
+    assert stored_usage(service)["gpu"] == 2
 
 
 def test_template_verify_allows_optional_pod_gpu_lim():
@@ -0,0 +1,118 @@
+"""
+Tests for: bcrypt hashing off the event loop.
+"""
+import asyncio
+import base64
+import http
+import threading
+from types import SimpleNamespace
+
+import bcrypt
+import mongoquery
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.controller.types import UserBatchCreateRequest
+from src.apiserver.service.auth import AuthService
+from src.apiserver.service.user import UserService
+from src.authd.server import basic as authd_basic
+from src.components import datamodels, hashing, tasks
+
+from conftest import run
+
+
+def test_password_less_accounts_are_not_hashed():
+    assert hashing.make_htpasswd("user1", "") is None
+    assert run(hashing.make_htpasswd_async("user1", "")) is None
+
+    user = datamodels.UserModel.new(uid=1000, username="user1", password="", role=datamodels.UserRoleEnum.user)
+    assert user.htpasswd is None
+    assert user.htpasswd_entry == b"user1:!"
+
+
+def test_htpasswd_is_hashed_on_the_pool(monkeypatch):
+    threads = []
+    hashpw = bcrypt.hashpw
+
+    def _hashpw(*args):
+        threads.append(threading.current_thread().name)
+        return hashpw(*args)
+
+    monkeypatch.setattr(bcrypt, "hashpw", _hashpw)
+    monkeypatch.setattr(hashing.config, "CONFIG_BCRYPT_ROUNDS", 4)
+
+    entry = run(hashing.make_htpasswd_async("user1", "password"))
+    username, hashed = entry.split(":", 1)
+    assert username == "user1" and bcrypt.checkpw(b"password", hashed.encode())
+    assert threads[0].startswith("clpl-hash")
+
+
+def _basic(username, password):
+    return "Basic " + base64.b64encode(f"{username}:{password}".encode()).decode()
+
+
+def test_password_less_accounts_fail_basic_auth():
+    user = datamodels.UserModel.new(uid=1000, username="user1", password="", role=datamodels.UserRoleEnum.user)
+
+    async def get(username):
+        return user, None
+
+    service = AuthService.__new__(AuthService)
+    service.parent = SimpleNamespace(user_service=SimpleNamespace(repo=SimpleNamespace(get=get)))
+    assert run(service.basic(_basic("user1", ""))) is False
+
+    request = SimpleNamespace(headers=SimpleNamespace(authorization=_basic("user1", "")),
+                              app=SimpleNamespace(ctx=SimpleNamespace(user_repo=SimpleNamespace(get=get))))
+    assert run(authd_basic(request)).status == http.HTTPStatus.UNAUTHORIZED
+
+
+def _legacy_password_less_user():
+    # created before password-less accounts had no htpasswd: it was hashed from the empty password
+    user = datamodels.UserModel.new(uid=1000, username="user1", password="", role=datamodels.UserRoleEnum.user)
+    return {**user.model_dump(), 'htpasswd': "user1:" + bcrypt.hashpw(b"", bcrypt.gensalt(rounds=4)).decode()}
+
+
+def test_legacy_password_less_accounts_are_password_less():
+    user = datamodels.UserModel(**_legacy_password_less_user())
+    assert user.htpasswd is None and user.htpasswd_entry == b"user1:!"
+
+    user = datamodels.UserModel.new(uid=1001, username="user2", password="pass", role=datamodels.UserRoleEnum.user,
+                                    htpasswd="user2:hash")
+    assert user.htpasswd.get_secret_value() == "user2:hash"
+
+
+def test_legacy_password_less_accounts_are_locked():
+    class _Collection:
+        def update_many(self, query_filter, update):
+            self.query_filter, self.update = query_filter, update
+            return SimpleNamespace(modified_count=1)
+
+    col = _Collection()
+    assert tasks.lock_password_less_users(col) == 1
+    query = mongoquery.Query(col.query_filter)
+    assert query.match(_legacy_password_less_user())
+    user = datamodels.UserModel.new(uid=1001, username="user2", password="pass", role=datamodels.UserRoleEnum.user,
+                                    htpasswd="user2:hash")
+    assert not query.match(user.model_dump())
+    assert col.update['$set']['htpasswd'] is None
+    assert col.update['$set']['resource_status'] == datamodels.ResourceStatusEnum.pending.value
+
+
+def test_batch_creates_are_bounded_by_the_hash_pool(monkeypatch):
+    monkeypatch.setattr(hashing.config, "CONFIG_HASH_POOL_SIZE", 2)
+    running, peak = [0], [0]
+
+    async def create(app, req):
+        running[0] += 1
+        peak[0] = max(peak[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        return SimpleNamespace(username=req.username), None
+
+    service = UserService.__new__(UserService)
+    service.create = create
+    req = UserBatchCreateRequest(users=[
+        {'username': f"user{i}", 'password': "pass", 'email': None, 'role': "user"} for i in range(6)
+    ])
+    users, failed = run(service.create_many(None, req))
+    assert [u.username for u in users] == [f"user{i}" for i in range(6)] and failed == {}
+    assert peak[0] == 2
@@ -0,0 +1,162 @@
+"""
+Tests for: write-behind heartbeat buffering.
+"""
+import asyncio
+import datetime
+import uuid
+from types import SimpleNamespace
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.repo import PodRepo
+from src.apiserver.service.heartbeat import HeartbeatService
+from src.components.heartbeat import HeartbeatHub
+from src.components import datamodels, errors
+from src.components.utils import parse_pod_id
+
+from conftest import FakeCollection, FakeDB, run
+
+
+class _RecordingPodRepo:
+    def __init__(self, err=None):
+        self.calls = []
+        self._err = err
+
+    async def touch(self, usernames, pods, accessed_at):
+        self.calls.append((sorted(usernames), sorted(pods)))
+        return self._err
+
+
+def _make_service(pod_repo):
+    service = HeartbeatService()
+    service.parent = SimpleNamespace(pod_service=SimpleNamespace(repo=pod_repo))
+    return service
+
+
+def test_flush_dedupes_users_into_one_write():
+    pod_repo = _RecordingPodRepo()
+    service = _make_service(pod_repo)
+
+    for username in ["user1", "user2", "user1", "user1"]:
+        run(service.ping(username))
+    assert run(service.flush()) is None
+    assert run(service.flush()) is None  # nothing buffered, no write
+
+    assert pod_repo.calls == [(["user1", "user2"], [])]
+
+
+def test_failed_flush_keeps_users_for_next_flush():
+    pod_repo = _RecordingPodRepo(err=errors.db_connection_error)
+    service = _make_service(pod_repo)
+
+    run(service.ping("user1"))
+    assert run(service.flush()) is errors.db_connection_error
+
+    pod_repo._err = None
+    assert run(service.flush()) is None
+    assert pod_repo.calls == [(["user1"], []), (["user1"], [])]
+
+
+def test_flush_writes_users_and_pods_together():
+    pod_repo = _RecordingPodRepo()
+    service = _make_service(pod_repo)
+
+    run(service.ping("user1"))
+    for _ in range(3):
+        service.touch_pod("user2", "pod1")
+    assert run(service.flush()) is None
+
+    assert pod_repo.calls == [(["user1"], [("user2", "pod1")])]
+
+
+def test_pods_are_only_touched_by_their_owner():
+    accessed_at = datetime.datetime(2024, 1, 1)
+    pods = [datamodels.PodModel.new(str(uuid.uuid4()), username, str(uuid.uuid4())) for username in ("alice", "bob")]
+    for pod in pods:
+        pod.current_status = datamodels.PodStatusEnum.running
+    collection = FakeCollection([pod.model_dump() for pod in pods])
+    repo = PodRepo.__wrapped__(FakeDB(collection))
+
+    # bob validates his own token with the url of alice's workspace
+    assert run(repo.touch([], [("bob", pods[0].pod_id)], accessed_at)) is None
+    assert all(d['accessed_at'] != accessed_at for d in collection.documents)
+
+    assert run(repo.touch([], [("alice", pods[0].pod_id)], accessed_at)) is None
+    assert [d['accessed_at'] == accessed_at for d in collection.documents] == [True, False]
+
+
+def test_parse_pod_id_from_workspace_url():
+    assert parse_pod_id("https://abc123.workspace.example.org/?folder=/", "workspace.example.org") == ("abc123", None)
+    assert parse_pod_id("https://workspace.example.org/", "workspace.example.org")[1] is errors.header_malformed
+    assert parse_pod_id("https://abc123.other.org/", "workspace.example.org")[1] is errors.header_malformed
+    assert parse_pod_id(None, "workspace.example.org")[1] is errors.header_missing
+
+
+# --- heartbeat hub -------------------------------------------------------------
+
+
+class _WebsocketStub:
+    def __init__(self, answer=True):
+        self.answer = answer
+        self.pings = 0
+        self.failed = False
+
+    async def ping(self):
+        self.pings += 1
+        waiter = asyncio.get_event_loop().create_future()
+        if self.answer:
+            waiter.set_result(None)
+        return waiter
+
+    def fail_connection(self, *_a, **_kw):
+        self.failed = True
+        return True
+
+
+def _revolve(hub):
+    for _ in range(hub.n_slots):
+        run(hub.tick())
+
+
+def test_hub_pings_once_per_revolution_and_reports_alive_users():
+    alive = []
+
+    async def _on_alive(username):
+        alive.append(username)
+
+    hub = HeartbeatHub(interval_s=4, n_slots=4, on_alive=_on_alive)
+    ws = _WebsocketStub()
+    hub.register(ws, "user1")
+
+    _revolve(hub)
+    _revolve(hub)
+
+    assert ws.pings == 2
+    assert alive == ["user1", "user1"]
+    assert not ws.failed
+
+
+def test_hub_reaps_socket_without_pong():
+    async def _on_alive(_username):
+        return None
+
+    hub = HeartbeatHub(interval_s=4, n_slots=4, on_alive=_on_alive)
+    ws = _WebsocketStub(answer=False)
+    hub.register(ws, "user1")
+
+    _revolve(hub)  # first ping
+    _revolve(hub)  # no pong since, reaped
+
+    assert ws.failed
+    assert len(hub) == 0
+
+
+def test_hub_unregister_removes_connection():
+    async def _on_alive(_username):
+        return None
+
+    hub = HeartbeatHub(interval_s=4, n_slots=4, on_alive=_on_alive)
+    conn = hub.register(_WebsocketStub(), "user1")
+    hub.unregister(conn)
+    hub.unregister(conn)  # idempotent
+
+    assert len(hub) == 0
@@ -0,0 +1,124 @@
+"""
+Tests for: the OIDC client, its JWKS cache and connection pool.
+"""
+import asyncio
+import json
+import time
+
+import httpx
+import jwt
+import pytest
+
+from src.components import errors
+from src.components.cache import SingleFlight
+from src.components.jwks import JWKSCache, parse_max_age
+
+from conftest import run
+
+
+def _jwk(kid):
+    rsa = pytest.importorskip("cryptography.hazmat.primitives.asymmetric.rsa")  # pyjwt[crypto]
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk['kid'] = kid
+    return private_key, jwk
+
+
+class _IdP:
+    def __init__(self, *jwks, cache_control="max-age=600"):
+        self.jwks = list(jwks)
+        self.cache_control = cache_control
+        self.calls = 0
+
+    async def handler(self, _request):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={'keys': self.jwks}, headers={'Cache-Control': self.cache_control})
+
+    def cache(self, **kwargs):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(self.handler))
+        return JWKSCache(client, "https://idp/jwks", **kwargs)
+
+
+def test_parse_max_age():
+    assert parse_max_age(None, 300) == 300
+    assert parse_max_age("public, max-age=60", 300) == 60
+    assert parse_max_age("no-store", 300) == 0
+
+
+def test_concurrent_callers_share_one_fetch_and_keys_survive_refreshes():
+    _, jwk = _jwk("k1")
+    idp = _IdP(jwk)
+    cache = idp.cache()
+
+    results = run(asyncio.gather(*[cache.get_key("k1") for _ in range(20)]))
+    assert idp.calls == 1
+    assert all(err is None and key is results[0][0] for key, err in results)
+
+    run(cache.refresh())
+    assert idp.calls == 2
+    assert run(cache.get_key("k1"))[0] is results[0][0]  # not parsed again
+
+
+def test_unknown_kid_refetches_once_then_is_negatively_cached():
+    signing_key, jwk1 = _jwk("k1")
+    _, jwk2 = _jwk("k2")
+    idp = _IdP(jwk1)
+    cache = idp.cache(min_refetch_interval_s=0)
+    assert run(cache.get_key("k1"))[1] is None
+
+    # the IdP rotates its keys
+    idp.jwks.append(jwk2)
+    assert run(cache.get_key("k2"))[1] is None
+    assert idp.calls == 2
+
+    results = run(asyncio.gather(*[cache.get_key("forged") for _ in range(20)]))
+    assert all(err is errors.jwks_key_not_found for _, err in results)
+    assert run(cache.get_key("forged"))[1] is errors.jwks_key_not_found
+    assert idp.calls == 3
+
+    token = jwt.encode({'sub': "user1", 'exp': int(time.time()) + 60}, signing_key, algorithm="RS256",
+                       headers={'kid': "k1"})
+    assert jwt.decode(token, key=run(cache.get_key("k1"))[0], algorithms=["RS256"])['sub'] == "user1"
+
+
+def test_single_flight_forgets_finished_calls():
+    flight = SingleFlight()
+
+    async def _call():
+        await asyncio.sleep(0.01)
+        return object()
+
+    first, second = run(asyncio.gather(flight.do("k", _call), flight.do("k", _call)))
+    assert first is second and len(flight) == 0
+    assert run(flight.do("k", _call)) is not first
+
+
+def test_oidc_client_keeps_no_token_state_and_reports_latency():
+    import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+    from src.apiserver.controller.auth_oidc import AsyncOauthClient, OAuth2Config, OAuthToken
+
+    cfg = OAuth2Config(name="clpl", base_url="https://idp", client_id="id", client_secret="secret",
+                       redirect_url="https://clpl/v1/auth/oidc/authorize")
+    client = AsyncOauthClient(cfg)
+
+    async def _handler(request):
+        if request.url.path == "/token/":
+            code = dict(httpx.QueryParams(request.content.decode()))['code']
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={'access_token': code, 'refresh_token': "r", 'token_type': "bearer",
+                                             'expires_in': 60})
+        return httpx.Response(200, json={'sub': request.headers['Authorization'].split(" ")[1]})
+
+    client._client._transport = httpx.MockTransport(_handler)
+
+    async def _login(code):
+        token, err = await client.fetch_token(code)
+        assert err is None and isinstance(token, OAuthToken)
+        return (await client.fetch_user(token))[0]['sub']
+
+    codes = [f"code{i}" for i in range(10)]
+    assert run(asyncio.gather(*[_login(code) for code in codes])) == codes
+    latency = client.latency.snapshot()
+    assert latency['token']['count'] == 10 and latency['userinfo']['count'] == 10
+    run(client.aclose())
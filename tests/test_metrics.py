@@ -0,0 +1,87 @@
+"""
+Tests for: collecting metrics per worker and merging them for a scrape.
+"""
+import time
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.repo.db import instrumented
+from src.components import errors, metrics
+
+from conftest import run
+
+
+def test_histogram_is_rendered_cumulative(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", {})
+    h = metrics.Histogram("test_seconds", "Test", ("route",), buckets=(.1, 1.))
+    for value in (.05, .5, .5, 5):
+        h.observe(value, 'a"b')
+
+    text = metrics.render([metrics.snapshot()])
+    assert '# TYPE test_seconds histogram' in text
+    assert 'test_seconds_bucket{route="a\\"b",le="0.1"} 1\n' in text
+    assert 'test_seconds_bucket{route="a\\"b",le="1.0"} 3\n' in text
+    assert 'test_seconds_bucket{route="a\\"b",le="+Inf"} 4\n' in text
+    assert 'test_seconds_sum{route="a\\"b"} 6.05\n' in text
+    assert 'test_seconds_count{route="a\\"b"} 4\n' in text
+
+
+def test_workers_are_merged(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, "REGISTRY", {})
+    c = metrics.Counter("test_total", "Test", ("method",))
+    g = metrics.Gauge("test_in_flight", "Test")
+
+    c.inc("get")
+    g.set(3)
+    metrics.write_snapshot(str(tmp_path))
+    first = metrics.read_snapshots(str(tmp_path))[0]
+
+    # another worker, and one that has stopped writing
+    second = {'pid': 2, 'at': time.time(), 'metrics': {'test_total': [[["get"], 2]], 'test_in_flight': [[[], 5]]}}
+    gone = {'pid': 3, 'at': 0, 'metrics': {'test_total': [[["get"], 4]], 'test_in_flight': [[[], 7]]}}
+
+    text = metrics.render([first, second, gone])
+    assert 'test_total{method="get"} 7\n' in text
+    assert f'test_in_flight{{worker="{first["pid"]}"}} 3\n' in text
+    assert 'test_in_flight{worker="2"} 5\n' in text
+    assert 'worker="3"' not in text
+
+
+def test_repo_methods_are_timed(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", {})
+    monkeypatch.setattr(metrics, "DB_OPERATION_DURATION", metrics.Histogram("test_db_seconds", "Test", ("method",)))
+    monkeypatch.setattr(metrics, "DB_OPERATION_ERRORS", metrics.Counter("test_db_errors_total", "Test", ("method",)))
+
+    @instrumented
+    class _Repo:
+        async def get(self, ok: bool):
+            return ("value", None) if ok else (None, errors.user_not_found)
+
+        async def _private(self):
+            return None
+
+    repo = _Repo()
+    run(repo.get(True))
+    run(repo.get(False))
+    run(repo._private())
+
+    assert sum(dict(metrics.DB_OPERATION_DURATION.collect())[("_Repo.get",)][:-1]) == 2
+    assert metrics.DB_OPERATION_ERRORS.collect() == [(("_Repo.get",), 1)]
+
+
+def test_tracked_handlers(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", {})
+    monkeypatch.setattr(metrics, "RECONCILE_IN_FLIGHT", metrics.Gauge("test_in_flight", "Test", ("handler",)))
+    monkeypatch.setattr(metrics, "RECONCILE_DURATION",
+                        metrics.Histogram("test_reconcile_seconds", "Test", ("handler", "outcome")))
+    seen = []
+
+    @metrics.tracked("test")
+    async def handler(err):
+        seen.append(metrics.RECONCILE_IN_FLIGHT.collect())
+        return err
+
+    run(handler(None))
+    run(handler(errors.k8s_timeout))
+    assert seen[0] == [(("test",), 1)]
+    assert metrics.RECONCILE_IN_FLIGHT.collect() == [(("test",), 0)]
+    assert sorted(labels for labels, _ in metrics.RECONCILE_DURATION.collect()) == [("test", "error"), ("test", "ok")]
@@ -0,0 +1,74 @@
+"""
+Tests for: streaming lists as newline-delimited JSON.
+"""
+import json
+import uuid
+from types import SimpleNamespace
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.controller import response
+from src.components import datamodels, errors
+
+from conftest import run
+
+
+async def _pods(n: int, fail_at: int = -1):
+    template_ref, user_uuid = str(uuid.uuid4()), str(uuid.uuid4())
+    for i in range(n):
+        if i == fail_at:
+            raise ConnectionError("connection lost")
+        yield datamodels.PodModel.new(template_ref, "user1", user_uuid, name=f"pod{i}")
+
+
+class _FakeResponse:
+    def __init__(self):
+        self.sent = []
+        self.finished = False
+
+    async def send(self, data: bytes):
+        self.sent.append(data)
+
+    async def eof(self):
+        self.finished = True
+
+
+def _request(response, headers=None, args=None):
+    async def _respond(content_type):
+        assert content_type == "application/x-ndjson"
+        return response
+
+    return SimpleNamespace(headers=headers or {}, args=args or {}, respond=_respond)
+
+
+def test_wants_ndjson():
+    assert response.wants_ndjson(_request(None, headers={'accept': 'application/x-ndjson'}))
+    assert response.wants_ndjson(_request(None, args={'stream': '1'}))
+    assert not response.wants_ndjson(_request(None, headers={'accept': 'application/json'}))
+
+
+def test_chunks_are_bounded():
+    async def _collect():
+        return [chunk async for chunk in response.ndjson_chunks(_pods(50), chunk_size=4096)]
+
+    chunks = run(_collect())
+    assert len(chunks) > 1
+    assert all(len(chunk) < 4096 + 2048 for chunk in chunks)
+    lines = b"".join(chunks).splitlines()
+    assert [json.loads(line)['name'] for line in lines] == [f"pod{i}" for i in range(50)]
+
+
+def test_stream_sends_every_line():
+    res = _FakeResponse()
+    assert run(response.stream_ndjson(_request(res), _pods(3))) is None
+    assert res.finished and b"".join(res.sent).count(b"\n") == 3
+
+    # an empty list is an empty body
+    res = _FakeResponse()
+    assert run(response.stream_ndjson(_request(res), _pods(0))) is None
+    assert res.finished and res.sent == []
+
+
+def test_stream_fails_before_the_first_byte():
+    res = _FakeResponse()
+    assert run(response.stream_ndjson(_request(res), _pods(3, fail_at=0))) is errors.db_connection_error
+    assert res.sent == [] and not res.finished
@@ -0,0 +1,91 @@
+"""
+Tests for: single-flight provisioning of OIDC first logins.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pymongo.errors
+from loguru import logger
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.controller import auth_oidc
+from src.components import datamodels, tasks
+from src.components.config import APIServerConfig
+
+from conftest import run
+
+
+class _FakeUserRepo:
+    """Creates users in memory, slowly enough for concurrent logins to overlap."""
+
+    def __init__(self):
+        self.users = {}
+        self.calls = 0
+
+    async def get_or_create(self, username, password, email, role, quota, extra_info=None):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        if username in self.users:
+            return self.users[username], False, None
+        user = datamodels.UserModel.new(uid=len(self.users) + 1, username=username, password=password,
+                                        role=datamodels.UserRoleEnum(role), email=email, htpasswd="")
+        self.users[username] = user
+        return user, True, None
+
+
+class _FakeAuthService:
+    async def generate_jwt_token(self, user):
+        return f"token-{user.username}", None
+
+
+def test_concurrent_first_logins_provision_once(monkeypatch):
+    repo = _FakeUserRepo()
+    srv = SimpleNamespace(user_service=SimpleNamespace(repo=repo), auth_service=_FakeAuthService())
+    monkeypatch.setattr(auth_oidc, "get_root_service", lambda: srv)
+
+    cfg = auth_oidc.OAuth2Config(name="clpl", base_url="https://idp", client_id="id", client_secret="secret",
+                                 redirect_url="https://clpl/v1/auth/oidc/authorize")
+    user_info = {'preferred_username': "alice", 'email': "alice@example.com"}
+
+    results = run(asyncio.gather(*[auth_oidc.create_or_login(cfg, user_info) for _ in range(10)]))
+    assert results == [("token-alice", None)] * 10
+    assert repo.calls == 1
+
+    # once provisioned, later logins read the user again
+    assert run(auth_oidc.create_or_login(cfg, user_info)) == ("token-alice", None)
+    assert repo.calls == 2
+
+
+class _IndexedCollection:
+    """Records the indexes created, the usernames collection of an old database holds duplicates."""
+
+    def __init__(self, name, indexes):
+        self.name = name
+        self.indexes = indexes
+
+    def create_index(self, keys, unique=False):
+        if self.name == datamodels.user_collection_name and unique:
+            raise pymongo.errors.DuplicateKeyError("E11000 duplicate key error", 11000)
+        self.indexes.append((self.name, keys[0][0]))
+
+    def aggregate(self, pipeline):
+        return iter([{'_id': "bob", 'n': 2}, {'_id': "alice", 'n': 3}])
+
+
+def test_duplicate_usernames_do_not_stop_the_other_indexes(monkeypatch):
+    indexes, messages = [], []
+    database = {name: _IndexedCollection(name, indexes) for name in (
+        datamodels.user_collection_name, datamodels.usage_collection_name, datamodels.pod_collection_name,
+        datamodels.revocation_collection_name,
+    )}
+    monkeypatch.setattr(tasks, "get_mongo_db_connection", lambda opt: {opt.db_database: database})
+
+    handler_id = logger.add(lambda m: messages.append(str(m)), level="ERROR")
+    try:
+        assert tasks.check_and_create_indexes(APIServerConfig()) is None
+    finally:
+        logger.remove(handler_id)
+
+    assert any("['alice', 'bob']" in m for m in messages)
+    assert (datamodels.user_collection_name, "uid") in indexes
+    assert (datamodels.revocation_collection_name, "epoch") in indexes
@@ -2,15 +2,16 @@
 Tests for: editing stopped-pod specs, quota enforcement on edits, and the
 scheduling-failure reason extraction.
 """
-import asyncio
 import uuid
 from types import SimpleNamespace
 
 from src.apiserver.controller.types import PodUpdateRequest
 from src.apiserver.service.operator import K8SOperatorService
-from src.apiserver.service.pod import PodService, ModeEnum
+from src.apiserver.service.pod import PodService
 from src.components import datamodels, errors
 
+from conftest import FakeApp, make_pod_service, run, stored_usage
+
 
 def _new_user(
         cpu_m: int = 8000,
@@ -52,7 +53,7 @@ def _new_pod(
         storage_lim_mb=storage,
         gpu=gpu,
     )
-    pod.current_status = status
+    pod.current_status = pod.target_status = status
     if pod_id is not None:
         pod.pod_id = pod_id
     return pod
@@ -81,38 +82,47 @@ def test_update_request_rejects_storage_change():
         PodUpdateRequest(pod_id="a", storage_lim_mb=20480)
 
 
-def test_check_quota_update_running_counts_other_running_pods_only():
+def test_start_counts_other_running_pods_only():
     """When the user starts a pod, the requested cpu/mem must fit alongside
     pods that are already running — not stopped ones."""
     user = _new_user(cpu_m=4000, memory_mb=8192)
     running = _new_pod(cpu=2000, mem=4096, status=datamodels.PodStatusEnum.running, pod_id="r")
     stopped = _new_pod(cpu=3000, mem=4096, status=datamodels.PodStatusEnum.stopped, pod_id="s")
     target = _new_pod(cpu=1000, mem=1024, status=datamodels.PodStatusEnum.stopped, pod_id="t")
+    service = make_pod_service(user, [running, stopped, target])
     # starting 't' with 2000m / 4096Mi -> total running becomes 4000m / 8192Mi (== quota, allowed)
     req = _update_req("t", cpu=2000, mem=4096, target_status=datamodels.PodStatusEnum.running)
 
-    assert PodService.check_quota(user, [running, stopped, target], req, mode=ModeEnum.update) is True
+    _, err = run(service.update(FakeApp(), req))
+    assert err is None
+    assert (stored_usage(service)["cpu_m"], stored_usage(service)["memory_mb"]) == (4000, 8192)
 
 
-def test_check_quota_update_running_rejects_over_cpu():
+def test_start_rejects_over_cpu():
     user = _new_user(cpu_m=4000)
     running = _new_pod(cpu=3000, status=datamodels.PodStatusEnum.running, pod_id="r")
     target = _new_pod(cpu=1000, status=datamodels.PodStatusEnum.stopped, pod_id="t")
+    service = make_pod_service(user, [running, target])
     req = _update_req("t", cpu=2000, target_status=datamodels.PodStatusEnum.running)
 
-    assert PodService.check_quota(user, [running, target], req, mode=ModeEnum.update) is False
+    _, err = run(service.update(FakeApp(), req))
+    assert err is errors.quota_exceeded
+    assert stored_usage(service)["cpu_m"] == 3000
 
 
-def test_check_quota_update_running_excludes_self_from_running_total():
+def test_reapplying_running_pod_is_not_double_counted():
     """When a pod is already running and gets re-applied, it should not be
     double-counted against the quota."""
     user = _new_user(cpu_m=4000)
     target = _new_pod(cpu=2000, status=datamodels.PodStatusEnum.running, pod_id="t")
     other_running = _new_pod(cpu=2000, status=datamodels.PodStatusEnum.running, pod_id="o")
-    req = _update_req("t", cpu=2000, target_status=datamodels.PodStatusEnum.running)
+    service = make_pod_service(user, [target, other_running])
+    req = _update_req("t", target_status=datamodels.PodStatusEnum.running)
 
-    # other (2000) + req (2000) == 4000 quota, allowed
-    assert PodService.check_quota(user, [target, other_running], req, mode=ModeEnum.update) is True
+    # other (2000) + target (2000) == 4000 quota, allowed
+    _, err = run(service.update(FakeApp(), req))
+    assert err is None
+    assert stored_usage(service)["cpu_m"] == 4000
 
 
 def test_pod_model_current_status_reason_default_is_none():
@@ -194,7 +204,7 @@ def test_spec_edit_rejected_on_running_pod_even_with_force():
     service = _make_service(user, pod)
 
     req = _spec_update_req("p1", force=True)
-    result, err = asyncio.get_event_loop().run_until_complete(
+    result, err = run(
         service.update(_FakeApp(), req)
     )
     assert result is None
@@ -207,7 +217,7 @@ def test_spec_edit_rejected_on_running_pod_for_user():
     service = _make_service(user, pod)
 
     req = _spec_update_req("p1", force=False)
-    result, err = asyncio.get_event_loop().run_until_complete(
+    result, err = run(
         service.update(_FakeApp(), req)
     )
     assert result is None
@@ -283,7 +293,7 @@ def test_template_ref_switch_updates_db_field():
     service = _make_service_with_template(user, pod, new_template_id, committed=True)
 
     req = PodUpdateRequest(pod_id="p1", template_ref=new_template_id)
-    result, err = asyncio.get_event_loop().run_until_complete(
+    result, err = run(
         service.update(_FakeApp(), req)
     )
 
@@ -305,7 +315,7 @@ def test_template_ref_switch_rejected_on_running_pod():
     service = _make_service_with_template(user, pod, new_template_id, committed=True)
 
     req = PodUpdateRequest(pod_id="p1", template_ref=new_template_id)
-    result, err = asyncio.get_event_loop().run_until_complete(
+    result, err = run(
         service.update(_FakeApp(), req)
     )
 
@@ -323,7 +333,7 @@ def test_template_ref_switch_rejected_when_template_not_committed():
     service = _make_service_with_template(user, pod, new_template_id, committed=False)
 
     req = PodUpdateRequest(pod_id="p1", template_ref=new_template_id)
-    result, err = asyncio.get_event_loop().run_until_complete(
+    result, err = run(
         service.update(_FakeApp(), req)
     )
 
@@ -343,7 +353,7 @@ def test_template_ref_switch_rejected_when_template_not_found():
     service = _make_service_with_template(user, pod, wrong_template_id, committed=True)
 
     req = PodUpdateRequest(pod_id="p1", template_ref=new_template_id)
-    result, err = asyncio.get_event_loop().run_until_complete(
+    result, err = run(
         service.update(_FakeApp(), req)
     )
 
@@ -362,7 +372,7 @@ def test_template_ref_same_value_is_noop():
     service = _make_service_with_template(user, pod, existing_template_id, committed=True)
 
     req = PodUpdateRequest(pod_id="p1", template_ref=existing_template_id)
-    result, err = asyncio.get_event_loop().run_until_complete(
+    result, err = run(
         service.update(_FakeApp(), req)
     )
 
@@ -406,33 +416,27 @@ def _pod_with_image_pull_error(message: str):
 
 
 def test_get_pod_failure_reason_reports_insufficient_memory():
-    import asyncio
-
     op = _make_operator_stub([
         _pod_with_unschedulable("0/3 nodes are available: 3 Insufficient memory.")
     ])
 
-    reason = asyncio.get_event_loop().run_until_complete(op.get_pod_failure_reason("pid"))
+    reason = run(op.get_pod_failure_reason("pid"))
     assert reason is not None
     assert "Unschedulable" in reason
     assert "Insufficient memory" in reason
 
 
 def test_get_pod_failure_reason_reports_image_pull():
-    import asyncio
-
     op = _make_operator_stub([
         _pod_with_image_pull_error("Back-off pulling image \"nope:latest\"")
     ])
 
-    reason = asyncio.get_event_loop().run_until_complete(op.get_pod_failure_reason("pid"))
+    reason = run(op.get_pod_failure_reason("pid"))
     assert reason is not None
     assert "ImagePullBackOff" in reason
 
 
 def test_get_pod_failure_reason_none_when_healthy():
-    import asyncio
-
     healthy = SimpleNamespace(
         status=SimpleNamespace(
             conditions=[SimpleNamespace(type="PodScheduled", status="True",
@@ -442,7 +446,7 @@ def test_get_pod_failure_reason_none_when_healthy():
     )
     op = _make_operator_stub([healthy])
 
-    reason = asyncio.get_event_loop().run_until_complete(op.get_pod_failure_reason("pid"))
+    reason = run(op.get_pod_failure_reason("pid"))
     assert reason is None
 
 
@@ -469,7 +473,7 @@ def test_wait_pod_returns_k8s_pod_failed_on_terminal_failure():
         deployment_status=SimpleNamespace(replicas=1, ready_replicas=None),
         pods=[_pod_with_unschedulable("Insufficient memory")],
     )
-    reason, err = asyncio.get_event_loop().run_until_complete(
+    reason, err = run(
         op.wait_pod("pid", datamodels.PodStatusEnum.running, timeout_s=5)
     )
     assert err is errors.k8s_pod_failed
@@ -483,7 +487,7 @@ def test_wait_pod_returns_k8s_timeout_when_no_terminal_reason():
         deployment_status=SimpleNamespace(replicas=1, ready_replicas=None),
         pods=[],  # no pods visible, no reason to surface
     )
-    reason, err = asyncio.get_event_loop().run_until_complete(
+    reason, err = run(
         op.wait_pod("pid", datamodels.PodStatusEnum.running, timeout_s=0)
     )
     assert err is errors.k8s_timeout
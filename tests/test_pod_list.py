@@ -0,0 +1,49 @@
+"""
+Tests for: listing pods with the owner filter and the range pushed into the database.
+"""
+import uuid
+
+from src.apiserver.repo import PodRepo
+from src.apiserver.service.common import merge_query_filter
+from src.components import datamodels
+
+from conftest import FakeCollection, FakeDB, run
+
+
+def _documents():
+    template_ref, user_uuid = str(uuid.uuid4()), str(uuid.uuid4())
+    return [
+        datamodels.PodModel.new(template_ref, f"user{i % 2}", user_uuid, name=f"pod{i:02d}").model_dump()
+        for i in range(10)
+    ]
+
+
+def test_range_is_read_from_the_server():
+    collection = FakeCollection(_documents())
+    repo = PodRepo.__wrapped__(FakeDB(collection))
+
+    count, pods, err = run(repo.list(index_start=2, index_end=5))
+    assert err is None and count == 10 and "count_documents" in collection.calls
+    assert [p.name for p in pods] == ["pod02", "pod03", "pod04"]
+    assert (collection.cursor.skipped, collection.cursor.limited) == (2, 3)
+
+    count, pods, err = run(repo.list(index_start=5, index_end=5))
+    assert err is None and pods == []
+
+
+def test_owner_listing_does_not_count_all_pods():
+    collection = FakeCollection(_documents())
+    repo = PodRepo.__wrapped__(FakeDB(collection))
+
+    count, pods, err = run(repo.list(extra_query_filter={'username': 'user1'}, count_all=False))
+    assert err is None and count == 0 and "count_documents" not in collection.calls
+    assert [p.name for p in pods] == ["pod01", "pod03", "pod05", "pod07", "pod09"]
+    assert collection.cursor.limited == 0
+
+
+def test_owner_filter_is_merged():
+    owner = {'username': 'user1'}
+    assert merge_query_filter({}, owner) == owner
+    assert merge_query_filter({'name': 'a'}, None) == {'name': 'a'}
+    # the client cannot widen the owner filter, e.g. with its own username condition
+    assert merge_query_filter({'username': 'user2'}, owner) == {'$and': [{'username': 'user2'}, owner]}
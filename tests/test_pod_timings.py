@@ -0,0 +1,106 @@
+"""
+Tests for: the per-phase timings of pod starts, from the handler and from the timestamps of K8s.
+"""
+import datetime
+from types import SimpleNamespace
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.service.operator import K8SOperatorService
+from src.apiserver.service.pod import PodService, _percentile
+from src.components import datamodels, metrics
+
+from conftest import run
+
+
+def test_phase_timer_records_phases(monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", {})
+    monkeypatch.setattr(metrics, "RECONCILE_PHASE_DURATION", metrics.Histogram("test_seconds", "Test",
+                                                                               ("handler", "phase")))
+    timer = metrics.PhaseTimer("pod_create_update")
+    with timer.phase("render"):
+        pass
+    timer.record("scheduling", 1.5)
+
+    timings = timer.total()
+    assert timings["scheduling"] == 1500 and timings["render"] >= 0 and timings["total"] >= 0
+    assert "total" not in timer.timings
+    observed = dict(metrics.RECONCILE_PHASE_DURATION.collect())
+    assert set(observed) == {("pod_create_update", "render"), ("pod_create_update", "scheduling")}
+
+
+def _at(seconds: float) -> datetime.datetime:
+    return datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+
+def _k8s_pod(created: float, scheduled=None, started=None, ready=None):
+    conditions = [SimpleNamespace(type=t, status="True", last_transition_time=_at(s))
+                  for t, s in (("PodScheduled", scheduled), ("Ready", ready)) if s is not None]
+    running = None if started is None else SimpleNamespace(started_at=_at(started))
+    return SimpleNamespace(
+        metadata=SimpleNamespace(creation_timestamp=_at(created)),
+        status=SimpleNamespace(
+            conditions=conditions,
+            container_statuses=[SimpleNamespace(state=SimpleNamespace(running=running, waiting=None))],
+        ),
+    )
+
+
+def _operator(items):
+    op = K8SOperatorService.__new__(K8SOperatorService)
+    op.namespace = "test-ns"
+    op.v1 = SimpleNamespace(list_namespaced_pod=lambda namespace, label_selector: SimpleNamespace(items=items))
+    return op
+
+
+def test_start_is_broken_down_from_the_newest_pod():
+    op = _operator([
+        _k8s_pod(0, scheduled=1, started=2, ready=3),  # the pod of the previous start
+        _k8s_pod(100, scheduled=101.5, started=140, ready=145),
+    ])
+    timings = run(op.get_pod_start_timings("pid", since=_at(99).timestamp()))
+    assert timings == {"scheduling": 1.5, "image_pull": 38.5, "readiness": 5.0}
+
+
+def test_start_is_broken_down_until_the_pod_got_stuck():
+    op = _operator([_k8s_pod(100, scheduled=101)])
+    assert run(op.get_pod_start_timings("pid", since=_at(99).timestamp())) == {"scheduling": 1.0}
+
+
+def test_nothing_is_broken_down_if_no_pod_was_started():
+    op = _operator([_k8s_pod(0, scheduled=1, started=2, ready=3)])
+    assert run(op.get_pod_start_timings("pid", since=_at(100).timestamp())) == {}
+    assert run(_operator([]).get_pod_start_timings("pid", since=0)) == {}
+
+
+def test_percentile():
+    assert _percentile([5], 95) == 5
+    assert _percentile([4, 1, 3, 2], 50) == 2
+    assert _percentile(list(range(1, 101)), 95) == 95
+
+
+class _FakePodRepo:
+    async def list_timings(self):
+        return [
+            {'template_ref': 't1', 'timings': {'image_pull': 1000, 'total': 2000}},
+            {'template_ref': 't1', 'timings': {'image_pull': 3000, 'total': 5000}},
+            {'template_ref': 't2', 'timings': {'total': 500}},
+        ], None
+
+
+def test_timings_are_summarized_by_template():
+    service = PodService.__new__(PodService)
+    service.repo = _FakePodRepo()
+
+    templates, err = run(service.summarize_timings(None))
+    assert err is None
+    assert [(t.template_ref, t.pods) for t in templates] == [('t1', 2), ('t2', 1)]
+    assert templates[0].p50_ms == {'image_pull': 1000, 'total': 2000}
+    assert templates[0].p95_ms == {'image_pull': 3000, 'total': 5000}
+
+
+def test_pods_without_timings_are_upgraded():
+    pod = datamodels.PodModel.new(
+        "6f2b7c4e-5d1a-4b3e-9f8a-2c3d4e5f6a7b", "user1", "0c1d2e3f-4a5b-4c6d-8e7f-8091a2b3c4d5"
+    ).model_dump()
+    del pod['timings']
+    assert datamodels.PodModel.upgrade(pod).timings is None
@@ -0,0 +1,101 @@
+"""
+Tests for: profiling a running worker, and broadcasting profiles to all workers.
+"""
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.components import errors, profiler
+
+from conftest import run
+
+
+def _spin(seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        pass
+
+
+_hoard = []
+
+
+async def _allocate():
+    await asyncio.sleep(0.05)
+    _hoard.append([object() for _ in range(20000)])
+
+
+def test_cpu_profile_samples_the_loop():
+    async def _test():
+        task = asyncio.ensure_future(profiler.run_profile("cpu", 0.3, 10))
+        await asyncio.sleep(0.05)
+        busy, err = await profiler.run_profile("cpu", 0.1, 10)
+        assert busy is None and err is errors.profile_running
+        _spin(0.2)  # holds the loop, the sampler sees it
+        return await task
+
+    result, err = run(_test())
+    assert err is None and result['samples'] > 0 and not profiler.is_running()
+    spinning = sum(n for stack, n in result['stacks'].items() if stack.endswith("tests/test_profiler.py:_spin"))
+    assert spinning > 0
+
+
+def test_alloc_profile_finds_the_allocating_line():
+    async def _test():
+        task = asyncio.ensure_future(profiler.run_profile("alloc", 0.2, 5))
+        await _allocate()
+        return await task
+
+    result, err = run(_test())
+    assert err is None
+    assert any(a['location'].startswith("tests/test_profiler.py:") and a['size_diff_kb'] > 0
+               for a in result['allocations'])
+    _hoard.clear()
+
+
+def test_broadcast_results_are_collected(tmp_path):
+    directory = str(tmp_path)
+    profile_id = profiler.request_profile("cpu", 5, 10, directory=directory)
+    assert profiler.pending_requests(directory) == []  # requested by this worker
+
+    profiler.write_result(profile_id, {'pid': 2, 'mode': 'cpu', 'samples': 3, 'stacks': {'a;b': 3}}, directory)
+    results = run(profiler.collect_results(profile_id, 1, 1, directory=directory))
+    assert [r['pid'] for r in results] == [2]
+    assert os.listdir(directory) == []
+
+
+def test_results_are_merged():
+    merged = profiler.merge_results([
+        {'pid': 2, 'samples': 3, 'stacks': {'a;b': 2, 'a;c': 1}},
+        {'pid': 1, 'samples': 2, 'stacks': {'a;c': 2}},
+    ], 10)
+    assert merged['workers'] == [1, 2] and merged['samples'] == 5
+    assert merged['collapsed'] == ['a;c 3', 'a;b 2']
+
+    allocations = [{'location': f"x.py:{i}", 'size_diff_kb': float(i), 'count_diff': 1, 'size_kb': 1., 'pid': 1}
+                   for i in range(5)]
+    merged = profiler.merge_results([{'pid': 1, 'allocations': allocations}], 2)
+    assert [a['location'] for a in merged['allocations']] == ["x.py:4", "x.py:3"]
+
+
+def test_answered_requests_are_forgotten_once_over(monkeypatch):
+    from src.components import tasks
+
+    polls = [[{'id': "a"}], [{'id': "a"}, {'id': "b"}], [{'id': "b"}], [], [{'id': "a"}]]
+
+    def _pending_requests():
+        if not polls:
+            raise asyncio.CancelledError()
+        return polls.pop(0)
+
+    answered = []
+
+    def _add_task(coro, name=None):
+        coro.close()
+        answered.append(name)
+
+    monkeypatch.setattr(tasks.config, "CONFIG_PROFILE_POLL_INTERVAL_S", 0)
+    monkeypatch.setattr(tasks.profiler, "pending_requests", _pending_requests)
+    run(tasks.poll_profile_requests(SimpleNamespace(add_task=_add_task)))
+    assert answered == ["profile_a", "profile_b", "profile_a"]
@@ -0,0 +1,92 @@
+"""
+Tests for: guarding the query filters of list requests.
+"""
+import pymongo.errors
+import pytest
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.repo import db
+from src.apiserver.service.common import parse_query_filter
+from src.components import datamodels, errors
+from src.components.query_guard import check_query_filter, query_error, query_shape
+
+from conftest import FakeCollection, run
+
+
+@pytest.mark.parametrize("query_filter", [
+    {},
+    {'current_status': 'running'},
+    {'username': {'$in': ['user1', 'user2']}, 'gpu': {'$gt': 0}},
+    {'$or': [{'name': {'$regex': '^dev-'}}, {'cpu_lim_m_cpu': {'$not': {'$lte': 1000}}}]},
+])
+def test_allowed_filters(query_filter):
+    assert check_query_filter(datamodels.pod_collection_name, query_filter) is None
+
+
+@pytest.mark.parametrize("query_filter", [
+    [],
+    {'password': 'x'},  # secrets
+    {'$where': 'sleep(1000)'},
+    {'$expr': {'$eq': ['$username', '$name']}},
+    {'name': {'$regex': 'dev'}},  # unanchored, scans the index
+    {'name': {'$not': {'$regex': '^dev-'}}},  # negated, scans the index
+    {'username': {'$in': ['user'] * 101}},
+    {'$and': []},
+    {'$and': [{'$or': [{'$and': [{'$or': [{'$and': [{'name': 'a'}]}]}]}]}]},
+    {'template_str': {'$exists': True}},  # rendered manifests are not filterable
+])
+def test_rejected_filters(query_filter):
+    assert check_query_filter(datamodels.pod_collection_name, query_filter) is errors.query_filter_not_allowed
+
+
+def test_parse_query_filter_checks_the_collection():
+    assert parse_query_filter('{"role": "admin"}', datamodels.user_collection_name) == ({'role': 'admin'}, None)
+    assert parse_query_filter('{"role": "admin"}', datamodels.pod_collection_name) == (
+        None, errors.query_filter_not_allowed
+    )
+    assert parse_query_filter('{', datamodels.user_collection_name) == (None, errors.wrong_query_filter)
+
+
+def test_query_shape_ignores_values():
+    assert query_shape({'a': 1, 'b': {'$in': ['x']}}) == query_shape({'b': {'$in': ['y']}, 'a': 2})
+    assert query_shape({'a': 1}) != query_shape({'a': 'x'})
+
+
+def test_query_error():
+    assert query_error(pymongo.errors.ExecutionTimeout("time limit")) is errors.query_timeout
+    assert query_error(errors.query_not_indexed) is errors.query_not_indexed
+    assert query_error(ConnectionError()) is errors.db_connection_error
+
+
+class _SizedCollection(FakeCollection):
+    """Reports n documents without holding them."""
+
+    def __init__(self, plan, n):
+        super().__init__(name="pods", plan=plan)
+        self.n = n
+
+    async def estimated_document_count(self, **kwargs):
+        return self.n
+
+
+def test_check_query_plan(monkeypatch):
+    monkeypatch.setattr(db, "_plan_cache", {})
+    collscan = {'stage': 'SORT', 'inputStage': {'stage': 'COLLSCAN'}}
+    ixscan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'name_1'}}
+
+    # small collections are not explained
+    small = _SizedCollection(collscan, 10)
+    run(db.check_query_plan(small, {'gpu': 1}, 'name'))
+    assert small.calls.count("find") == 0
+
+    large = _SizedCollection(collscan, 10 ** 6)
+    for value in (1, 2):
+        with pytest.raises(Exception) as e:
+            run(db.check_query_plan(large, {'gpu': value}, 'name'))
+        assert e.value is errors.query_not_indexed
+    assert large.calls.count("find") == 1  # the second query has the same shape
+
+    indexed = _SizedCollection(ixscan, 10 ** 6)
+    indexed.name = "users"
+    run(db.check_query_plan(indexed, {'username': 'user1'}, 'name'))
+    assert indexed.calls.count("find") == 1
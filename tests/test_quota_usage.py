@@ -0,0 +1,159 @@
+"""
+Tests for: quota admission against the materialized per-user usage document.
+"""
+import asyncio
+import uuid
+
+from src.apiserver.controller.types import PodCreateRequest, PodUpdateRequest
+from src.apiserver.repo.usage import usage_of
+from src.components import datamodels, errors
+
+from conftest import FakeApp, make_pod_service, run, stored_usage
+
+
+def _new_user(cpu_m: int = 2000, pod_n: int = 10) -> datamodels.UserModel:
+    return datamodels.UserModel.new(
+        uid=1,
+        username="user1",
+        password="pass",
+        role=datamodels.UserRoleEnum.user,
+        quota={
+            "cpu_m": cpu_m,
+            "memory_mb": 16384,
+            "storage_mb": 51200,
+            "gpu": 0,
+            "network_mb": 0,
+            "pod_n": pod_n,
+        },
+    )
+
+
+def _new_pod(target: datamodels.PodStatusEnum,
+             current: datamodels.PodStatusEnum,
+             pod_id: str = "p1",
+             cpu: int = 1000) -> datamodels.PodModel:
+    pod = datamodels.PodModel.new(
+        template_ref=str(uuid.uuid4()),
+        username="user1",
+        user_uuid=str(uuid.uuid4()),
+        cpu_lim_m_cpu=cpu,
+        mem_lim_mb=1024,
+        storage_lim_mb=10240,
+    )
+    pod.pod_id = pod_id
+    pod.target_status = target
+    pod.current_status = current
+    return pod
+
+
+def test_usage_of_failed_pod_holds_no_compute():
+    pod = _new_pod(datamodels.PodStatusEnum.running, datamodels.PodStatusEnum.failed)
+    usage = usage_of(pod)
+    assert usage["pod_n"] == 1
+    assert usage["storage_mb"] == 10240
+    assert usage["cpu_m"] == 0 and usage["memory_mb"] == 0
+
+
+def test_start_pod_reserves_compute():
+    pod = _new_pod(datamodels.PodStatusEnum.stopped, datamodels.PodStatusEnum.stopped)
+    service = make_pod_service(_new_user(), [pod])
+
+    req = PodUpdateRequest(pod_id="p1", target_status=datamodels.PodStatusEnum.running)
+    _, err = run(service.update(FakeApp(), req))
+
+    assert err is None
+    assert stored_usage(service)["cpu_m"] == 1000
+    assert stored_usage(service)["memory_mb"] == 1024
+
+
+def test_start_pod_over_quota_is_rejected_before_update():
+    pod = _new_pod(datamodels.PodStatusEnum.stopped, datamodels.PodStatusEnum.stopped)
+    other = _new_pod(datamodels.PodStatusEnum.running, datamodels.PodStatusEnum.running, pod_id="p2", cpu=1500)
+    service = make_pod_service(_new_user(cpu_m=2000), [pod, other])
+
+    req = PodUpdateRequest(pod_id="p1", target_status=datamodels.PodStatusEnum.running)
+    result, err = run(service.update(FakeApp(), req))
+
+    assert result is None
+    assert err is errors.quota_exceeded
+    assert "find_one_and_replace" not in service.repo.db.collections[datamodels.pod_collection_name].calls
+    assert stored_usage(service)["cpu_m"] == 1500
+
+
+def test_stop_pod_releases_compute():
+    pod = _new_pod(datamodels.PodStatusEnum.running, datamodels.PodStatusEnum.running)
+    service = make_pod_service(_new_user(), [pod])
+
+    req = PodUpdateRequest(pod_id="p1", target_status=datamodels.PodStatusEnum.stopped)
+    _, err = run(service.update(FakeApp(), req))
+
+    assert err is None
+    assert stored_usage(service)["cpu_m"] == 0
+    assert stored_usage(service)["memory_mb"] == 0
+    assert stored_usage(service)["pod_n"] == 1
+
+
+def test_create_failure_gives_reservation_back():
+    service = make_pod_service(_new_user(), [_new_pod(datamodels.PodStatusEnum.stopped,
+                                                      datamodels.PodStatusEnum.stopped)])
+    before = dict(stored_usage(service))
+
+    async def _insert_one(document):
+        raise ConnectionError()
+
+    service.repo.db.collections[datamodels.pod_collection_name].insert_one = _insert_one
+    req = PodCreateRequest(
+        name="pod-new",
+        description="",
+        template_ref=str(uuid.uuid4()),
+        cpu_lim_m_cpu=1000,
+        mem_lim_mb=1024,
+        storage_lim_mb=10240,
+        username="user1",
+        timeout_s=3600,
+    )
+    _, err = run(service.create(FakeApp(), req))
+
+    assert err is errors.db_connection_error
+    assert stored_usage(service) == before
+
+
+def test_failed_start_after_stop_is_not_released_twice():
+    pod = _new_pod(datamodels.PodStatusEnum.running, datamodels.PodStatusEnum.pending)
+    service = make_pod_service(_new_user(), [pod])
+
+    # the pod is stopped while its start is waited for, which gives its compute back
+    req = PodUpdateRequest(pod_id="p1", target_status=datamodels.PodStatusEnum.stopped)
+    _, err = run(service.update(FakeApp(), req))
+    assert err is None and stored_usage(service)["cpu_m"] == 0
+
+    # then the start fails: the pod no longer held compute
+    held_pod, err = run(service.repo.fail("p1"))
+    assert err is None and held_pod is None
+
+
+def test_failed_start_marks_pod_failed_once():
+    pod = _new_pod(datamodels.PodStatusEnum.running, datamodels.PodStatusEnum.pending)
+    service = make_pod_service(_new_user(), [pod])
+
+    held_pod, err = run(service.repo.fail("p1"))
+    assert err is None and held_pod.holds_compute
+    failed, _ = run(service.repo.get("p1"))
+    assert failed.current_status == datamodels.PodStatusEnum.failed
+
+    held_pod, err = run(service.repo.fail("p1"))
+    assert err is None and held_pod is None
+
+
+def test_concurrent_starts_reserve_compute_once():
+    pod = _new_pod(datamodels.PodStatusEnum.stopped, datamodels.PodStatusEnum.stopped)
+    service = make_pod_service(_new_user(), [pod])
+
+    async def _start_twice():
+        req = PodUpdateRequest(pod_id="p1", target_status=datamodels.PodStatusEnum.running)
+        return await asyncio.gather(service.update(FakeApp(), req), service.update(FakeApp(), req.model_copy()))
+
+    errs = [err for _, err in run(_start_twice())]
+    assert errs.count(None) == 1 and errors.pod_changed in errs
+    assert stored_usage(service)["cpu_m"] == 1000
+    assert stored_usage(service)["memory_mb"] == 1024
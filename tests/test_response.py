@@ -0,0 +1,39 @@
+"""
+Tests for: serializing response models to JSON bytes.
+"""
+import datetime
+import http
+import json
+import uuid
+
+from sanic.response import json as json_response
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.controller import response
+from src.apiserver.controller.types import PodListResponse
+from src.components import datamodels
+
+
+def _pod_list_response():
+    pods = [datamodels.PodModel.new(str(uuid.uuid4()), "user1", str(uuid.uuid4()), name=f"pod{i}") for i in range(3)]
+    # a pod read back from the database carries an aware datetime
+    pods[0] = datamodels.PodModel(**pods[0].model_dump())
+    return PodListResponse(status=http.HTTPStatus.OK, message="success", total_pods=3, pods=pods)
+
+
+def test_model_response_matches_model_dump(monkeypatch):
+    model = _pod_list_response()
+    expected = json.loads(json_response(model.model_dump()).body)
+
+    res = response.model_response(model, status=http.HTTPStatus.CREATED)
+    assert res.status == http.HTTPStatus.CREATED and res.content_type == "application/json"
+    assert json.loads(res.body) == expected
+
+    monkeypatch.setattr(response, "orjson", None)
+    assert json.loads(response.model_response(model).body) == expected
+
+
+def test_datetime_format_is_unchanged():
+    for v in (datetime.datetime.utcnow(), datetime.datetime.fromtimestamp(0),
+              datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)):
+        assert datamodels._format_datetime(v) == v.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
@@ -0,0 +1,53 @@
+"""
+Tests for: detecting event loop stalls and attributing them to the code that blocks the loop.
+"""
+import asyncio
+import json
+import time
+
+from src.components import stalls
+
+from conftest import run
+
+
+def _block():
+    time.sleep(0.3)  # a synchronous call on the loop
+
+
+def test_blocking_callback_is_attributed(tmp_path):
+    async def _test():
+        watchdog = stalls.StallWatchdog(0.05, sample_interval_s=0.01, check_interval_s=0.01, directory=str(tmp_path))
+        watchdog.start(asyncio.get_running_loop())
+        await asyncio.sleep(0.05)
+        _block()
+        await asyncio.sleep(0.05)
+        watchdog.stop()
+        return watchdog
+
+    watchdog = run(_test())
+    stall = next(s for s in watchdog.stalls.values() if "in _block" in s['location'])
+    assert stall['location'].startswith("tests/test_stalls.py:")
+    assert stall['count'] == 1 and stall['max_ms'] >= 250
+    assert stall['stack'][-1] == stall['location']
+
+    reported = stalls.read_stalls(str(tmp_path))
+    assert stall['location'] in [s['location'] for s in reported]
+
+
+def test_stalls_of_workers_are_merged(tmp_path):
+    def _write(pid, count, total_ms, max_ms):
+        stall = {'location': 'src/x.py:1 in f', 'count': count, 'total_ms': total_ms, 'max_ms': max_ms,
+                 'stack': [f"worker {pid}"]}
+        with open(tmp_path / f"{pid}.json", "w") as f:
+            json.dump({'pid': pid, 'stalls': [stall]}, f)
+
+    _write(1, 2, 300, 200)
+    _write(2, 1, 500, 500)
+    with open(tmp_path / "3.json", "w") as f:
+        json.dump({'pid': 3, 'stalls': [{'location': 'src/y.py:2 in g', 'count': 1, 'total_ms': 100, 'max_ms': 100,
+                                         'stack': []}]}, f)
+
+    reported = stalls.read_stalls(str(tmp_path))
+    assert [s['location'] for s in reported] == ['src/x.py:1 in f', 'src/y.py:2 in g']
+    assert reported[0]['count'] == 3 and reported[0]['total_ms'] == 800 and reported[0]['max_ms'] == 500
+    assert reported[0]['stack'] == ["worker 2"] and sorted(reported[0]['workers']) == [1, 2]
@@ -0,0 +1,28 @@
+"""
+Tests for: uid allocation from leased blocks.
+"""
+import asyncio
+
+from src.apiserver.repo.uid import UidAllocator
+
+from conftest import FakeCollection, FakeDB, run
+
+
+def test_concurrent_callers_share_leases_and_get_unique_uids():
+    collection = FakeCollection([{"_id": "global", "uid_counter": 1}])
+    workers = [UidAllocator(FakeDB(collection), block_size=8) for _ in range(3)]
+
+    uids = run(asyncio.gather(*[workers[i % 3].next() for i in range(60)]))
+    assert len(set(uids)) == 60
+    assert min(uids) == 1  # the first uid is the counter before the first lease, as before
+    assert collection.calls == ["find_one_and_update"] * 9  # ceil(20 / 8) leases per worker, not one $inc per user
+
+
+def test_block_leased_before_fork_is_not_reused():
+    collection = FakeCollection([{"_id": "global", "uid_counter": 1}])
+    allocator = UidAllocator(FakeDB(collection), block_size=8)
+    assert run(allocator.next()) == 1
+
+    allocator._pid = -1  # what a forked worker sees
+    assert run(allocator.next()) == 9
+    assert collection.calls == ["find_one_and_update"] * 2
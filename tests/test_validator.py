@@ -0,0 +1,118 @@
+"""
+Tests for: cached token validation on the auth-url path.
+"""
+import time
+
+import jwt
+
+from src.components import config, errors
+from src.components.cache import TTLCache
+from src.components.config import APIServerConfig
+from src.components.resources import K8SIngressResource
+from src.components.revocation import RevocationTable
+from src.components.validator import DeviceTokenValidator, handle_token_validate
+
+from conftest import run
+
+_SECRET = "secret"
+_ALGORITHM = "HS256"
+
+
+def _token(username="user1", role="device", exp_s=config.CONFIG_DEVICE_TOKEN_EXPIRE_S):
+    now = int(time.time())
+    payload = {'username': username, 'role': role, 'exp': now + exp_s, 'iat': now, 'email': None, 'uid': 1000}
+    return jwt.encode(payload, _SECRET, algorithm=_ALGORITHM)
+
+
+def test_cached_token_skips_decode(monkeypatch):
+    validator = DeviceTokenValidator(_SECRET, _ALGORITHM)
+    token = _token()
+
+    res, err = validator.validate(token, "user1")
+    assert err is None and res.token == token
+
+    def _fail(*_a, **_kw):
+        raise AssertionError("jwt.decode called for a cached token")
+
+    monkeypatch.setattr(jwt, "decode", _fail)
+    res, err = validator.validate(token, "user1")
+    assert err is None and res.token == token
+
+
+def test_non_device_token_is_rotated():
+    validator = DeviceTokenValidator(_SECRET, _ALGORITHM)
+    token = _token(role="user", exp_s=3600)
+
+    res, err = validator.validate(token, "user1")
+    assert err is None
+    assert res.token != token
+    assert jwt.decode(res.token, _SECRET, algorithms=[_ALGORITHM])['role'] == "device"
+    # the rotated token is handed out again until the presented token expires
+    assert validator.validate(token, "user1")[0].token == res.token
+
+
+def test_username_mismatch_and_bad_signature_are_rejected():
+    validator = DeviceTokenValidator(_SECRET, _ALGORITHM)
+    token = _token()
+
+    assert validator.validate(token, "user1")[1] is None
+    assert validator.validate(token, "user2")[1] is errors.user_not_allowed  # also on a cache hit
+    assert validator.validate(token + "x", "user1")[1] is errors.invalid_token
+
+
+def test_ttl_cache_evicts_lru_and_expired_entries():
+    cache = TTLCache(maxsize=2)
+    cache.put("a", 1, expires_at=100)
+    cache.put("b", 2, expires_at=100)
+    assert cache.get("a", now=0) == 1  # "b" is now least recently used
+    cache.put("c", 3, expires_at=100)
+
+    assert cache.get("b", now=0) is None
+    assert cache.get("a", now=0) == 1
+    assert cache.get("c", now=100) is None  # expired
+    assert len(cache) == 1
+
+
+class _RequestStub:
+    def __init__(self, cookie=None, bearer=None):
+        self.cookies = {config.CONFIG_AUTH_COOKIES_NAME: cookie} if cookie is not None else {}
+        self.headers = {'Authorization': f"Bearer {bearer}"} if bearer is not None else {}
+
+
+def test_cookie_is_only_set_when_the_token_changes():
+    validator = DeviceTokenValidator(_SECRET, _ALGORITHM)
+    token = _token()
+
+    r = run(handle_token_validate(_RequestStub(bearer=token), "user1", validator, cache_duration_s=60))
+    assert r.status == 200 and 'Set-Cookie' in r.headers
+    assert r.headers['X-Accel-Expires'] == "60"
+
+    r = run(handle_token_validate(_RequestStub(cookie=token), "user1", validator, cache_duration_s=60))
+    assert r.status == 200 and 'Set-Cookie' not in r.headers  # cacheable by the ingress
+
+    r = run(handle_token_validate(_RequestStub(cookie=token), "user1", validator))
+    assert r.headers['Cache-Control'] == "no-store"
+
+
+def test_ingress_carries_auth_cache_annotations():
+    opt = APIServerConfig(config_auth_endpoint="http://apiserver", config_auth_cache_duration_s=30)
+    pod_values = {"POD_LABEL": "clpl-pod-1", "POD_ID": "pod1", "POD_USERNAME": "user1"}
+    ingress, _ = K8SIngressResource(pod_values=pod_values,
+                                    auth_values=opt.auth_config_values,
+                                    k8s_values=opt.k8s_config_values).render()
+
+    annotations = ingress['metadata']['annotations']
+    cookie = config.CONFIG_AUTH_COOKIES_NAME
+    assert annotations['nginx.ingress.kubernetes.io/auth-cache-duration'] == "200 202 30s"
+    assert annotations['nginx.ingress.kubernetes.io/auth-cache-key'] == \
+           f"$cookie_{cookie}$http_authorization$arg_{cookie}"
+
+
+def test_revoked_token_is_rejected_on_a_cache_hit():
+    revocations = RevocationTable()
+    validator = DeviceTokenValidator(_SECRET, _ALGORITHM, revocations=revocations)
+    token = _token()
+    assert validator.validate(token, "user1")[1] is None
+
+    revocations.update(1, [(1000, 1, False)])
+    assert validator.validate(token, "user1")[1] is errors.token_revoked
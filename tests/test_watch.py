@@ -0,0 +1,156 @@
+"""
+Tests for: the pod status watch hub and its server-sent event stream.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import src.apiserver.controller  # noqa: F401  # the controller package must be initialized before services
+from src.apiserver.controller import watch
+from src.components import datamodels
+from src.components.events import PodStatusEvent
+from src.components.watch import PodWatchHub
+
+from conftest import run
+
+
+def _event(pod_id: str, version: int, current_status: str = "running", username: str = "user1") -> PodStatusEvent:
+    return PodStatusEvent(
+        pod_id=pod_id,
+        username=username,
+        target_status=datamodels.PodStatusEnum.running,
+        current_status=current_status,
+        resource_status=datamodels.ResourceStatusEnum.committed,
+        resource_version=version,
+    )
+
+
+def _drain(sub):
+    events = []
+    while not sub.queue.empty():
+        events.append(sub.queue.get_nowait())
+    return events
+
+
+def _hub(queue_size: int = 8, backlog_size: int = 8) -> PodWatchHub:
+    hub = PodWatchHub(queue_size=queue_size, backlog_size=backlog_size, lookback=10)
+    hub.cursor = 1000  # subscribing starts from now, keep the versions of the tests ahead of it
+    return hub
+
+
+def test_publish_is_scoped_and_deduplicated(monkeypatch):
+    async def _test():
+        hub = _hub()
+        monkeypatch.setattr("src.components.watch.next_resource_version", lambda: 0)
+        mine, _ = hub.subscribe("user1")
+        everyone, _ = hub.subscribe(None)
+
+        assert hub.publish(_event("p1", 1001, "pending"))
+        assert hub.publish(_event("p2", 1002, "pending", username="user2"))
+        # the same write seen again by the poll, and a write that only touched accessed_at
+        assert not hub.publish(_event("p1", 1001, "pending"))
+        assert not hub.publish(_event("p1", 1003, "pending"))
+        assert hub.publish(_event("p1", 1004, "running"))
+
+        assert [(ev.pod_id, ev.resource_version) for ev in _drain(mine)] == [("p1", 1001), ("p1", 1004)]
+        assert [ev.pod_id for ev in _drain(everyone)] == ["p1", "p2", "p1"]
+        assert hub.cursor == 1004
+
+    run(_test())
+
+
+def test_slow_subscriber_is_marked_lagged(monkeypatch):
+    async def _test():
+        hub = _hub(queue_size=2)
+        monkeypatch.setattr("src.components.watch.next_resource_version", lambda: 0)
+        sub, _ = hub.subscribe()
+        for i in range(3):
+            hub.publish(_event(f"p{i}", 1001 + i))
+        assert sub.lagged and sub.queue.qsize() == 2
+
+    run(_test())
+
+
+def test_resume_from_backlog_or_database(monkeypatch):
+    async def _test():
+        hub = _hub(backlog_size=2)
+        monkeypatch.setattr("src.components.watch.next_resource_version", lambda: 0)
+        first, _ = hub.subscribe()
+        for i in range(3):
+            hub.publish(_event(f"p{i}", 1100 + i * 100))
+
+        # the backlog holds the last 2 events, it is complete after the evicted one
+        _, replay = hub.subscribe(since=1305)
+        assert [ev.pod_id for ev in replay] == ["p2"]
+        _, replay = hub.subscribe(since=1205)
+        assert [ev.pod_id for ev in replay] == ["p1", "p2"]
+        _, replay = hub.subscribe(since=1100)
+        assert replay is None
+
+        # once idle, nothing is polled and the backlog is not trusted anymore
+        for sub in list(hub._subscribers):
+            hub.unsubscribe(sub)
+        _, replay = hub.subscribe(since=1305)
+        assert replay is None
+
+    run(_test())
+
+
+class _FakeResponse:
+    def __init__(self, limit: int):
+        self.sent = []
+        self.limit = limit
+
+    async def send(self, data: bytes):
+        self.sent.append(data)
+        if len(self.sent) >= self.limit:
+            raise ConnectionResetError  # the client went away
+
+    async def eof(self):
+        pass
+
+
+class _FakePodService:
+    def __init__(self, events):
+        self.watch = _hub()
+        self.events = events
+        self.since = None
+
+    async def list_status(self, app, since, username=None):
+        self.since = since
+        return [ev for ev in self.events if username is None or ev.username == username], None
+
+
+def test_stream_resumes_from_the_database(monkeypatch):
+    pod_service = _FakePodService([_event("p1", 1500), _event("p2", 1600, username="user2")])
+    monkeypatch.setattr(watch, "get_root_service", lambda: SimpleNamespace(pod_service=pod_service))
+    response = _FakeResponse(limit=3)
+
+    async def _respond(**kwargs):
+        assert kwargs["content_type"] == "text/event-stream"
+        return response
+
+    async def _test():
+        request = SimpleNamespace(headers={"last-event-id": "1400"}, args={}, app=None, respond=_respond)
+        task = asyncio.ensure_future(watch.stream_pod_status(request, "user1"))
+        await asyncio.sleep(0)
+        pod_service.watch.publish(_event("p1", 1700, "stopped"))
+        try:
+            await task
+        except ConnectionResetError:
+            pass
+
+    run(_test())
+    assert pod_service.since == 1400 - pod_service.watch.lookback
+    assert response.sent[0].startswith(b"retry: ")
+    assert response.sent[1].startswith(b"id: 1500\nevent: pod_status_event\ndata: {")
+    assert response.sent[2].startswith(b"id: 1700\n")
+    assert len(pod_service.watch) == 0
+
+
+def test_stream_rejects_bad_since():
+    async def _respond(**kwargs):
+        raise AssertionError("must not start streaming")
+
+    request = SimpleNamespace(headers={}, args={"since": "-1"}, app=None, respond=_respond)
+    res = run(watch.stream_pod_status(request))
+    assert res.status == 400